@@ -1,23 +1,79 @@
+from typing import Optional
+
 from fastapi import APIRouter
-from api.service import insta
+from pydantic import BaseModel
+from api.service import ingest, insta, ollama
+from api.service.response import format_response
 import base64
 
 
 router = APIRouter()
 
+# we'll populate these when the main app registers this router
+router.insta = None
+router.database = None
+router.ingest_workers = None
 
 prefix = "/ai"
 
+
+class IngestRequest(BaseModel):
+    username: str
+    club_id: Optional[int] = None
+
+
 @router.get("/insta-post")
-def get_insta_details(username: str):
-    caption, image = insta.get_latest_post(username=username)
-    # base64 encode the binary image 
+async def get_insta_details(username: str):
+    try:
+        caption, image = await router.insta.get_latest_post(username)
+    except ValueError as e:
+        return format_response(status_code=404, data={"error": type(e).__name__, "message": str(e)})
+    except Exception as e:
+        return format_response(status_code=502, data={"error": type(e).__name__, "message": str(e)})
+    # base64 encode the binary image
     image = base64.b64encode(image).decode("utf-8")
     return {
         "caption": caption,
         "image": image
     }
-    
+
+
+@router.post("/ingest")
+async def ingest_post(request: IngestRequest):
+    """
+    Queue turning the club's latest post into a draft event, returning the job id at once.
+
+    Poll /ai/ingest/{job_id} for the draft; it holds the fields for /manage/add-event.
+    """
+    try:
+        username = request.username.strip().lower()
+        if not username:
+            raise ValueError("Username is required")
+        job_id = await router.database.add_ingest_job(username, club_id=request.club_id)
+        router.ingest_workers.notify()
+        return format_response(status_code=202, data={"job_id": job_id, "status": "queued"})
+    except Exception as e:
+        status = 400 if isinstance(e, ValueError) else 500
+        return format_response(status_code=status, data={"error": type(e).__name__, "message": str(e)})
+
+
+@router.get("/ingest/{job_id}")
+async def ingest_status(job_id: int):
+    try:
+        job = await router.database.get_ingest_job(job_id)
+        if job is None:
+            return format_response(status_code=404, data={"error": "Job not found"})
+        return format_response(status_code=200, data=job)
+    except Exception as e:
+        return format_response(status_code=500, data={"error": type(e).__name__, "message": str(e)})
+
+
 def setup(app):
     print("Loading")
-    app.include_router(router, prefix=prefix)
\ No newline at end of file
+    app.include_router(router, prefix=prefix)
+    router.insta = insta.InstaFetcher()
+    router.database = app.database
+    router.ingest_workers = ingest.IngestWorkers(
+        app.database, router.insta, ollama.AsyncOllamaService(), coordination=app.coordination
+    )
+    app.background.append(router.ingest_workers)
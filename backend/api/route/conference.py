@@ -1,16 +1,18 @@
-from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 
-from fastapi import APIRouter
-from pydantic import BaseModel
+from fastapi import APIRouter, Request, UploadFile
+from pydantic import BaseModel, ValidationError
 
 router = APIRouter()
 
-from api.service.response import format_response
+from api.service import bulk, config, pagination
+from api.service.payments import PaymentError
+from api.service.response import format_response, if_none_match, not_modified, resource_etag
+from api.service.schedule import Schedule
 
 # we'll populate these fields when the main app registers this router
 router.database = None
-router.razorpay_client = None
+router.payments = None
 
 prefix = "/events"
 
@@ -20,85 +22,194 @@ class EventRegistration(BaseModel):
     user_id: int
 
 
+class ConflictCheck(BaseModel):
+    user_id: int
+    event_ids: List[int]
+
+
 @router.post("/register-event")
 async def register_event(registration: EventRegistration):
     try:
-        # collect registered events and their timings
-        registered = router.database.get_registered_events(registration.user_id)
-        event_details_ids = [event["event_id"] for event in registered]
-        event_details = [router.database.search_event(event_id=x)[0] for x in event_details_ids]
-        timings = [(event["start_time"], event["end_time"]) for event in event_details]
-
-        to_register = router.database.search_event(event_name=registration.name)
+        def lookup(database):
+            # collect registered events and their timings
+            return (
+                database.get_booked_intervals(registration.user_id),
+                database.get_event(event_name=registration.name),
+            )
+
+        # all the lookups share one unit of work
+        booked, to_register = await router.database.unit_of_work(lookup)
         if not to_register:
             raise ValueError("Event not found")
-        to_register = to_register[0]
 
-        if to_register["event_id"] in event_details_ids:
-            raise ValueError("Already registered for this event")
-
-        # check each event for time conflict
-        for start, end in timings:
-            if to_register["start_time"] < end and to_register["end_time"] > start:
+        paid = (to_register["price"] or 0) > 0
+        held = None
+        if to_register["event_id"] in {event_id for event_id, _, _ in booked}:
+            if paid:
+                held = await router.database.get_live_registration(registration.user_id, to_register["event_id"])
+            if not held or held["status"] != "unpaid":
+                raise ValueError("Already registered for this event")
+
+        if held:
+            # a retry whose response was lost, or a waiter offered a seat: the same hold, and its order
+            registration_id, status = held["registration_id"], held["status"]
+        else:
+            schedule = Schedule((start, end) for _, start, end in booked)
+            if schedule.collides(to_register["start_time"], to_register["end_time"]):
                 raise ValueError("Time slot collides with another event")
 
-        order_id = None
-        if to_register["price"] > 0:
-            order_id = await process_payment(registration.user_id, to_register["price"])
-            if not order_id:
-                raise ValueError("Payment failed")
+            # a paid event's seat is held unpaid until the payment's capture is reconciled; a waiter
+            # gets the order for theirs when the seat is offered
+            registered = await router.database.register_event(registration.name, registration.user_id)
+            registration_id, status = registered["registration_id"], registered["status"]
 
-        registration_id = router.database.register_event(registration.name, registration.user_id)
-        return format_response(status_code=200, data={"registration_id": registration_id, "order_id": order_id})
+        order_id = None
+        if status == "unpaid":
+            try:
+                # the same order on every retry, and never blocks the event loop
+                order_id = await router.payments.create_order(
+                    registration_id, registration.user_id, to_register["event_id"], to_register["price"]
+                )
+            except Exception as e:
+                # don't hold a seat for a payment that cannot start; a retry's hold may still be
+                # getting its order from the first request, so only this request's own is cancelled
+                if not held:
+                    await router.database.cancel_registration(registration_id)
+                if isinstance(e, PaymentError):
+                    raise ValueError(f"Payment failed: {e}")
+                raise
+
+        return format_response(status_code=200, data={"registration_id": registration_id, "status": status, "order_id": order_id})
 
     except Exception as e:
         return {"response": {"error": type(e).__name__, "message": str(e)}}
 
 
-@router.get("/get-events")
-async def get_events():
+@router.post("/register-bulk")
+async def register_bulk(file: UploadFile):
+    """
+    Register many users from a CSV (with a `name,user_id` header) or JSON lines upload.
+
+    Valid rows are registered and invalid rows are reported, one result per row.
+    """
+    try:
+        rows = await bulk.read_rows(file)
+        if not rows:
+            raise ValueError("No registrations in upload")
+
+        registrations = []
+        errors = []
+        for number, row in enumerate(rows):
+            try:
+                registrations.append((number, EventRegistration.model_validate(row).model_dump()))
+            except ValidationError as e:
+                errors.append({"row": number, "error": str(e)})
+
+        results = await router.database.register_events_bulk([registration for _, registration in registrations])
+        # report rows by their position in the upload
+        for (number, _), result in zip(registrations, results):
+            result["row"] = number
+        results = sorted(results + errors, key=lambda result: result["row"])
+        return format_response(status_code=200, data=results)
+    except Exception as e:
+        status = 500
+        if isinstance(e, ValueError):
+            status = 400
+        return format_response(status_code=status, data={"error": type(e).__name__, "message": str(e)})
+
+
+@router.post("/check-conflicts")
+async def check_conflicts(check: ConflictCheck):
     try:
-        events = router.database.get_event_ids()
-        return format_response(status_code=200, data=events)
+        def lookup(database):
+            return database.get_booked_intervals(check.user_id), database.get_events(check.event_ids)
+
+        booked, events = await router.database.unit_of_work(lookup)
+
+        booked_ids = {event_id for event_id, _, _ in booked}
+        schedule = Schedule((start, end) for _, start, end in booked)
+        candidates = [event for event in events if event["event_id"] not in booked_ids]
+        data = {
+            "conflicts": [event["event_id"] for event in schedule.collisions(candidates)],
+            "registered": [event["event_id"] for event in events if event["event_id"] in booked_ids],
+        }
+        return format_response(status_code=200, data=data)
     except Exception as e:
         return format_response(status_code=500, data={"error": type(e).__name__, "message": str(e)})
 
 
+@router.get("/get-events")
+async def get_events(
+    request: Request, format: str = "json", cursor: Optional[str] = None, limit: Optional[int] = None
+):
+    try:
+        return await pagination.list_response(
+            request, router.database, "iter_event_ids", ["event_id"], format=format, cursor=cursor, limit=limit
+        )
+    except Exception as e:
+        status = 400 if isinstance(e, ValueError) else 500
+        return format_response(status_code=status, data={"error": type(e).__name__, "message": str(e)})
+
+
 @router.get("/get-event/{event_id}")
-async def get_event(event_id: int):
+async def get_event(request: Request, event_id: int):
     try:
-        event = router.database.search_event(event_id=event_id)
+        # an unchanged event is answered from the version this worker has cached
+        version = router.database.database.version_stamp("event", event_id)
+        if version is not None:
+            tag = resource_etag("event", event_id, version)
+            if if_none_match(request, tag):
+                return not_modified(tag, config.HTTP_MAX_AGE)
+
+        event = await router.database.get_event(event_id=event_id)
         if not event:
             return format_response(status_code=404, data={"error": "Event not found"})
 
-        return format_response(status_code=200, data=event[0])
+        return format_response(
+            status_code=200,
+            data=event,
+            request=request,
+            etag=resource_etag("event", event_id, event["version"]),
+            max_age=config.HTTP_MAX_AGE,
+        )
     except Exception as e:
         return format_response(status_code=500, data={"error": type(e).__name__, "message": str(e)})
 
 
 @router.get("/get-all-registrations")
-async def get_registrations():
+async def get_registrations(
+    request: Request, format: str = "json", cursor: Optional[str] = None, limit: Optional[int] = None
+):
     try:
-        registrations = router.database.get_registrations()
-        return format_response(status_code=200, data=registrations)
+        return await pagination.list_response(
+            request,
+            router.database,
+            "iter_registrations",
+            ["registration_id", "user_id", "event_name", "event_id", "registration_timestamp", "status"],
+            key=lambda registration: registration["registration_id"],
+            format=format,
+            cursor=cursor,
+            limit=limit,
+        )
     except Exception as e:
-        return format_response(status_code=500, data={"error": type(e).__name__, "message": str(e)})
+        status = 400 if isinstance(e, ValueError) else 500
+        return format_response(status_code=status, data={"error": type(e).__name__, "message": str(e)})
 
 
 @router.get("/approve-registration/{registration_id}")
 async def approve_registration(registration_id: int):
     try:
-        registration = router.database.approve_registration(registration_id)
+        registration = await router.database.approve_registration(registration_id)
         return format_response(status_code=200, data=registration)
     except Exception as e:
         return format_response(status_code=500, data={"error": type(e).__name__, "message": str(e)})
 
 
 @router.get("/registered-events")
-async def get_registered_events(user_id: int):
+async def get_registered_events(request: Request, user_id: int):
     try:
-        events = router.database.get_registered_events(user_id)
-        return format_response(status_code=200, data=events)
+        events = await router.database.get_registered_events(user_id)
+        return format_response(status_code=200, data=events, request=request)
     except Exception as e:
         return format_response(status_code=500, data={"error": type(e).__name__, "message": str(e)})
 
@@ -106,7 +217,7 @@ async def get_registered_events(user_id: int):
 @router.get("/cancel-registration/{registration_id}")
 async def cancel_registration(registration_id: int):
     try:
-        registration = router.database.cancel_registration(registration_id)
+        registration = await router.database.cancel_registration(registration_id)
         return format_response(status_code=200, data=registration)
     except Exception as e:
         return format_response(status_code=500, data={"error": type(e).__name__, "message": str(e)})
@@ -115,7 +226,7 @@ async def cancel_registration(registration_id: int):
 @router.get("/registration-status/{registration_id}")
 async def registration_status(registration_id):
     try:
-        status = router.database.registration_status(registration_id)
+        status = await router.database.registration_status(registration_id)
         return format_response(status_code=200, data=status)
     except Exception as e:
         return format_response(status_code=500, data={"error": type(e).__name__, "message": str(e)})
@@ -123,6 +234,7 @@ async def registration_status(registration_id):
 
 @router.get("/search-event")
 async def search_event(
+    request: Request,
     event_id: Optional[int] = None,
     event_name: Optional[str] = None,
     event_location: Optional[str] = None,
@@ -130,48 +242,77 @@ async def search_event(
     start_time: Optional[int] = None,
     end_time: Optional[int] = None,
     limit: Optional[int] = None,
+    offset: int = 0,
+    page_size: int = config.SEARCH_PAGE_SIZE,
 ):
     if categories:
         categories: list[str] = categories.split(",")
-    results = router.database.search_event(
-        event_id=event_id,
-        event_name=event_name,
-        event_location=event_location,
-        categories=categories,
-        start_time=start_time,
-        end_time=end_time,
-        limit=limit,
+    # keep the response bounded however large the catalogue grows
+    page_size = max(1, min(page_size, config.SEARCH_MAX_PAGE_SIZE))
+    offset = max(0, offset)
+    query = sorted(request.query_params.multi_items())
+
+    # results only change with the catalogue, so an unchanged one needs no query
+    version = router.database.database.version_stamp("catalogue")
+    if version is not None:
+        tag = resource_etag("search", query, version)
+        if if_none_match(request, tag):
+            return not_modified(tag, config.HTTP_MAX_AGE)
+
+    def lookup(database):
+        # the version is read from the database first, in the same transaction, so the results
+        # are at least as new as it
+        version = database.catalogue_version(cached=False)
+        results = database.search_event(
+            event_id=event_id,
+            event_name=event_name,
+            event_location=event_location,
+            categories=categories,
+            start_time=start_time,
+            end_time=end_time,
+            limit=limit,
+            offset=offset,
+            page_size=page_size,
+        )
+        return version, results
+
+    version, results = await router.database.unit_of_work(lookup)
+    return format_response(
+        status_code=200,
+        data=results,
+        request=request,
+        etag=resource_etag("search", query, version),
+        max_age=config.HTTP_MAX_AGE,
     )
-    return format_response(status_code=200, data=results)
 
 
 @router.get("/leaderboard")
-async def get_leaderboard(limit: Optional[int] = 10):
+async def get_leaderboard(request: Request, limit: Optional[int] = 10):
     try:
-        leaderboard = router.database.get_leaderboard(limit=limit)
-        return format_response(status_code=200, data=leaderboard)
-    except Exception as e:
-        return format_response(status_code=500, data={"error": type(e).__name__, "message": str(e)})
-
-
-async def process_payment(user_id: int, amount: float) -> Optional[str]:
-    try:
-        order = router.razorpay_client.order.create(
-            {
-                "amount": int(amount * 100),  # Amount in paise
-                "currency": "INR",
-                "receipt": f"event_{user_id}_{datetime.now().timestamp()}",
-                "payment": {"capture": "automatic"},
-            }
+        version = router.database.database.version_stamp("leaderboard")
+        if version is not None:
+            tag = resource_etag("leaderboard", limit, version)
+            if if_none_match(request, tag):
+                return not_modified(tag, config.HTTP_MAX_AGE)
+
+        def lookup(database):
+            # as for search, the version first and a board at least as new as it
+            version = database.leaderboard_version(cached=False)
+            return version, database.get_leaderboard(limit=limit, version=version)
+
+        version, leaderboard = await router.database.unit_of_work(lookup)
+        return format_response(
+            status_code=200,
+            data=leaderboard,
+            request=request,
+            etag=resource_etag("leaderboard", limit, version),
+            max_age=config.HTTP_MAX_AGE,
         )
-        order_id = order["id"]
-        print(f"Razorpay order created with ID: {order_id}")
-        return order_id
     except Exception as e:
-        print(f"Payment processing failed: {e}")
-        return None
+        return format_response(status_code=500, data={"error": type(e).__name__, "message": str(e)})
 
 
 def setup(app):
     app.include_router(router, prefix=prefix)
     router.database = app.database
+    router.payments = app.payments
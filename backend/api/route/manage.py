@@ -3,17 +3,17 @@ import re
 from enum import IntEnum
 from typing import List, Optional
 
-import razorpay
-from fastapi import APIRouter
-from pydantic import BaseModel
+from fastapi import APIRouter, Request, UploadFile
+from pydantic import BaseModel, ValidationError
 
-from api.service import response
+from api.service import bulk, pagination, response
 
 router = APIRouter()
 
 # we'll populate these fields when the main app registers this router
 router.database = None
-router.razorpay_client = None
+router.payments = None
+router.expiry_scheduler = None
 
 prefix = "/manage"
 
@@ -44,6 +44,24 @@ class Event(BaseModel):
     price: float
 
 
+def validate_event(event: Event):
+    if event.start_time <= datetime.datetime.now().timestamp():
+        raise ValueError("Start time is invalid")
+
+    if event.end_time - event.start_time > 12 * 60 * 60:
+        raise ValueError("Event duration is too long")
+
+    if event.limit <= 0:
+        raise ValueError("Limit must be greater than 0")
+
+    if len(event.categories) > 50:
+        raise ValueError("Too many categories")
+
+    for category in event.categories:
+        if black_username_regex.findall(category):
+            raise ValueError(f"Category `{category}` contains invalid characters")
+
+
 class RatingUpdate(BaseModel):
     event_id: int
     rating: int
@@ -52,27 +70,23 @@ class RatingUpdate(BaseModel):
 @router.post("/create-user")
 async def create_user(user: User):
     try:
-        current_users = router.database.get_usernames()
-        if user.username in current_users:
-            raise ValueError("Username already exists")
+        # add_user rejects taken usernames with an indexed lookup
         if black_username_regex.findall(user.username):
             raise ValueError("Username contains invalid characters")
 
         if user.type == UserType.club and not user.upi_id:
             raise ValueError("UPI ID must be provided for club accounts")
 
-        # todo: validate UPI ID using razorpay
         if user.type == UserType.club:
             try:
-                account = router.razorpay_client.payment.validateVpa({"vpa": user.upi_id})
-                if not account:
+                if not await router.payments.validate_vpa(user.upi_id):
                     raise ValueError("Invalid UPI ID")
             except Exception as e:
                 raise ValueError(f"Failed to validate UPI ID: {e}")
-            userid = router.database.add_user(user.username, user.type.value, user.interests)
-            router.database.add_club(user.id, user.username, upi_id=user.upi_id)
+            userid = await router.database.add_user(user.username, user.type.value, user.interests)
+            await router.database.add_club(userid, user.username, upi_id=user.upi_id)
         else:
-            userid = router.database.add_user(user.username, user.type.value, user.interests)
+            userid = await router.database.add_user(user.username, user.type.value, user.interests)
 
         # return the userid
         return response.format_response(200, userid)
@@ -86,7 +100,7 @@ async def get_user(user_id: Optional[int] = None, username: Optional[str] = None
         if not (user_id or username):
             raise KeyError("User ID or username required")
 
-        user = router.database.get_user(user_id=user_id, username=username)
+        user = await router.database.get_user(user_id=user_id, username=username)
         if not user:
             raise ValueError(f"User not found: {f'id= {user_id}' if user_id else f'username={username}'}")
 
@@ -102,38 +116,26 @@ async def get_user(user_id: Optional[int] = None, username: Optional[str] = None
 
 
 @router.get("/all-user-ids")
-async def all_users():
+async def all_users(
+    request: Request, format: str = "json", cursor: Optional[str] = None, limit: Optional[int] = None
+):
     try:
-        users = router.database.get_user_ids()
-        return response.format_response(status_code=200, data=users)
+        return await pagination.list_response(
+            request, router.database, "iter_user_ids", ["user_id"], format=format, cursor=cursor, limit=limit
+        )
     except Exception as e:
-        return response.format_response(status_code=500, data={"error": str(type(e).__name__), "message": str(e)})
+        status = 400 if isinstance(e, ValueError) else 500
+        return response.format_response(status_code=status, data={"error": str(type(e).__name__), "message": str(e)})
 
 
 @router.post("/add-event")
 async def add_event(event: Event):
     try:
-        events = router.database.search_event()
-        event_names = [event["event_name"] for event in events]
-        if event.event_name in event_names:
+        if await router.database.get_event(event_name=event.event_name):
             raise ValueError("Event name already exists")
-        if event.start_time <= datetime.datetime.now().timestamp():
-            raise ValueError("Start time is invalid")
-
-        if event.end_time - event.start_time > 12 * 60 * 60:
-            raise ValueError("Event duration is too long")
+        validate_event(event)
 
-        if event.limit <= 0:
-            raise ValueError("Limit must be greater than 0")
-
-        if len(event.categories) > 50:
-            raise ValueError("Too many categories")
-
-        for category in event.categories:
-            if black_username_regex.findall(category):
-                raise ValueError(f"Category `{category}` contains invalid characters")
-
-        event_id = router.database.add_event(
+        event_id = await router.database.add_event(
             event_name=event.event_name,
             event_location=event.event_location,
             categories=event.categories,
@@ -151,26 +153,75 @@ async def add_event(event: Event):
         return response.format_response(status_code=status, data={"error": str(type(e).__name__), "message": str(e)})
 
 
+@router.post("/add-events-bulk")
+async def add_events_bulk(file: UploadFile):
+    """
+    Import a whole schedule from a CSV (with a header row) or JSON lines upload.
+
+    Every row is validated before anything is written, and the import is all or nothing.
+    """
+    try:
+        rows = await bulk.read_rows(file)
+        if not rows:
+            raise ValueError("No events in upload")
+
+        events = []
+        errors = []
+        names = set()
+        for number, row in enumerate(rows):
+            try:
+                if isinstance(row, dict) and isinstance(row.get("categories"), str):
+                    row["categories"] = [category for category in row["categories"].split(",") if category]
+                # rejects rows that are not objects too
+                event = Event.model_validate(row)
+                validate_event(event)
+                if event.event_name in names:
+                    raise ValueError("Event name is repeated in the upload")
+                names.add(event.event_name)
+                events.append(event.model_dump())
+            except (ValueError, ValidationError, TypeError) as e:
+                errors.append({"row": number, "message": str(e)})
+
+        if not errors:
+            # a single set-based lookup for names that are already taken
+            taken = await router.database.get_existing_event_names(list(names))
+            errors = [
+                {"row": number, "message": "Event name already exists"}
+                for number, event in enumerate(events)
+                if event["event_name"] in taken
+            ]
+        if errors:
+            return response.format_response(
+                status_code=400, data={"error": "ValueError", "message": "Invalid events in upload", "rows": errors}
+            )
+
+        event_ids = await router.database.add_events_bulk(events)
+        return response.format_response(200, event_ids)
+    except Exception as e:
+        status = 500
+        if isinstance(e, ValueError):
+            status = 400
+        return response.format_response(status_code=status, data={"error": str(type(e).__name__), "message": str(e)})
+
+
 @router.put("/update-club-upi/{club_id}")
 async def update_club_upi(club_id: int, upi_id: str):
     try:
         # Verify that the user is a club
-        user = router.database.get_user(user_id=club_id)
+        user = await router.database.get_user(user_id=club_id)
         if not user:
             raise ValueError("Club not found")
         if user["user_type"] != UserType.club:
             raise ValueError("User is not a club")
 
-        # todo: use razorpay to validate UPI ID
         try:
-            account = router.razorplay_client.payment.validateVpa({"vpa": upi_id})
-            if not account:
+            if not await router.payments.validate_vpa(upi_id):
                 raise ValueError("Invalid UPI ID")
         except Exception as e:
             raise ValueError(f"Failed to validate UPI ID: {e}")
 
         # Update the UPI ID
-        router.database.update_club_upi(club_id=club_id, upi_id=upi_id)
+        await router.database.update_club_upi(club_id=club_id, upi_id=upi_id)
         return response.format_response(200, {"message": "Club UPI updated successfully"})
     except Exception as e:
         return response.format_response(status_code=400, data={"error": str(type(e).__name__), "message": str(e)})
@@ -181,12 +232,38 @@ async def update_event_rating(rating_update: RatingUpdate):
     try:
         if not 1 <= rating_update.rating <= 5:  # Manual validation
             raise ValueError("Rating must be between 1 and 5")
-        router.database.update_event_rating(rating_update.event_id, rating_update.rating)
+        await router.database.update_event_rating(rating_update.event_id, rating_update.rating)
         return response.format_response(200, {"message": "Event rating updated successfully"})
     except Exception as e:
         return response.format_response(status_code=400, data={"error": str(type(e).__name__), "message": str(e)})
 
 
+@router.get("/cache-stats")
+async def cache_stats():
+    try:
+        return response.format_response(200, await router.database.cache_stats())
+    except Exception as e:
+        return response.format_response(status_code=500, data={"error": str(type(e).__name__), "message": str(e)})
+
+
+@router.get("/payment-stats")
+async def payment_stats():
+    try:
+        return response.format_response(200, {**router.payments.metrics, "breaker": router.payments.breaker.state})
+    except Exception as e:
+        return response.format_response(status_code=500, data={"error": str(type(e).__name__), "message": str(e)})
+
+
+@router.get("/scheduler-stats")
+async def scheduler_stats():
+    try:
+        return response.format_response(200, router.expiry_scheduler.metrics)
+    except Exception as e:
+        return response.format_response(status_code=500, data={"error": str(type(e).__name__), "message": str(e)})
+
+
 def setup(app):
     app.include_router(router, prefix=prefix)
     router.database = app.database
+    router.expiry_scheduler = app.expiry_scheduler
+    router.payments = app.payments
@@ -0,0 +1,59 @@
+from fastapi import APIRouter, Request
+
+from api.service import payments, reconciliation
+from api.service.response import format_response
+
+router = APIRouter()
+
+# we'll populate these fields when the main app registers this router
+router.capture_writer = None
+router.reconciler = None
+
+prefix = "/payments"
+
+
+def _reply(status_code: int, data):
+    # razorpay goes by the HTTP status, and redelivers webhooks that did not get a 2xx
+    response = format_response(status_code=status_code, data=data)
+    response.status_code = status_code
+    return response
+
+
+@router.post("/webhook")
+async def payment_webhook(request: Request):
+    """
+    Razorpay's webhook. Captures are stored as they are, and matched to registrations in the background.
+    """
+    body = await request.body()
+    if not payments.verify_webhook_signature(body, request.headers.get("x-razorpay-signature")):
+        return _reply(400, {"error": "InvalidSignature", "message": "Webhook signature does not match"})
+    try:
+        capture = payments.parse_capture(body)
+    except (ValueError, KeyError, TypeError) as e:
+        return _reply(400, {"error": type(e).__name__, "message": str(e)})
+    if capture is None:
+        return _reply(200, {"stored": False})
+
+    try:
+        await router.capture_writer.add(capture)
+    except Exception as e:
+        return _reply(503, {"error": type(e).__name__, "message": str(e)})
+    return _reply(200, {"stored": True})
+
+
+@router.get("/reconciliation-stats")
+async def reconciliation_stats():
+    try:
+        return format_response(200, {"captures": router.capture_writer.metrics, "reconciliation": router.reconciler.metrics})
+    except Exception as e:
+        return format_response(status_code=500, data={"error": type(e).__name__, "message": str(e)})
+
+
+def setup(app):
+    app.include_router(router, prefix=prefix)
+    router.reconciler = reconciliation.PaymentReconciler(
+        app.database, coordination=app.coordination, payments=app.payments
+    )
+    router.capture_writer = reconciliation.CaptureWriter(app.database, on_flush=router.reconciler.notify)
+    # stopped in reverse, so the writer stores what it holds after reconciliation stops
+    app.background.extend([router.capture_writer, router.reconciler])
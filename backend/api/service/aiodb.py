@@ -0,0 +1,53 @@
+import asyncio
+import functools
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from api.service.db import Database
+
+
+class AsyncDatabase:
+    """
+    Awaitable facade over Database for the async route handlers.
+
+    In "thread" mode every call runs on a bounded thread pool, so a SQLite query never blocks
+    the event loop. In "inline" mode calls run directly on the loop, as they used to.
+    """
+
+    def __init__(self, database: Database, mode: str = "thread", workers: int = 10):
+        if mode not in ("thread", "inline"):
+            raise ValueError(f"Unknown database mode: {mode}")
+        self.database = database
+        self.mode = mode
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="database") if mode == "thread" else None
+
+    async def _run(self, fn: Callable, *args, **kwargs):
+        def call():
+            with self.database.transaction():
+                return fn(*args, **kwargs)
+
+        if self._executor is None:
+            return call()
+        return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+    async def unit_of_work(self, fn: Callable[[Database], Any]):
+        """Call `fn(database)` in one session and transaction, so several lookups share them."""
+        return await self._run(fn, self.database)
+
+    def __getattr__(self, name):
+        attr = getattr(self.database, name)
+        # generators stream from their own connection, and are iterated off the loop by the caller
+        if not callable(attr) or inspect.isgeneratorfunction(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            return await self._run(attr, *args, **kwargs)
+
+        return method
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        self.database.close()
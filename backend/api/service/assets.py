@@ -1,5 +1,73 @@
 import secrets
+import threading
+import time
+from typing import Optional
+
+# ids are laid out as | 39 bits of milliseconds since EPOCH_MS | 6 bits of node id | 8 bits of sequence |
+# 53 bits in total, so they survive being parsed as a javascript number by the frontend
+EPOCH_MS = 1735689600000  # 2025-01-01T00:00:00Z
+NODE_BITS = 6
+SEQUENCE_BITS = 8
+MAX_NODES = 1 << NODE_BITS
+
+
+class IdGenerator:
+    """
+    Snowflake-style id generator: time ordered, O(1) per id and unique without a lookup.
+
+    Every process needs its own node id, which the database leases out (see Database.claim_node_id).
+    Up to 256 ids are issued per millisecond per node before waiting for the next millisecond.
+    A leased node id is only used until its lease runs out: past `valid_until`, another process may
+    hold it, so no ids are issued until the lease is renewed.
+    """
+
+    def __init__(self, node_id: int = 0):
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+        self.node_id = node_id
+        # the unix time the node id's lease runs out at, or None for a node id that is not leased
+        self.valid_until = None
+
+    def lease(self, node_id: int, valid_until: Optional[float]):
+        """Generate with `node_id` until `valid_until`, or for good if it is None."""
+        with self._lock:
+            self.node_id = node_id
+            self.valid_until = valid_until
+
+    @property
+    def node_id(self) -> int:
+        return self._node_id
+
+    @node_id.setter
+    def node_id(self, node_id: int):
+        if not 0 <= node_id < MAX_NODES:
+            raise ValueError(f"Node id must be between 0 and {MAX_NODES - 1}")
+        self._node_id = node_id
+
+    def next_id(self) -> int:
+        with self._lock:
+            if self.valid_until is not None and time.time() >= self.valid_until:
+                raise RuntimeError("The id node lease has run out without being renewed")
+            now = int(time.time() * 1000) - EPOCH_MS
+            # never go back in time, even if the clock does
+            now = max(now, self._last_ms)
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & ((1 << SEQUENCE_BITS) - 1)
+                if self._sequence == 0:
+                    # this millisecond is used up
+                    while now <= self._last_ms:
+                        time.sleep(0.0001)
+                        now = int(time.time() * 1000) - EPOCH_MS
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return (now << (NODE_BITS + SEQUENCE_BITS)) | (self._node_id << SEQUENCE_BITS) | self._sequence
+
+
+# until a node id is leased, draw one at random
+generator = IdGenerator(secrets.randbelow(MAX_NODES))
 
 
 def unique_id():
-    return secrets.randbits(32)
+    return generator.next_id()
@@ -0,0 +1,45 @@
+import csv
+import io
+import json
+from typing import List
+
+from fastapi import UploadFile
+
+
+def parse_rows(data: bytes, filename: str = "", content_type: str = "") -> List[dict]:
+    """
+    Parse an uploaded CSV file (with a header row), JSON array or JSON lines file into a list of rows.
+
+    JSON rows are returned as they are, so callers must validate that each is an object.
+    """
+    text = data.decode("utf-8-sig")
+    if filename.endswith(".csv") or "csv" in (content_type or ""):
+        return [dict(row) for row in csv.DictReader(io.StringIO(text))]
+
+    if text.lstrip().startswith("["):
+        try:
+            rows = json.loads(text)
+        except json.JSONDecodeError:
+            rows = None  # a JSON lines file whose first row is an array
+        if isinstance(rows, list):
+            return rows
+
+    rows = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            rows.append(json.loads(line))
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Line {number} is not valid JSON: {e}")
+    return rows
+
+
+async def read_rows(file: UploadFile) -> List[dict]:
+    return parse_rows(await file.read(), filename=file.filename or "", content_type=file.content_type or "")
+
+
+def chunks(values: list, size: int = 500):
+    # keeps IN (...) lists under the database's bound parameter limit
+    for start in range(0, len(values), size):
+        yield values[start : start + size]
@@ -0,0 +1,244 @@
+import asyncio
+import json
+import os
+import secrets
+import socket
+import time
+from typing import Callable, Dict, List, Tuple
+
+import sqlalchemy as db
+from sqlalchemy import Column, Table, create_engine
+from sqlalchemy.dialects import sqlite
+
+from api.service import config
+
+
+class Coordination:
+    """
+    State shared by the worker processes of one deployment.
+
+    Messages published by a worker are delivered to every other worker (never back to itself),
+    and leases let a single worker own a background job, such as the pending expiry sweep.
+    """
+
+    def __init__(self):
+        # unique per process, so a worker can skip its own messages and recognise its own leases
+        self.origin = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+
+    def publish(self, channel: str, message):
+        raise NotImplementedError
+
+    def poll(self) -> List[Tuple[str, object]]:
+        """The (channel, message) pairs published by other workers since the last poll."""
+        raise NotImplementedError
+
+    def acquire_lease(self, name: str, ttl: float) -> bool:
+        """Take or renew the lease `name` for `ttl` seconds, returning whether we hold it."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class LocalCoordination(Coordination):
+    """A single worker: nobody to tell, and every lease is ours."""
+
+    def publish(self, channel: str, message):
+        pass
+
+    def poll(self) -> List[Tuple[str, object]]:
+        return []
+
+    def acquire_lease(self, name: str, ttl: float) -> bool:
+        return True
+
+
+class SQLiteCoordination(Coordination):
+    """
+    Coordination through a SQLite file next to the database, for workers on one machine.
+
+    Messages are appended to a log which every worker polls from the last sequence number it saw.
+    Entries older than `retention` seconds are pruned by the publishers.
+    """
+
+    def __init__(self, url: str = "sqlite:///coordination.db", retention: float = 300):
+        super().__init__()
+        self.retention = retention
+        self.engine = create_engine(url, connect_args={"check_same_thread": False, "timeout": config.DB_BUSY_TIMEOUT})
+        db.event.listen(self.engine, "connect", self._tune_connection)
+        self.meta = db.MetaData()
+
+        self._messages = Table(
+            "messages",
+            self.meta,
+            Column("seq", db.Integer, primary_key=True, autoincrement=True),
+            Column("origin", db.String, nullable=False),
+            Column("channel", db.String, nullable=False),
+            Column("payload", db.String, nullable=False),
+            Column("created_at", db.Float, nullable=False, index=True),
+        )
+
+        self._leases = Table(
+            "leases",
+            self.meta,
+            Column("name", db.String, primary_key=True),
+            Column("owner", db.String, nullable=False),
+            Column("expires_at", db.Float, nullable=False),
+        )
+
+        self.meta.create_all(self.engine)
+
+        # only messages published after we started are of interest
+        with self.engine.connect() as connection:
+            self._last_seq = connection.execute(db.select(db.func.max(self._messages.c.seq))).scalar() or 0
+        self._published = 0
+
+    @staticmethod
+    def _tune_connection(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+    def publish(self, channel: str, message):
+        now = time.time()
+        with self.engine.begin() as connection:
+            connection.execute(
+                self._messages.insert().values(
+                    origin=self.origin, channel=channel, payload=json.dumps(message), created_at=now
+                )
+            )
+            self._published += 1
+            if self._published % 100 == 0:
+                connection.execute(self._messages.delete().where(self._messages.c.created_at < now - self.retention))
+
+    def poll(self) -> List[Tuple[str, object]]:
+        with self.engine.connect() as connection:
+            command = (
+                db.select(self._messages.c.seq, self._messages.c.origin, self._messages.c.channel, self._messages.c.payload)
+                .where(self._messages.c.seq > self._last_seq)
+                .order_by(self._messages.c.seq)
+            )
+            rows = connection.execute(command).fetchall()
+        if rows:
+            self._last_seq = rows[-1].seq
+        return [(row.channel, json.loads(row.payload)) for row in rows if row.origin != self.origin]
+
+    def acquire_lease(self, name: str, ttl: float) -> bool:
+        now = time.time()
+        leases = self._leases.c
+        # take the lease if it is free, ours already or expired, in one statement
+        command = sqlite.insert(self._leases).values(name=name, owner=self.origin, expires_at=now + ttl)
+        command = command.on_conflict_do_update(
+            index_elements=[leases.name],
+            set_={"owner": self.origin, "expires_at": now + ttl},
+            where=db.or_(leases.owner == self.origin, leases.expires_at < now),
+        )
+        with self.engine.begin() as connection:
+            return connection.execute(command).rowcount == 1
+
+    def close(self):
+        self.engine.dispose()
+
+
+class RedisCoordination(Coordination):
+    """
+    Coordination through Redis pub/sub, for workers spread over several machines.
+
+    `client` is a redis-py client, or anything with the same publish, pubsub, set, get and pexpire methods.
+    """
+
+    def __init__(self, client, prefix: str = "ems"):
+        super().__init__()
+        self.client = client
+        self.prefix = prefix
+        self._pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(f"{prefix}:messages")
+
+    def publish(self, channel: str, message):
+        payload = {"origin": self.origin, "channel": channel, "message": message}
+        self.client.publish(f"{self.prefix}:messages", json.dumps(payload))
+
+    def poll(self) -> List[Tuple[str, object]]:
+        messages = []
+        while True:
+            received = self._pubsub.get_message(timeout=0)
+            if received is None:
+                break
+            if received.get("type") != "message":
+                continue
+            payload = json.loads(received["data"])
+            if payload["origin"] != self.origin:
+                messages.append((payload["channel"], payload["message"]))
+        return messages
+
+    def acquire_lease(self, name: str, ttl: float) -> bool:
+        key = f"{self.prefix}:lease:{name}"
+        if self.client.set(key, self.origin, nx=True, px=int(ttl * 1000)):
+            return True
+        owner = self.client.get(key)
+        if isinstance(owner, bytes):
+            owner = owner.decode()
+        if owner == self.origin:
+            self.client.pexpire(key, int(ttl * 1000))
+            return True
+        return False
+
+    def close(self):
+        self._pubsub.close()
+
+
+def from_url(url: str) -> Coordination:
+    if url in ("", "local"):
+        return LocalCoordination()
+    if url.startswith("sqlite://"):
+        return SQLiteCoordination(url)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("COORDINATION_URL points at redis, but the redis package is not installed") from e
+        return RedisCoordination(redis.Redis.from_url(url))
+    raise ValueError(f"Unknown coordination backend: {url}")
+
+
+class CoordinationListener:
+    """Background task that polls the coordination backend and hands messages to the subscribers of their channel."""
+
+    def __init__(self, coordination: Coordination, interval: float = config.COORDINATION_POLL_INTERVAL):
+        self.coordination = coordination
+        self.interval = interval
+        self.handlers: Dict[str, List[Callable]] = {}
+        self._task = None
+
+    def subscribe(self, channel: str, handler: Callable):
+        self.handlers.setdefault(channel, []).append(handler)
+
+    def poll_once(self) -> int:
+        messages = self.coordination.poll()
+        for channel, message in messages:
+            for handler in self.handlers.get(channel, []):
+                handler(message)
+        return len(messages)
+
+    async def _loop(self):
+        while True:
+            try:
+                # handlers may query the database, so keep them off the event loop
+                await asyncio.to_thread(self.poll_once)
+            except Exception as e:
+                print(f"Coordination poll failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
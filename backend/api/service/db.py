@@ -1,35 +1,85 @@
 import datetime
+import logging
+import os
+import random
+import re
+import socket
+import threading
 import time
-from typing import List, Optional
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, List, Optional, Tuple
 
 import sqlalchemy as db
 from sqlalchemy import Column, ForeignKey, Table, create_engine, func
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import Session
 
+from api.service import config
+from api.service import assets
+from api.service import migrations
 from api.service.assets import unique_id
+from api.service.bulk import chunks
+from api.service.cache import LRUCache
+from api.service.coordination import Coordination, LocalCoordination
+from api.service.schedule import Schedule
+from api.service.waiting import EventWaitingList
+
+logger = logging.getLogger(__name__)
+
+# registration states, and the states each one may move to
+REGISTRATION_TRANSITIONS = {
+    # a waiter offered a seat of a paid event holds it unpaid, like a new registration for it
+    "waiting": ("pending", "unpaid", "cancelled"),
+    "pending": ("confirmed", "expired", "cancelled"),
+    # a paid registration holds its seat until the payment is captured, or the hold expires
+    "unpaid": ("confirmed", "expired", "cancelled"),
+    "confirmed": ("cancelled",),
+    "expired": (),
+    "cancelled": (),
+}
+# the states that count as being registered, and those that hold one of the event's seats
+LIVE_STATUSES = ("waiting", "pending", "unpaid", "confirmed")
+SEAT_STATUSES = ("pending", "unpaid", "confirmed")
+REGISTRATION_FIELDS = ("registration_id", "user_id", "event_name", "event_id", "status", "registration_timestamp")
+# ingest jobs move through these in order, or end up failed; the middle two are a worker's
+INGEST_STATUSES = ("queued", "fetching", "extracting", "done", "failed")
+INGEST_FIELDS = ("job_id", "username", "club_id", "status", "attempts", "created_at", "updated_at", "draft", "error")
+LIVE_CONDITION = db.text("status IN ('waiting', 'pending', 'unpaid', 'confirmed')")
+# what reconciling a captured payment did: confirmed its registration, found it confirmed already,
+# found its hold expired or cancelled, which needs a refund, or found nothing it pays for in full,
+# which needs a refund or a look by hand
+RECONCILE_OUTCOMES = ("confirmed", "duplicate", "refund", "underpaid", "unmatched")
+
+# generated ids are 53 bits wide; sqlite integers are 64 bit already, and an INTEGER
+# primary key keeps being the rowid there
+Id = db.BigInteger().with_variant(db.Integer(), "sqlite")
 
 
 class Database:
-    _instance = None
-
-    def __new__(cls, *args, **kwargs):
-        # we make this a singleton class
-        # we don't want two instances of the database class
-        if Database._instance is None:
-            Database._instance = object.__new__(cls)
-            Database._instance.__init__(*args, **kwargs)
-        return Database._instance
-
-    def __init__(self, dbfile: str = "database.db"):
+    def __init__(self, url: str = config.DATABASE_URL, coordination: Optional[Coordination] = None):
         # here we create the database, and the tables used.
-        self.engine = create_engine(f"sqlite:///{dbfile}")
-        self.engine.connect()
+        # `url` is a database url, or the path of a sqlite file.
+        # every worker process has its own instance; they tell each other about their writes
+        # through `coordination`, so their caches and waitlist mirrors stay in step
+        self.coordination = coordination or LocalCoordination()
+        if "://" not in url:
+            url = f"sqlite:///{url}"
+        self.engine = self._create_engine(url)
+        self.is_sqlite = self.engine.dialect.name == "sqlite"
         self.meta = db.MetaData()
 
+        # the session of the unit of work running in the current context
+        self._session = ContextVar(f"session_{id(self)}", default=None)
+        # set by close, to stop renewing the id node lease
+        self._closed = threading.Event()
+        self._lease_renewal = None
+
         self._events = Table(
             "events",
             self.meta,
-            Column("event_id", db.Integer, unique=True, nullable=False, primary_key=True),
+            Column("event_id", Id, unique=True, nullable=False, primary_key=True),
             Column("event_name", db.String, unique=True, nullable=False),
             Column("event_location", db.String),
             Column("categories", db.String),
@@ -39,13 +89,34 @@ class Database:
             Column("price", db.Float),
             Column("on_duty", db.Boolean, default=False),
             Column("rating", db.Float),
-            Column("club_id", db.Integer, ForeignKey("clubs.club_id")),
+            Column("club_id", Id, ForeignKey("clubs.club_id")),
+            # confirmed and pending registrations, maintained in the registration transactions
+            Column("seats_taken", db.Integer, nullable=False, default=0, server_default="0"),
+            # running totals behind `rating`, the mean of every rating the event received
+            Column("rating_sum", db.Float, nullable=False, default=0, server_default="0"),
+            Column("rating_count", db.Integer, nullable=False, default=0, server_default="0"),
+            # bumped by every write to the row, and served as the event's ETag
+            Column("version", db.Integer, nullable=False, default=1, server_default="1"),
+            db.Index("ix_events_start_time", "start_time"),
+            db.Index("ix_events_end_time", "end_time"),
+            db.Index("ix_events_event_location", "event_location"),
+            db.Index("ix_events_club_id", "club_id"),
+        )
+
+        # one row per (event, category), so category filters are index lookups
+        # instead of LIKE scans over the comma-joined `categories` column
+        self._event_categories = Table(
+            "event_categories",
+            self.meta,
+            Column("event_id", Id, ForeignKey("events.event_id"), primary_key=True),
+            Column("category", db.String, primary_key=True),
+            db.Index("ix_event_categories_category", "category", "event_id"),
         )
 
         self._users = Table(
             "users",
             self.meta,
-            Column("user_id", db.Integer, unique=True, nullable=False, primary_key=True),
+            Column("user_id", Id, unique=True, nullable=False, primary_key=True),
             Column("username", db.String, unique=True, nullable=False),
             Column("user_type", db.Integer),
             Column("interests", db.String),
@@ -55,7 +126,7 @@ class Database:
         self._venues = Table(
             "venues",
             self.meta,
-            Column("venue_id", db.Integer, unique=True, nullable=False, primary_key=True),
+            Column("venue_id", Id, unique=True, nullable=False, primary_key=True),
             Column("venue_name", db.String, unique=True, nullable=False),
             Column("capacity", db.Integer),
         )
@@ -63,49 +134,473 @@ class Database:
         self._clubs = Table(
             "clubs",
             self.meta,
-            Column("club_id", db.Integer, ForeignKey("users.user_id"), unique=True, nullable=False, primary_key=True),
+            Column("club_id", Id, ForeignKey("users.user_id"), unique=True, nullable=False, primary_key=True),
             Column("club_name", db.String, unique=True, nullable=False),
             Column("club_email", db.String),
             Column("upi_id", db.String),
         )
 
+        # per-club rating totals, updated with every event rating, so the leaderboard
+        # is the first rows of the average_rating index
+        self._club_ratings = Table(
+            "club_ratings",
+            self.meta,
+            Column("club_id", Id, ForeignKey("clubs.club_id"), primary_key=True),
+            Column("rating_sum", db.Float, nullable=False, default=0),
+            Column("rating_count", db.Integer, nullable=False, default=0),
+            Column("average_rating", db.Float, nullable=False, default=0),
+            db.Index("ix_club_ratings_average_rating", "average_rating"),
+        )
+
+        # every registration, in one of the REGISTRATION_TRANSITIONS states
         self._registrations = Table(
             "registrations",
             self.meta,
-            Column("registration_id", db.Integer, unique=True, nullable=False, primary_key=True),
-            Column("user_id", db.Integer, ForeignKey("users.user_id")),
+            Column("registration_id", Id, unique=True, nullable=False, primary_key=True),
+            Column("user_id", Id, ForeignKey("users.user_id")),
             Column("event_name", db.String),
-            Column("event_id", db.Integer, ForeignKey("events.event_id")),
+            Column("event_id", Id, ForeignKey("events.event_id")),
+            Column("status", db.String, nullable=False, default="confirmed", server_default="confirmed"),
+            # when it entered its status: the place in the queue while waiting, the offer time while pending,
+            # the hold time while unpaid
+            Column("registration_timestamp", db.Integer),
+            # a user holds one live registration per event, and may register again after cancelling
+            db.Index(
+                "ux_registrations_live_user_id_event_id",
+                "user_id",
+                "event_id",
+                unique=True,
+                sqlite_where=LIVE_CONDITION,
+                postgresql_where=LIVE_CONDITION,
+            ),
+            db.Index("ix_registrations_user_id", "user_id"),
+            # the head of an event's waitlist is the first entry of (event_id, "waiting")
+            db.Index("ix_registrations_event_id_status", "event_id", "status", "registration_timestamp"),
+            # the expiry sweep walks ("pending", oldest offer first)
+            db.Index("ix_registrations_status_timestamp", "status", "registration_timestamp"),
         )
 
-        self._waitlist = Table(
-            "waitlist",
+        # leases of the node ids that keep generated ids unique across processes
+        self._id_nodes = Table(
+            "id_nodes",
             self.meta,
-            Column("user_id", db.Integer, ForeignKey("users.user_id")),
-            Column("event_id", db.Integer, ForeignKey("events.event_id")),
-            Column("registration_timestamp", db.Integer),
-            Column("registration_id", db.Integer, unique=True, nullable=False, primary_key=True),
+            Column("node_id", db.Integer, primary_key=True, autoincrement=False),
+            Column("owner", db.String, nullable=False),
+            Column("expires_at", db.Integer, nullable=False),
         )
 
-        self._pendinglist = Table(
-            "pendinglist",
+        # posters being turned into draft events, claimed by the ingest workers of any process
+        self._ingest_jobs = Table(
+            "ingest_jobs",
             self.meta,
-            Column("user_id", db.Integer, ForeignKey("users.user_id")),
-            Column("event_id", db.Integer, ForeignKey("events.event_id")),
-            Column("registration_timestamp", db.Integer),
-            Column("registration_id", db.Integer, unique=True, nullable=False, primary_key=True),
+            Column("job_id", Id, primary_key=True, autoincrement=False),
+            Column("username", db.String, nullable=False),
+            Column("club_id", Id),
+            # see INGEST_STATUSES
+            Column("status", db.String, nullable=False, default="queued"),
+            Column("attempts", db.Integer, nullable=False, default=0),
+            Column("owner", db.String),
+            Column("created_at", db.Integer, nullable=False),
+            Column("updated_at", db.Integer, nullable=False),
+            Column("draft", db.JSON),
+            Column("error", db.String),
+            # the queue is read oldest first, and stalled jobs by when they last moved
+            db.Index("ix_ingest_jobs_status_updated_at", "status", "updated_at"),
+        )
+
+        # gateway orders by idempotency key, one per registration: a retried payment reuses its order,
+        # and registering again after a cancelled or expired hold gets a new one
+        self._payment_orders = Table(
+            "payment_orders",
+            self.meta,
+            Column("idempotency_key", db.String, primary_key=True),
+            Column("registration_id", Id),
+            Column("user_id", Id, nullable=False),
+            Column("event_id", Id, nullable=False),
+            Column("amount", db.Integer, nullable=False),  # in the currency's smallest unit
+            Column("currency", db.String, nullable=False),
+            Column("order_id", db.String, unique=True),
+            # "creating" while a worker asks the gateway, "created" once it has, "released" if it failed
+            Column("status", db.String, nullable=False),
+            Column("attempts", db.Integer, nullable=False, default=1),
+            Column("created_at", db.Integer, nullable=False),
+            Column("updated_at", db.Integer, nullable=False),
+            # the payment reconciler finds the seats offered to waiters that have no order yet
+            db.Index("ix_payment_orders_registration_id", "registration_id"),
+        )
+
+        # captured payments as the gateway reported them; rows are only ever added
+        self._payment_captures = Table(
+            "payment_captures",
+            self.meta,
+            Column("payment_id", db.String, primary_key=True),  # redeliveries of a webhook carry the same id
+            Column("order_id", db.String, nullable=False),
+            Column("amount", db.Integer, nullable=False),
+            Column("currency", db.String, nullable=False),
+            Column("received_at", db.Integer, nullable=False),
+            Column("payload", db.Text, nullable=False),
+            # reconciliation walks the captures oldest first
+            db.Index("ix_payment_captures_received_at", "received_at"),
+        )
+
+        # what reconciliation made of each capture, in one of the RECONCILE_OUTCOMES
+        self._payment_reconciliations = Table(
+            "payment_reconciliations",
+            self.meta,
+            Column("payment_id", db.String, primary_key=True),
+            Column("registration_id", Id),
+            Column("outcome", db.String, nullable=False),
+            Column("reconciled_at", db.Integer, nullable=False),
         )
 
-        self.meta.create_all(self.engine)
+        # the versions of the resources that span many rows, "catalogue" and "leaderboard": one counter
+        # each, added to in the same transaction as the writes that change them
+        self._versions = Table(
+            "versions",
+            self.meta,
+            Column("name", db.String, primary_key=True),
+            Column("version", db.Integer, nullable=False),
+        )
+
+        # new tables, columns and indexes are added to existing databases by the migrations
+        migrations.upgrade(self)
+        with self.engine.begin() as connection:
+            command = self._insert_ignoring_conflicts(self._versions, [self._versions.c.name])
+            connection.execute(command, [{"name": name, "version": 0} for name in ("catalogue", "leaderboard")])
+            # full-text search uses sqlite's fts5, other backends fall back to ILIKE
+            self._fts = self.is_sqlite and self._create_fts(connection)
+
+        if config.ID_NODE is not None:
+            assets.generator.lease(int(config.ID_NODE), None)
+        else:
+            self._node_owner = f"{socket.gethostname()}:{os.getpid()}:{id(self)}"
+            self.claim_node_id()
+            self._lease_renewal = threading.Thread(target=self._renew_node_lease, name="id-node-lease", daemon=True)
+            self._lease_renewal.start()
+
+        # read-through caches, invalidated by the write paths once they commit.
+        # names map to ids, so invalidating an id is enough when a row changes
+        self.event_map = LRUCache(maxsize=config.CACHE_SIZE, ttl=config.CACHE_TTL)
+        self.event_name_map = LRUCache(maxsize=config.CACHE_SIZE, ttl=config.CACHE_TTL)
+        self.user_map = LRUCache(maxsize=config.CACHE_SIZE, ttl=config.CACHE_TTL)
+        self.username_map = LRUCache(maxsize=config.CACHE_SIZE, ttl=config.CACHE_TTL)
+        self.registration_map = LRUCache(maxsize=config.CACHE_SIZE, ttl=config.CACHE_TTL)
+        self.leaderboard_map = LRUCache(maxsize=64, ttl=config.LEADERBOARD_TTL)
+        # version stamps of the resources that span many rows, "catalogue" and "leaderboard"
+        self.version_map = LRUCache(maxsize=16, ttl=config.CACHE_TTL)
+        self._caches = {
+            "events": self.event_map,
+            "event_names": self.event_name_map,
+            "users": self.user_map,
+            "usernames": self.username_map,
+            "registrations": self.registration_map,
+            "leaderboard": self.leaderboard_map,
+            "versions": self.version_map,
+        }
 
-        self.event_map = {}
-        self.user_map = {}
-        self.registration_map = {}
+        # per-event waitlist queues, mirrored from the waiting registrations
+        self.waiting_list = EventWaitingList()
+        self.waiting_list.load(self.get_waiting_list())
 
         self.populate_venues()
 
-    def populate_venues(self):
+    def _create_engine(self, url: str):
+        if url.startswith("sqlite"):
+            engine = create_engine(
+                url,
+                pool_size=config.DB_POOL_SIZE,
+                max_overflow=config.DB_MAX_OVERFLOW,
+                connect_args={
+                    "check_same_thread": False,
+                    "timeout": config.DB_BUSY_TIMEOUT,
+                    "cached_statements": config.DB_STATEMENT_CACHE_SIZE,
+                },
+            )
+            db.event.listen(engine, "connect", self._tune_connection)
+            return engine
+
+        # a server database: connections are pooled, and checked before use since the server may drop them
+        return create_engine(
+            url,
+            pool_size=config.DB_POOL_SIZE,
+            max_overflow=config.DB_MAX_OVERFLOW,
+            pool_timeout=config.DB_BUSY_TIMEOUT,
+            pool_recycle=config.DB_POOL_RECYCLE,
+            pool_pre_ping=True,
+        )
+
+    @staticmethod
+    def _tune_connection(dbapi_connection, connection_record):
+        # WAL lets readers run alongside the writer, and NORMAL only fsyncs on checkpoints
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run a unit of work in a single session and transaction.
+
+        Nested calls reuse the enclosing session, so a route can wrap several
+        database calls and pay for one connection checkout and one commit.
+        """
+        session = self._session.get()
+        if session is not None:
+            yield session
+            return
+
         with Session(self.engine) as session:
+            token = self._session.set(session)
+            try:
+                yield session
+                self._write_versions(session)
+                session.commit()
+            except BaseException:
+                session.rollback()
+                raise
+            finally:
+                self._session.reset(token)
+
+        changes = session.info.get("changes")
+        if changes:
+            self.apply_changes(changes)
+            try:
+                # one message per unit of work for the other workers
+                self.coordination.publish("changes", changes)
+            except Exception as e:
+                # their caches catch up when the entries expire
+                print(f"Could not publish changes: {e}")
+
+    @staticmethod
+    def _record(session, change: list):
+        # applied to this process's caches and mirrors once the unit of work has committed,
+        # and to the other workers' when they receive it
+        session.info.setdefault("changes", []).append(change)
+
+    def _invalidate(self, session, cache: str, key):
+        self._record(session, ["invalidate", cache, key])
+
+    def _bump_version(self, session, name: str):
+        # written once per unit of work, just before it commits
+        session.info.setdefault("versions", set()).add(name)
+        self._invalidate(session, "versions", name)
+
+    def _write_versions(self, session):
+        # the counters are the last rows a unit of work locks, in name order, so units of work
+        # waiting on each other's events never also wait on each other's counters
+        for name in sorted(session.info.get("versions", ())):
+            command = (
+                self._versions.update()
+                .where(self._versions.c.name == name)
+                .values(version=self._versions.c.version + 1)
+            )
+            session.execute(command)
+
+    def _event_changed(self, session, event_id: int):
+        # the event, and every search result it may appear in
+        self._invalidate(session, "events", event_id)
+        self._bump_version(session, "catalogue")
+
+    def _enqueue_waiting(self, session, event_id: int, registration_id: int, timestamp: int):
+        self._record(session, ["enqueue", event_id, registration_id, timestamp])
+
+    def _cancel_waiting(self, session, registration_id: int):
+        self._record(session, ["cancel", registration_id])
+
+    def apply_changes(self, changes: List[list]):
+        for change in changes:
+            if change[0] == "invalidate":
+                self._caches[change[1]].invalidate(change[2])
+            elif change[0] == "clear":
+                self._caches[change[1]].clear()
+            elif change[0] == "enqueue":
+                self.waiting_list.enqueue(*change[1:])
+            elif change[0] == "cancel":
+                self.waiting_list.cancel(change[1])
+
+    def _fill(self, cache: LRUCache, key, value, since: int):
+        # a unit of work that has written may still roll back, so only committed reads are cached
+        session = self._session.get()
+        if session is None or not session.info.get("changes"):
+            cache.set(key, value, since=since)
+
+    def cache_stats(self) -> dict:
+        return {name: cache.stats() for name, cache in self._caches.items()}
+
+    def version_stamp(self, resource: str, key=None) -> Optional[int]:
+        """
+        The version of an "event" (by id), the "catalogue" or the "leaderboard", if this process has it cached.
+
+        Never touches the database, so requests for unchanged resources can be answered from memory.
+        """
+        if resource == "event":
+            event = self.event_map.get(key)
+            return event["version"] if event else None
+        return self.version_map.get(resource)
+
+    def _read_version(self, name: str, cached: bool) -> int:
+        if cached:
+            version = self.version_map.get(name)
+            if version is not None:
+                return version
+        since = self.version_map.token()
+        with self.transaction() as session:
+            # a single primary key lookup
+            command = db.select(self._versions.c.version).where(self._versions.c.name == name)
+            version = session.execute(command).scalar()
+        self._fill(self.version_map, name, version, since)
+        return version
+
+    def catalogue_version(self, cached: bool = True) -> int:
+        """
+        The version of all events together, from this worker's cache unless `cached` is False.
+
+        Routes read it uncached before the resource it tags, so a write landing in between makes the
+        body newer than its tag, which only costs a client one extra full response.
+        """
+        # every unit of work that writes to events adds one, so it only ever grows and never repeats
+        return self._read_version("catalogue", cached)
+
+    def leaderboard_version(self, cached: bool = True) -> int:
+        # every rating adds one
+        return self._read_version("leaderboard", cached)
+
+    @staticmethod
+    def _create_fts(connection) -> bool:
+        # full-text index over event names and locations, kept in sync by triggers.
+        # the fts rowid is the event id, so lookups and deletes stay indexed
+        exists = connection.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'events_fts'"
+        ).first()
+        if not exists:
+            try:
+                connection.exec_driver_sql(
+                    "CREATE VIRTUAL TABLE events_fts USING fts5("
+                    "event_name, event_location, tokenize = 'unicode61 remove_diacritics 2')"
+                )
+            except db.exc.OperationalError:
+                # sqlite was built without fts5, search falls back to LIKE
+                return False
+            connection.exec_driver_sql(
+                "INSERT INTO events_fts (rowid, event_name, event_location) "
+                "SELECT event_id, event_name, event_location FROM events"
+            )
+
+        connection.exec_driver_sql(
+            "CREATE TRIGGER IF NOT EXISTS events_fts_insert AFTER INSERT ON events BEGIN "
+            "INSERT INTO events_fts (rowid, event_name, event_location) "
+            "VALUES (new.event_id, new.event_name, new.event_location); END"
+        )
+        connection.exec_driver_sql(
+            "CREATE TRIGGER IF NOT EXISTS events_fts_delete AFTER DELETE ON events BEGIN "
+            "DELETE FROM events_fts WHERE rowid = old.event_id; END"
+        )
+        connection.exec_driver_sql(
+            "CREATE TRIGGER IF NOT EXISTS events_fts_update AFTER UPDATE OF event_name, event_location ON events BEGIN "
+            "UPDATE events_fts SET event_name = new.event_name, event_location = new.event_location "
+            "WHERE rowid = old.event_id; END"
+        )
+        return True
+
+    @staticmethod
+    def _normalize_categories(categories: List[str]) -> List[str]:
+        # categories are matched case-insensitively, and each one is stored once per event
+        normalized = []
+        for category in categories:
+            category = category.strip().lower()
+            if category and category not in normalized:
+                normalized.append(category)
+        return normalized
+
+    @staticmethod
+    def _fts_query(text: str) -> Optional[str]:
+        # every word has to appear, as a prefix, in the event name or location
+        tokens = re.findall(r"\w+", text)
+        if not tokens:
+            return None
+        return " ".join(f'"{token}"*' for token in tokens)
+
+    def claim_node_id(self) -> int:
+        """Lease a node id that no other live process holds, and generate ids with it."""
+        # every lost race means another process took a node, so there are at most MAX_NODES of them
+        for _ in range(assets.MAX_NODES):
+            try:
+                node_id, expires_at = self._lease_free_node()
+            except db.exc.IntegrityError:
+                # a process starting alongside us inserted the same node id first
+                continue
+            # only once the lease has committed, so no two processes ever generate with one node id
+            assets.generator.lease(node_id, expires_at)
+            return node_id
+        raise RuntimeError(f"All {assets.MAX_NODES} id nodes are leased")
+
+    def _lease_free_node(self) -> Tuple[int, int]:
+        now = int(time.time())
+        expires_at = now + config.ID_NODE_LEASE
+        nodes = list(range(assets.MAX_NODES))
+        random.shuffle(nodes)
+        with self.transaction() as session:
+            leases = dict(session.execute(db.select(self._id_nodes.c.node_id, self._id_nodes.c.expires_at)).all())
+            for node_id in nodes:
+                if node_id not in leases:
+                    command = self._id_nodes.insert().values(
+                        node_id=node_id, owner=self._node_owner, expires_at=expires_at
+                    )
+                elif leases[node_id] < now:
+                    # the process holding it stopped renewing, so the lease is free again
+                    command = (
+                        self._id_nodes.update()
+                        .where(self._id_nodes.c.node_id == node_id)
+                        .where(self._id_nodes.c.expires_at < now)
+                        .values(owner=self._node_owner, expires_at=expires_at)
+                    )
+                else:
+                    continue
+                # psycopg reports no rowcount for an INSERT, so the written row is returned instead
+                if session.execute(command.returning(self._id_nodes.c.node_id)).first() is not None:
+                    return node_id, expires_at
+        raise RuntimeError(f"All {assets.MAX_NODES} id nodes are leased")
+
+    def _renew_node_lease(self):
+        # a lease is renewed a few times over its length, so a renewal or two may fail before it runs
+        # out; past that, the generator refuses ids until a renewal or a new lease gets through
+        while not self._closed.wait(config.ID_NODE_LEASE / 3):
+            try:
+                expires_at = int(time.time()) + config.ID_NODE_LEASE
+                with self.transaction() as session:
+                    command = (
+                        self._id_nodes.update()
+                        .where(self._id_nodes.c.node_id == assets.generator.node_id)
+                        .where(self._id_nodes.c.owner == self._node_owner)
+                        .values(expires_at=expires_at)
+                    )
+                    renewed = session.execute(command).rowcount == 1
+                if renewed:
+                    assets.generator.valid_until = expires_at
+                else:
+                    # another process took it over while we could not renew
+                    logger.warning("Id node %s was taken over, leasing another", assets.generator.node_id)
+                    self.claim_node_id()
+            except Exception:
+                logger.exception("Failed to renew the id node lease, it runs out at %s", assets.generator.valid_until)
+
+    def close(self):
+        """Stop renewing the id node lease and give it up, then close the connections."""
+        self._closed.set()
+        if self._lease_renewal is not None:
+            self._lease_renewal.join()
+            try:
+                with self.transaction() as session:
+                    command = self._id_nodes.delete().where(self._id_nodes.c.owner == self._node_owner)
+                    session.execute(command)
+            except Exception:
+                # it expires on its own
+                logger.exception("Failed to release the id node lease")
+        self.engine.dispose()
+
+    def populate_venues(self):
+        with self.transaction() as session:
             # Check if venues table is already populated
             if session.query(self._venues).count() == 0:
                 # Static venue data
@@ -126,18 +621,81 @@ class Database:
                     )
                     session.execute(insert_stmt)
 
-                session.commit()
+    def _take_seat(self, session, event_id: int) -> bool:
+        # a single conditional increment, so two concurrent registrations
+        # can never both take the last seat
+        command = (
+            self._events.update()
+            .where(self._events.c.event_id == event_id)
+            .where(self._events.c.seats_taken < self._events.c.limit)
+            .values(seats_taken=self._events.c.seats_taken + 1, version=self._events.c.version + 1)
+        )
+        self._event_changed(session, event_id)
+        return session.execute(command).rowcount == 1
+
+    def _take_seats(self, session, event_id: int, count: int) -> int:
+        """Take up to `count` seats of the event at once, returning how many were taken."""
+        while True:
+            command = db.select(self._events.c.seats_taken, self._events.c.limit).where(
+                self._events.c.event_id == event_id
+            )
+            seats_taken, limit = session.execute(command).one()
+            granted = max(0, min(count, (limit or 0) - seats_taken))
+            if not granted:
+                return 0
+            # only applies if nobody took a seat since we read the counter
+            command = (
+                self._events.update()
+                .where(self._events.c.event_id == event_id)
+                .where(self._events.c.seats_taken == seats_taken)
+                .values(seats_taken=seats_taken + granted, version=self._events.c.version + 1)
+            )
+            if session.execute(command).rowcount == 1:
+                self._event_changed(session, event_id)
+                return granted
+
+    def _release_seat(self, session, event_id: int):
+        command = (
+            self._events.update()
+            .where(self._events.c.event_id == event_id)
+            .where(self._events.c.seats_taken > 0)
+            .values(seats_taken=self._events.c.seats_taken - 1, version=self._events.c.version + 1)
+        )
+        self._event_changed(session, event_id)
+        session.execute(command)
 
     def get_user_ids(self):
-        with Session(self.engine) as session:
+        with self.transaction() as session:
             command = self._users.select()
             result = session.execute(command)
             res = result.fetchall()
         # return the first element of each tuple, which is the user id
         return {x[0] for x in res}
 
+    def _stream(self, command, key, after=None, limit: Optional[int] = None) -> Iterator:
+        """
+        Rows of `command` in `key` order, starting after the key `after`.
+
+        The rows come from a server-side cursor in batches of STREAM_BATCH_SIZE, on a connection of
+        their own, so a generator can be consumed outside of any unit of work.
+        """
+        command = command.order_by(key)
+        if after is not None:
+            command = command.where(key > after)
+        if limit is not None:
+            command = command.limit(limit)
+        with self.engine.connect() as connection:
+            result = connection.execution_options(stream_results=True, yield_per=config.STREAM_BATCH_SIZE).execute(
+                command
+            )
+            yield from result
+
+    def iter_user_ids(self, after: Optional[int] = None, limit: Optional[int] = None) -> Iterator[int]:
+        for row in self._stream(db.select(self._users.c.user_id), self._users.c.user_id, after, limit):
+            yield row.user_id
+
     def get_usernames(self):
-        with Session(self.engine) as session:
+        with self.transaction() as session:
             command = self._users.select()
             result = session.execute(command)
             res = result.fetchall()
@@ -145,27 +703,22 @@ class Database:
         return [x[1] for x in res]
 
     def add_user(self, username: str, user_type: int, interests: List[str]):
-        existing_user = self.get_user(username=username)
-        if existing_user:
-            raise ValueError("Username already exists")
-        str_interests = ",".join(interests)
-        user_ids = self.get_user_ids()
-
-        new_id = unique_id()
-
-        while new_id in user_ids:
+        with self.transaction() as session:
+            existing_user = self.get_user(username=username)
+            if existing_user:
+                raise ValueError("Username already exists")
+            str_interests = ",".join(interests)
             new_id = unique_id()
 
-        with Session(self.engine) as session:
             command = self._users.insert().values(
                 user_id=new_id, username=username, user_type=user_type, interests=str_interests, creation_time=db.func.now()
             )
             session.execute(command)
-            session.commit()
+            self._invalidate(session, "usernames", username)
         return new_id
 
     def add_club(self, club_id: int, club_name: str, club_email: str = None, upi_id: str = None):
-        with Session(self.engine) as session:
+        with self.transaction() as session:
             command = self._clubs.insert().values(
                 club_id=club_id,
                 club_name=club_name,
@@ -173,10 +726,19 @@ class Database:
                 upi_id=upi_id,
             )
             session.execute(command)
-            session.commit()
 
     def get_user(self, user_id: Optional[int] = None, username: Optional[str] = None):
-        with Session(self.engine) as session:
+        if username:
+            user_id = self.username_map.get(username)
+        if user_id:
+            cached = self.user_map.get(user_id)
+            if cached is not None:
+                return cached
+
+        # taken before reading, so a row read while a write commits is not cached after its invalidation
+        since = self.user_map.token(), self.username_map.token()
+
+        with self.transaction() as session:
             if username:
                 command = self._users.select().where(self._users.c.username == username)
             elif user_id:
@@ -193,11 +755,59 @@ class Database:
                 "user_type": res[2],
                 "interests": res[3].split(","),
             }
-            return ans
+
+        self._fill(self.user_map, ans["user_id"], ans, since[0])
+        self._fill(self.username_map, ans["username"], ans["user_id"], since[1])
+        return ans
+
+    @staticmethod
+    def _event_row(event) -> dict:
+        event = event._mapping
+        return {
+            "event_id": event["event_id"],
+            "event_name": event["event_name"],
+            "event_location": event["event_location"],
+            "categories": (event["categories"] or "").split(","),
+            "start_time": event["start_time"],
+            "end_time": event["end_time"],
+            "limit": event["limit"],
+            "price": event["price"],
+            "on_duty": event["on_duty"],
+            "rating": event["rating"],
+            "club_id": event["club_id"],
+            "seats_taken": event["seats_taken"],
+            "version": event["version"],
+        }
+
+    def get_event(self, event_id: Optional[int] = None, event_name: Optional[str] = None):
+        """Exact lookup of a single event by its id or name, using the primary key or unique index."""
+        if event_name:
+            event_id = self.event_name_map.get(event_name)
+        if event_id:
+            cached = self.event_map.get(event_id)
+            if cached is not None:
+                return cached
+
+        since = self.event_map.token(), self.event_name_map.token()
+        with self.transaction() as session:
+            if event_id:
+                command = self._events.select().where(self._events.c.event_id == event_id)
+            elif event_name:
+                command = self._events.select().where(self._events.c.event_name == event_name)
+            else:
+                return {}
+            res = session.execute(command).fetchone()
+
+        if not res:
+            return {}
+        event = self._event_row(res)
+        self._fill(self.event_map, event["event_id"], event, since[0])
+        self._fill(self.event_name_map, event["event_name"], event["event_id"], since[1])
+        return event
 
     def search_event(
         self,
-        club_id: int,
+        club_id: Optional[int] = None,
         event_id: Optional[int] = None,
         event_name: Optional[str] = None,
         event_location: Optional[str] = None,
@@ -205,14 +815,27 @@ class Database:
         start_time: Optional[datetime.datetime] = None,
         end_time: Optional[datetime.datetime] = None,
         limit: Optional[int] = None,
+        offset: int = 0,
+        page_size: Optional[int] = None,
     ):
-        with Session(self.engine) as session:
+        with self.transaction() as session:
             command = self._events.select()
+            ranked = False
 
             if event_id:
                 command = command.filter(self._events.c.event_id == event_id)
             if event_name:
-                command = command.filter(self._events.c.event_name.like(f"%{event_name}%"))
+                fts_query = self._fts_query(event_name)
+                if self._fts and fts_query:
+                    # ranked full-text match on the event name and location
+                    command = (
+                        command.join(db.table("events_fts"), db.literal_column("events_fts.rowid") == self._events.c.event_id)
+                        .filter(db.text("events_fts MATCH :fts_query").bindparams(fts_query=fts_query))
+                        .order_by(db.literal_column("bm25(events_fts)"))
+                    )
+                    ranked = True
+                else:
+                    command = command.filter(self._events.c.event_name.ilike(f"%{event_name}%"))
             if event_location:
                 command = command.filter(self._events.c.event_location == event_location)
             if start_time:
@@ -220,37 +843,76 @@ class Database:
             if end_time:
                 command = command.filter(self._events.c.end_time <= end_time)
             if categories:
-                for category in categories:
-                    command = command.filter(self._events.c.categories.like(f"%{category}%"))
+                # events tagged with every requested category
+                categories = self._normalize_categories(categories)
+                matching = (
+                    db.select(self._event_categories.c.event_id)
+                    .where(self._event_categories.c.category.in_(categories))
+                    .group_by(self._event_categories.c.event_id)
+                    .having(func.count() == len(categories))
+                )
+                command = command.filter(self._events.c.event_id.in_(matching))
             if limit:
                 command = command.filter(self._events.c.limit == limit)
             if club_id:
                 command = command.filter(self._events.c.club_id == club_id)
 
+            if not ranked:
+                command = command.order_by(self._events.c.start_time, self._events.c.event_id)
+            if offset:
+                command = command.offset(offset)
+            if page_size:
+                command = command.limit(page_size)
+
             result = session.execute(command)
             res = result.fetchall()
 
-        ans = []
-        for event in res:
-            ans.append(
-                {
-                    "event_id": event[0],
-                    "event_name": event[1],
-                    "event_location": event[2],
-                    "categories": event[3].split(","),
-                    "start_time": event[4],
-                    "end_time": event[5],
-                    "limit": event[6],
-                    "price": event[7],
-                    "on_duty": event[8],
-                    "rating": event[9],
-                    "club_id": event[10],
-                }
-            )
+        return [self._event_row(event) for event in res]
+
+    def get_events(self, event_ids: List[int]):
+        with self.transaction() as session:
+            command = self._events.select().where(self._events.c.event_id.in_(event_ids))
+            res = session.execute(command).fetchall()
+        return [self._event_row(event) for event in res]
+
+    def get_booked_intervals(self, user_id: int):
+        """The (event_id, start_time, end_time) of every event the user is registered, pending or waiting for."""
+        return self.get_booked_intervals_bulk([user_id]).get(user_id, [])
+
+    def get_booked_intervals_bulk(self, user_ids: List[int]) -> dict:
+        """Booked intervals for several users at once, keyed by user id, with one joined query per chunk."""
+        ans = {}
+        with self.transaction() as session:
+            for chunk in chunks(list(set(user_ids))):
+                command = (
+                    db.select(
+                        self._registrations.c.user_id,
+                        self._events.c.event_id,
+                        self._events.c.start_time,
+                        self._events.c.end_time,
+                    )
+                    .join(self._events)
+                    .where(self._registrations.c.user_id.in_(chunk))
+                    .where(self._registrations.c.status.in_(LIVE_STATUSES))
+                )
+                for user_id, event_id, start_time, end_time in session.execute(command):
+                    ans.setdefault(user_id, []).append((event_id, start_time, end_time))
         return ans
 
+    def iter_event_ids(self, after: Optional[int] = None, limit: Optional[int] = None) -> Iterator[int]:
+        for row in self._stream(db.select(self._events.c.event_id), self._events.c.event_id, after, limit):
+            yield row.event_id
+
+    def get_existing_event_names(self, event_names: List[str]) -> set:
+        with self.transaction() as session:
+            taken = set()
+            for chunk in chunks(event_names):
+                command = db.select(self._events.c.event_name).where(self._events.c.event_name.in_(chunk))
+                taken.update(session.execute(command).scalars())
+        return taken
+
     def get_event_ids(self):
-        with Session(self.engine) as session:
+        with self.transaction() as session:
             command = self._events.select()
             result = session.execute(command)
             res = result.fetchall()
@@ -267,13 +929,12 @@ class Database:
         club_id: int,
         price: Optional[float] = 0.0
     ):
-        event_ids = self.get_event_ids()
-        new_id = unique_id()
+        with self.transaction() as session:
+            if self.get_event(event_name=event_name):
+                raise ValueError("Event name already exists")
 
-        while new_id in event_ids:
             new_id = unique_id()
 
-        with Session(self.engine) as session:
             command = self._events.insert().values(
                 event_id=new_id,
                 event_name=event_name,
@@ -286,378 +947,539 @@ class Database:
                 club_id=club_id,
             )
             session.execute(command)
-            session.commit()
+
+            values = [{"event_id": new_id, "category": category} for category in self._normalize_categories(categories)]
+            if values:
+                session.execute(self._event_categories.insert(), values)
+            self._bump_version(session, "catalogue")
 
         return new_id
 
-    def get_registered_events(self, user_id: int):
-        with Session(self.engine) as session:
-            command = self._registrations.select().where(self._registrations.c.user_id == user_id)
-            result = session.execute(command)
-            res = result.fetchall()
-        ans = []
-        for entry in res:
-            ans.append(
-                {
-                    "registration_id": entry[0],
-                    "user_id": entry[1],
-                    "event_name": entry[2],
-                    "event_id": entry[3],
-                    "status": "confirmed",
-                }
+    def add_events_bulk(self, events: List[dict]) -> List[int]:
+        """Insert many validated events in one transaction, returning their ids in order."""
+        with self.transaction() as session:
+            taken = self.get_existing_event_names([event["event_name"] for event in events])
+            if taken:
+                raise ValueError(f"Event names already exist: {', '.join(sorted(taken))}")
+
+            new_ids = [unique_id() for _ in events]
+            session.execute(
+                self._events.insert(),
+                [
+                    {
+                        "event_id": new_id,
+                        "event_name": event["event_name"],
+                        "event_location": event["event_location"],
+                        "categories": ",".join(event["categories"]),
+                        "start_time": event["start_time"],
+                        "end_time": event["end_time"],
+                        "limit": event["limit"],
+                        "price": event.get("price", 0.0),
+                        "club_id": event["club_id"],
+                        "seats_taken": 0,
+                    }
+                    for new_id, event in zip(new_ids, events)
+                ],
             )
-        with Session(self.engine) as session:
-            # check waiting and pending lists
-            command = self._waitlist.select().where(self._waitlist.c.user_id == user_id)
-            result = session.execute(command)
-            res = result.fetchall()
-        for entry in res:
-            ans.append({"registration_id": entry[3], "user_id": entry[0], "event_id": entry[1], "status": "waiting"})
+            categories = [
+                {"event_id": new_id, "category": category}
+                for new_id, event in zip(new_ids, events)
+                for category in self._normalize_categories(event["categories"])
+            ]
+            if categories:
+                session.execute(self._event_categories.insert(), categories)
+            self._bump_version(session, "catalogue")
+
+        return new_ids
+
+    def _registration_rows(self):
+        # registrations with the event name joined from the event, since registrations approved
+        # from an offer don't store it; the columns are in REGISTRATION_FIELDS order
+        registrations = self._registrations.c
+        return db.select(
+            registrations.registration_id,
+            registrations.user_id,
+            func.coalesce(self._events.c.event_name, registrations.event_name).label("event_name"),
+            registrations.event_id,
+            registrations.status,
+            registrations.registration_timestamp,
+        ).select_from(self._registrations.outerjoin(self._events))
+
+
+    @staticmethod
+    def _registration_dict(entry) -> dict:
+        # the cheapest way from a row to a dict, which the response serializes natively
+        return dict(zip(REGISTRATION_FIELDS, entry))
+
+    def _find_registration(self, session, registration_id: int):
+        command = self._registrations.select().where(self._registrations.c.registration_id == registration_id)
+        return session.execute(command).fetchone()
+
+    def _transition(self, session, registration, status: str, **values) -> bool:
+        """
+        Move a registration row to `status` with one conditional UPDATE.
+
+        Returns False if the registration left the state it was read in meanwhile.
+        """
+        if status not in REGISTRATION_TRANSITIONS[registration.status]:
+            raise ValueError(f"Cannot move a {registration.status} registration to {status}")
+        command = (
+            self._registrations.update()
+            .where(self._registrations.c.registration_id == registration.registration_id)
+            .where(self._registrations.c.status == registration.status)
+            .values(status=status, **values)
+        )
+        if session.execute(command).rowcount != 1:
+            return False
+        self._invalidate(session, "registrations", registration.registration_id)
+        if registration.status == "waiting":
+            self._cancel_waiting(session, registration.registration_id)
+        return True
 
-        with Session(self.engine) as session:
-            command = self._pendinglist.select().where(self._pendinglist.c.user_id == user_id)
-            result = session.execute(command)
-            res = result.fetchall()
-        for entry in res:
-            ans.append({"registration_id": entry[3], "user_id": entry[0], "event_id": entry[1], "status": "pending"})
-        return ans
+    def get_registered_events(self, user_id: int):
+        with self.transaction() as session:
+            command = (
+                self._registration_rows()
+                .where(self._registrations.c.user_id == user_id)
+                .where(self._registrations.c.status.in_(LIVE_STATUSES))
+            )
+            return [self._registration_dict(entry) for entry in session.execute(command)]
 
     def get_registrations(self, event_id: Optional[int] = None):
-        ans = []
-
-        # Get confirmed registrations
-        with Session(self.engine) as session:
-            command = self._registrations.select()
+        with self.transaction() as session:
+            command = self._registration_rows().where(self._registrations.c.status.in_(LIVE_STATUSES))
             if event_id:
                 command = command.where(self._registrations.c.event_id == event_id)
-            result = session.execute(command)
-            res = result.fetchall()
-
-            for entry in res:
-                ans.append(
-                    {
-                        "registration_id": entry[0],
-                        "user_id": entry[1],
-                        "event_name": entry[2],
-                        "event_id": entry[3],
-                        "status": "confirmed",
-                    }
-                )
-
-        # Get waitlist registrations
-        with Session(self.engine) as session:
-            command = self._waitlist.select()
-            if event_id:
-                command = command.where(self._waitlist.c.event_id == event_id)
-            result = session.execute(command)
-            res = result.fetchall()
-
-            for entry in res:
-                ans.append(
-                    {
-                        "registration_id": entry[3],
-                        "user_id": entry[0],
-                        "event_id": entry[1],
-                        "registration_timestamp": entry[2],
-                        "status": "waiting",
-                    }
-                )
-
-        # Get pending registrations
-        with Session(self.engine) as session:
-            command = self._pendinglist.select()
-            if event_id:
-                command = command.where(self._pendinglist.c.event_id == event_id)
-            result = session.execute(command)
-            res = result.fetchall()
+            return [self._registration_dict(entry) for entry in session.execute(command)]
 
-            for entry in res:
-                ans.append(
-                    {
-                        "registration_id": entry[3],
-                        "user_id": entry[0],
-                        "event_id": entry[1],
-                        "registration_timestamp": entry[2],
-                        "status": "pending",
-                    }
-                )
+    def iter_registrations(self, after: Optional[int] = None, limit: Optional[int] = None) -> Iterator[dict]:
+        command = self._registration_rows().where(self._registrations.c.status.in_(LIVE_STATUSES))
+        for entry in self._stream(command, self._registrations.c.registration_id, after, limit):
+            yield self._registration_dict(entry)
 
-        return ans
+    def get_live_registration(self, user_id: int, event_id: int) -> Optional[dict]:
+        """The user's live registration for the event, if there is one."""
+        with self.transaction() as session:
+            command = (
+                self._registration_rows()
+                .where(self._registrations.c.user_id == user_id)
+                .where(self._registrations.c.event_id == event_id)
+                .where(self._registrations.c.status.in_(LIVE_STATUSES))
+            )
+            entry = session.execute(command).fetchone()
+        return self._registration_dict(entry) if entry else None
 
     def get_registration(self, registration_id: int):
-        if registration_id in self.registration_map:
-            return self.registration_map[registration_id]
-
-        with Session(self.engine) as session:
-            command = self._registrations.select().where(self._registrations.c.registration_id == registration_id)
-            result = session.execute(command)
-            res = result.fetchone()
+        cached = self.registration_map.get(registration_id)
+        if cached is not None:
+            return cached
+
+        since = self.registration_map.token()
+        with self.transaction() as session:
+            command = self._registration_rows().where(self._registrations.c.registration_id == registration_id)
+            res = session.execute(command).fetchone()
         if not res:
             raise ValueError("Registration not found")
 
-        return {"registration_id": res[0], "user_id": res[1], "event_name": res[2], "event_id": res[3]}
+        registration = self._registration_dict(res)
+        self._fill(self.registration_map, registration_id, registration, since)
+        return registration
+
+    def _queue_entries(self, status: str, registration_id: Optional[int] = None) -> List[dict]:
+        # waiting or pending registrations, oldest first
+        registrations = self._registrations.c
+        with self.transaction() as session:
+            command = (
+                db.select(
+                    registrations.user_id,
+                    registrations.event_id,
+                    registrations.registration_timestamp,
+                    registrations.registration_id,
+                )
+                .where(registrations.status == status)
+                .order_by(registrations.registration_timestamp)
+            )
+            if registration_id is not None:
+                command = command.where(registrations.registration_id == registration_id)
+            return [dict(entry._mapping) for entry in session.execute(command)]
 
     def get_waiting_entry(self, registration_id: int):
-        with Session(self.engine) as session:
-            command = self._waitlist.select().where(self._waitlist.c.registration_id == registration_id)
-            result = session.execute(command)
-            res = result.fetchone()
-        if not res:
+        entries = self._queue_entries("waiting", registration_id)
+        if not entries:
             raise ValueError("Registration not found")
-        return {
-            "user_id": res[0],
-            "event_id": res[1],
-            "registration_timestamp": res[2],
-            "registration_id": res[3],
-        }
+        return entries[0]
 
     def get_waiting_list(self):
-        with Session(self.engine) as session:
-            command = self._waitlist.select().order_by(self._waitlist.c.registration_timestamp)
-            result = session.execute(command)
-            res = result.fetchall()
-        ans = []
-        for entry in res:
-            ans.append(
-                {
-                    "user_id": entry[0],
-                    "event_id": entry[1],
-                    "registration_timestamp": entry[2],
-                    "registration_id": entry[3],
-                }
-            )
-        return ans
+        return self._queue_entries("waiting")
 
     def get_pending_list(self):
-        with Session(self.engine) as session:
-            command = self._pendinglist.select().order_by(self._pendinglist.c.registration_timestamp)
-            result = session.execute(command)
-            res = result.fetchall()
-        ans = []
-        for entry in res:
-            ans.append(
-                {
-                    "user_id": entry[0],
-                    "event_id": entry[1],
-                    "registration_timestamp": entry[2],
-                    "registration_id": entry[3],
-                }
-            )
-        return ans
+        return self._queue_entries("pending")
 
-    def register_event(self, event_name: str, user_id: int):
-        self.remove_from_pending()
-        existing_events = self.search_event(event_name=event_name)
-        print(existing_events)
-        if not existing_events:
-            print("Event not found")
-            raise ValueError("Event not found")
-        existing_users = self.get_user(user_id=user_id)
-        if not existing_users:
-            print("User not found")
-            raise ValueError("User not found")
-
-        new_id = unique_id()
-        existing = self.get_registrations()
-        while new_id in existing:
-            new_id = unique_id()
-
-        print("New ID", new_id)
+    def register_event(self, event_name: str, user_id: int) -> dict:
+        """Register the user for the event, returning the registration's id and the status it got."""
+        with self.transaction() as session:
+            event = self.get_event(event_name=event_name)
+            if not event:
+                print("Event not found")
+                raise ValueError("Event not found")
+            existing_users = self.get_user(user_id=user_id)
+            if not existing_users:
+                print("User not found")
+                raise ValueError("User not found")
 
-        limit = existing_events[0]["limit"]
-        current = len(self.search_event(event_id=existing_events[0]["event_id"]))
+            new_id = unique_id()
 
-        # if we need to push to the waiting list:
-        if current >= limit:
-            print("Adding to waitlist")
-            with Session(self.engine) as session:
-                command = self._waitlist.insert().values(
-                    user_id=user_id,
-                    event_id=existing_events[0]["event_id"],
-                    registration_timestamp=int(time.time()),
-                    registration_id=new_id,
-                )
-                session.execute(command)
-                session.commit()
-        else:
-            print("Adding to registration")
-            # there are seats available
-            with Session(self.engine) as session:
+            if self._take_seat(session, event["event_id"]):
+                # there are seats available; a paid event's is held until the payment is captured
+                status = "unpaid" if self._is_paid(event["price"]) else "confirmed"
                 command = self._registrations.insert().values(
                     registration_id=new_id,
                     user_id=user_id,
                     event_name=event_name,
-                    event_id=existing_events[0]["event_id"],  # first entry of the first result of the event name lookup
+                    event_id=event["event_id"],  # the event found by the exact name lookup
+                    status=status,
+                    registration_timestamp=int(time.time()),
                 )
-                # todo: implement limit to registrations
                 session.execute(command)
-                session.commit()
-
-        return new_id
+            else:
+                # if we need to push to the waiting list:
+                status = "waiting"
+                self.add_to_waiting(user_id, event["event_id"], int(time.time()), new_id)
+
+        return {"registration_id": new_id, "status": status}
+
+    @staticmethod
+    def _is_paid(price: Optional[float]) -> bool:
+        # events created before prices existed have none, and are free
+        return (price or 0) > 0
+
+    def register_events_bulk(self, registrations: List[dict]) -> List[dict]:
+        """
+        Register many (event name, user id) rows in one transaction.
+
+        Rows are checked against each other and the database with a few set-based queries, then
+        each event's free seats go to its rows in upload order and the rest join the waitlist.
+        Returns one result per row, holding either the registration or the reason it was rejected.
+        """
+        now = int(time.time())
+        results = [{"row": number} for number in range(len(registrations))]
+
+        with self.transaction() as session:
+            names = list({row["name"] for row in registrations})
+            events = {}
+            for chunk in chunks(names):
+                command = self._events.select().where(self._events.c.event_name.in_(chunk))
+                for event in session.execute(command):
+                    events[event.event_name] = event
+
+            user_ids = list({row["user_id"] for row in registrations})
+            users = set()
+            for chunk in chunks(user_ids):
+                command = db.select(self._users.c.user_id).where(self._users.c.user_id.in_(chunk))
+                users.update(session.execute(command).scalars())
+
+            booked = self.get_booked_intervals_bulk(user_ids)
+            schedules = {}
+
+            accepted = {}
+            for result, row in zip(results, registrations):
+                event = events.get(row["name"])
+                user_id = row["user_id"]
+                if event is None:
+                    result["error"] = "Event not found"
+                elif user_id not in users:
+                    result["error"] = "User not found"
+                elif self._is_paid(event.price):
+                    result["error"] = "Paid events must be registered individually"
+                elif event.event_id in {event_id for event_id, _, _ in booked.get(user_id, [])}:
+                    result["error"] = "Already registered for this event"
+                else:
+                    if user_id not in schedules:
+                        schedules[user_id] = Schedule((start, end) for _, start, end in booked.get(user_id, []))
+                    if schedules[user_id].collides(event.start_time, event.end_time):
+                        result["error"] = "Time slot collides with another event"
+                        continue
+                    booked.setdefault(user_id, []).append((event.event_id, event.start_time, event.end_time))
+                    schedules.pop(user_id)
+                    accepted.setdefault(event.event_id, []).append((result, row, event))
+
+            rows = []
+            for event_id, accepted_rows in accepted.items():
+                granted = self._take_seats(session, event_id, len(accepted_rows))
+                for position, (result, row, event) in enumerate(accepted_rows):
+                    result["registration_id"] = unique_id()
+                    result["status"] = "confirmed" if position < granted else "waiting"
+                    rows.append(
+                        {
+                            "registration_id": result["registration_id"],
+                            "user_id": row["user_id"],
+                            "event_name": event.event_name,
+                            "event_id": event_id,
+                            "status": result["status"],
+                            "registration_timestamp": now,
+                        }
+                    )
 
-    def add_to_pending(self):
-        waiting_list = self.get_waiting_list()
-        if not waiting_list:
-            return
-        entry = waiting_list[0]
-        with Session(self.engine) as session:
-            command = self._pendinglist.insert().values(
-                user_id=entry["user_id"],
-                event_id=entry["event_id"],
-                registration_timestamp=int(time.time()),
-                registration_id=entry["registration_id"],
+            if rows:
+                session.execute(self._registrations.insert(), rows)
+                for entry in rows:
+                    if entry["status"] == "waiting":
+                        self._enqueue_waiting(session, entry["event_id"], entry["registration_id"], now)
+
+        return results
+
+    def _next_waiting(self, session, event_id: int):
+        # the rows are locked until we commit, and rows another transaction is promoting are skipped,
+        # so concurrent promotions on a server database take different entries (sqlite has one writer anyway)
+        registrations = self._registrations.c
+        # the head of the in-memory queue, checked against the table by primary key
+        while True:
+            registration_id = self.waiting_list.peek(event_id)
+            if registration_id is None:
+                break
+            command = (
+                self._registrations.select()
+                .where(registrations.registration_id == registration_id)
+                .where(registrations.status == "waiting")
+                .with_for_update(skip_locked=True)
             )
-            session.execute(command)
-            session.commit()
+            entry = session.execute(command).fetchone()
+            if entry:
+                return entry
+            # the mirror is behind the table, or another worker is promoting it
+            self.waiting_list.cancel(registration_id)
+
+        # nothing in the mirror, ask the (event_id, status, registration_timestamp) index
+        command = (
+            self._registrations.select()
+            .where(registrations.event_id == event_id)
+            .where(registrations.status == "waiting")
+            .order_by(registrations.registration_timestamp, registrations.registration_id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        return session.execute(command).fetchone()
+
+    def add_to_pending(self, event_id: int):
+        """
+        Offer a freed seat of the event to the longest waiting registration for that same event.
+
+        The offer is pending until it is approved, or, for a paid event, held unpaid until its payment
+        is captured; the payment reconciler creates the order for it. Either expires if nothing comes.
+        """
+        with self.transaction() as session:
+            entry = self._next_waiting(session, event_id)
+            if not entry:
+                return None
+            # the offer holds a seat until it is approved or expires
+            if not self._take_seat(session, event_id):
+                return None
+            event = self.get_event(event_id=event_id)
+            status = "unpaid" if self._is_paid(event["price"]) else "pending"
+            if not self._transition(session, entry, status, registration_timestamp=int(time.time())):
+                self._release_seat(session, event_id)
+                return None
+        return entry.registration_id
 
     def add_to_waiting(self, user_id, event_id, registration_timestamp, registration_id):
-        with Session(self.engine) as session:
-            command = self._waitlist.insert().values(
+        with self.transaction() as session:
+            command = self._registrations.insert().values(
                 user_id=user_id,
                 event_id=event_id,
+                status="waiting",
                 registration_timestamp=registration_timestamp,
                 registration_id=registration_id,
             )
             session.execute(command)
-            session.commit()
-
-    def remove_from_pending(self):
-        pending_list = self.get_pending_list()
-        for ele in pending_list:
-            if ele["registration_timestamp"] + 3600 < int(time.time()):
-                with Session(self.engine) as session:
-                    command = self._pendinglist.delete().where(
-                        self._pendinglist.c.registration_id == ele["registration_id"]
-                    )
-                    session.execute(command)
-                    session.commit()
-                self.add_to_waiting(ele["user_id"], ele["event_id"], int(time.time()), ele["registration_id"])
+            self._enqueue_waiting(session, event_id, registration_id, registration_timestamp)
 
-    def cancel_registration(self, registration_id):
-        try:
-            self.get_waiting_entry(registration_id)
-            with Session(self.engine) as session:
-                command = self._waitlist.delete().where(self._waitlist.c.registration_id == registration_id)
-                session.execute(command)
-                session.commit()
+    def expire_pending(self, batch_size: int = config.EXPIRY_BATCH_SIZE, now: Optional[int] = None) -> dict:
+        """
+        Expire up to `batch_size` of the oldest pending offers in one transaction.
 
-            with Session(self.engine) as session:
-                command = self._pendinglist.delete().where(self._pendinglist.c.registration_id == registration_id)
-                session.execute(command)
-                session.commit()
+        Each freed seat is offered to the next registration in line for the same event.
+        """
+        return self._expire_holds("pending", config.PENDING_TTL, batch_size, now)
+
+    def expire_unpaid(self, batch_size: int = config.EXPIRY_BATCH_SIZE, now: Optional[int] = None) -> dict:
+        """Expire up to `batch_size` of the oldest seat holds whose payment never came, like expire_pending."""
+        return self._expire_holds("unpaid", config.PAYMENT_HOLD_TTL, batch_size, now)
 
-        except ValueError:
-            # it is not in the waiting list, so it raised a ValueError
-            with Session(self.engine) as session:
-                command = self._registrations.delete().where(self._registrations.c.registration_id == registration_id)
+    def _expire_holds(self, status: str, ttl: int, batch_size: int, now: Optional[int]) -> dict:
+        now = int(time.time()) if now is None else now
+        registrations = self._registrations.c
+        with self.transaction() as session:
+            command = (
+                db.select(registrations.registration_id, registrations.event_id, registrations.registration_timestamp)
+                .where(registrations.status == status)
+                .where(registrations.registration_timestamp < now - ttl)
+                .order_by(registrations.registration_timestamp)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            expired = [row._mapping for row in session.execute(command).fetchall()]
+            if not expired:
+                return {"expired": 0, "max_lag": 0}
+
+            # the whole batch moves to expired in one UPDATE
+            registration_ids = [entry["registration_id"] for entry in expired]
+            command = (
+                self._registrations.update()
+                .where(registrations.registration_id.in_(registration_ids))
+                .where(registrations.status == status)
+                .values(status="expired", registration_timestamp=now)
+            )
+            session.execute(command)
+            for registration_id in registration_ids:
+                self._invalidate(session, "registrations", registration_id)
+
+            for event_id, count in Counter(entry["event_id"] for entry in expired).items():
+                command = (
+                    self._events.update()
+                    .where(self._events.c.event_id == event_id)
+                    .values(
+                        seats_taken=db.case(
+                            (self._events.c.seats_taken > count, self._events.c.seats_taken - count), else_=0
+                        ),
+                        version=self._events.c.version + 1,
+                    )
+                )
                 session.execute(command)
-                session.commit()
+                self._event_changed(session, event_id)
+                for _ in range(count):
+                    if self.add_to_pending(event_id) is None:
+                        break
+
+        # how long past its deadline the oldest hold in the batch was swept
+        max_lag = now - (expired[0]["registration_timestamp"] + ttl)
+        return {"expired": len(expired), "max_lag": max_lag}
 
-            # add a waitlist member to the pending list
-            self.add_to_pending()
+    def cancel_registration(self, registration_id):
+        with self.transaction() as session:
+            registration = self._find_registration(session, registration_id)
+            # cancelling is idempotent, and a registration that no longer exists has nothing to cancel
+            if registration is None or not REGISTRATION_TRANSITIONS[registration.status]:
+                return True
+            if not self._transition(session, registration, "cancelled", registration_timestamp=int(time.time())):
+                raise ValueError("Registration changed while cancelling, try again")
+
+            # pending offers, unpaid holds and confirmed registrations all hold a seat
+            if registration.status in SEAT_STATUSES:
+                self._release_seat(session, registration.event_id)
+                # offer the seat to the event's waitlist
+                self.add_to_pending(registration.event_id)
 
         return True
 
     def approve_registration(self, registration_id):
-        self.remove_from_pending()
-        # check if its in the pending table
-        # if its not, raise error
-        # if it is, and if the registration time is more than an hour ago, raise an error and remove from table
-        # else, add to registration table
-        with Session(self.engine) as session:
-            command = self._pendinglist.select().where(self._pendinglist.c.registration_id == registration_id)
-            result = session.execute(command)
-            res = result.fetchone()
-        if not res:
-            raise ValueError("Registration not found")
-
-        if int(time.time()) - res[2] > 3600:
-            with Session(self.engine) as session:
-                command = self._pendinglist.delete().where(self._pendinglist.c.registration_id == registration_id)
-                session.execute(command)
-                session.commit()
+        with self.transaction() as session:
+            # only pending offers can be approved, unless they have expired
+            registration = self._find_registration(session, registration_id)
+            # a paid event's seats are only confirmed by their captured payment
+            if registration is not None and self._is_paid(self.get_event(event_id=registration.event_id)["price"]):
+                raise ValueError("Registrations for paid events are confirmed by their payment")
+            if registration is None or registration.status != "pending":
+                raise ValueError("Registration not found")
+
+            # offers the background sweep has not reached yet still expire on time
+            now = int(time.time())
+            expired = now - registration.registration_timestamp > config.PENDING_TTL
+            if expired:
+                # the offer expires, and we raise once that has committed
+                if self._transition(session, registration, "expired", registration_timestamp=now):
+                    self._release_seat(session, registration.event_id)
+                    self.add_to_pending(registration.event_id)
+            elif not self._transition(session, registration, "confirmed", registration_timestamp=now):
+                raise ValueError("Registration not found")
+
+        if expired:
             raise ValueError("Registration expired")
-
-        with Session(self.engine) as session:
-            command = self._registrations.insert().values(
-                registration_id=registration_id, user_id=res[0], event_id=res[1]
-            )
-            session.execute(command)
-            session.commit()
-
-            # Remove from pending list after successful registration
-            command = self._pendinglist.delete().where(self._pendinglist.c.registration_id == registration_id)
-            session.execute(command)
-            session.commit()
-
-        return {"registration_id": registration_id, "user_id": res[0], "event_id": res[1], "status": "confirmed"}
+        return {
+            "registration_id": registration_id,
+            "user_id": registration.user_id,
+            "event_id": registration.event_id,
+            "status": "confirmed",
+        }
 
     def registration_status(self, registration_id):
-        with Session(self.engine) as session:
-            command = self._registrations.select().where(self._registrations.c.registration_id == registration_id)
-            result = session.execute(command)
-            res = result.fetchone()
-        if res:
-            return "confirmed"
-        with Session(self.engine) as session:
-            command = self._pendinglist.select().where(self._pendinglist.c.registration_id == registration_id)
-            result = session.execute(command)
-            res = result.fetchone()
-        if res:
-            return "pending"
-        with Session(self.engine) as session:
-            command = self._waitlist.select().where(self._waitlist.c.registration_id == registration_id)
-            result = session.execute(command)
-            res = result.fetchone()
-        if res:
-            return "waiting"
-        return "not found"
+        with self.transaction() as session:
+            command = db.select(self._registrations.c.status).where(
+                self._registrations.c.registration_id == registration_id
+            )
+            status = session.execute(command).scalar()
+        return status or "not found"
 
     def update_club_upi(self, club_id: int, upi_id: str):
-        with Session(self.engine) as session:
+        with self.transaction() as session:
             command = self._clubs.update().where(self._clubs.c.club_id == club_id).values(upi_id=upi_id)
             session.execute(command)
-            session.commit()
 
     def update_event_rating(self, event_id: int, new_rating: float):
-        with Session(self.engine) as session:
-            event = session.query(self._events).filter(self._events.c.event_id == event_id).first()
+        with self.transaction() as session:
+            command = db.select(self._events.c.club_id).where(self._events.c.event_id == event_id)
+            event = session.execute(command).first()
             if not event:
                 raise ValueError("Event not found")
 
-            if event.rating is None:
-                event.rating = new_rating
-            else:
-                event.rating = (event.rating + new_rating) / 2
-
-            session.commit()
-
-    def get_leaderboard(self, limit: int = 10):
-        with Session(self.engine) as session:
-            # Subquery to calculate the average rating for each club
-            subquery = (
-                session.query(
-                    self._events.c.club_id,
-                    func.avg(self._events.c.rating).label("avg_rating"),
+            events = self._events.c
+            command = (
+                self._events.update()
+                .where(events.event_id == event_id)
+                .values(
+                    rating_sum=events.rating_sum + new_rating,
+                    rating_count=events.rating_count + 1,
+                    rating=(events.rating_sum + new_rating) / (events.rating_count + 1),
+                    version=events.version + 1,
                 )
-                .group_by(self._events.c.club_id)
-                .subquery()
             )
+            session.execute(command)
+            self._event_changed(session, event_id)
+
+            if event.club_id is None:
+                return
 
-            # Query to retrieve club information and their average rating
+            clubs = self._club_ratings.c
             command = (
-                session.query(
-                    self._clubs.c.club_id,
-                    self._clubs.c.club_name,
-                    subquery.c.avg_rating,
+                self._club_ratings.update()
+                .where(clubs.club_id == event.club_id)
+                .values(
+                    rating_sum=clubs.rating_sum + new_rating,
+                    rating_count=clubs.rating_count + 1,
+                    average_rating=(clubs.rating_sum + new_rating) / (clubs.rating_count + 1),
+                )
+            )
+            if not session.execute(command).rowcount:
+                command = self._club_ratings.insert().values(
+                    club_id=event.club_id, rating_sum=new_rating, rating_count=1, average_rating=new_rating
                 )
-                .outerjoin(self._clubs, self._clubs.c.club_id == subquery.c.club_id)
-                .order_by(subquery.c.avg_rating.desc())
+                session.execute(command)
+            # the cached boards are kept per limit, drop them all
+            self._record(session, ["clear", "leaderboard"])
+            self._bump_version(session, "leaderboard")
+
+    def get_leaderboard(self, limit: int = 10, version: Optional[int] = None):
+        """
+        The top clubs by average rating, at least as new as the leaderboard `version` if one is given.
+        """
+        # the homepage polls this; ratings clear the cached boards, and LEADERBOARD_TTL bounds how
+        # long a worker that missed that message serves an old one
+        cached = self.leaderboard_map.get(limit)
+        if cached is not None and (version is None or cached[0] >= version):
+            return cached[1]
+
+        since = self.leaderboard_map.token()
+        with self.transaction() as session:
+            # the board is cached with the version read before it, which it is at least as new as
+            if version is None:
+                version = self.leaderboard_version(cached=False)
+            # the top clubs are the first entries of the average_rating index
+            command = (
+                db.select(self._clubs.c.club_id, self._clubs.c.club_name, self._club_ratings.c.average_rating)
+                .join(self._clubs, self._clubs.c.club_id == self._club_ratings.c.club_id)
+                .order_by(self._club_ratings.c.average_rating.desc())
                 .limit(limit)
             )
-
-            result = session.execute(command)
-            res = result.fetchall()
+            res = session.execute(command).fetchall()
 
         ans = []
         for club_id, club_name, avg_rating in res:
@@ -668,4 +1490,298 @@ class Database:
                     "average_rating": avg_rating if avg_rating is not None else 0.0,
                 }
             )
+        self._fill(self.leaderboard_map, limit, (version, ans), since)
         return ans
+
+    def add_ingest_job(self, username: str, club_id: Optional[int] = None) -> int:
+        now = int(time.time())
+        job_id = unique_id()
+        with self.transaction() as session:
+            command = self._ingest_jobs.insert().values(
+                job_id=job_id, username=username, club_id=club_id, status="queued", created_at=now, updated_at=now
+            )
+            session.execute(command)
+        return job_id
+
+    def get_ingest_job(self, job_id: int) -> Optional[dict]:
+        with self.transaction() as session:
+            command = db.select(*(self._ingest_jobs.c[field] for field in INGEST_FIELDS)).where(
+                self._ingest_jobs.c.job_id == job_id
+            )
+            row = session.execute(command).first()
+        return dict(zip(INGEST_FIELDS, row)) if row else None
+
+    def claim_ingest_job(self, owner: str, now: Optional[int] = None) -> Optional[dict]:
+        """
+        Take the oldest queued job for `owner`, moving it to "fetching", or None when the queue is empty.
+
+        Jobs whose worker went quiet for INGEST_JOB_TIMEOUT seconds are queued again first, or failed
+        once they used up INGEST_MAX_ATTEMPTS.
+        """
+        now = int(time.time()) if now is None else now
+        jobs = self._ingest_jobs.c
+        with self.transaction() as session:
+            stalled = (
+                self._ingest_jobs.update()
+                .where(jobs.status.in_(("fetching", "extracting")))
+                .where(jobs.updated_at < now - config.INGEST_JOB_TIMEOUT)
+            )
+            session.execute(
+                stalled.where(jobs.attempts >= config.INGEST_MAX_ATTEMPTS).values(
+                    status="failed", owner=None, updated_at=now, error="The worker processing it stopped responding"
+                )
+            )
+            session.execute(stalled.values(status="queued", owner=None, updated_at=now))
+
+            while True:
+                command = (
+                    db.select(jobs.job_id)
+                    .where(jobs.status == "queued")
+                    .order_by(jobs.updated_at, jobs.job_id)
+                    .limit(1)
+                    .with_for_update(skip_locked=True)
+                )
+                job_id = session.execute(command).scalar()
+                if job_id is None:
+                    return None
+                # only one worker moves it out of the queue
+                command = (
+                    self._ingest_jobs.update()
+                    .where(jobs.job_id == job_id)
+                    .where(jobs.status == "queued")
+                    .values(status="fetching", owner=owner, attempts=jobs.attempts + 1, updated_at=now)
+                )
+                if session.execute(command).rowcount == 1:
+                    break
+
+        return self.get_ingest_job(job_id)
+
+    def update_ingest_job(self, job_id: int, owner: str, status: str, draft: Optional[dict] = None, error: Optional[str] = None) -> bool:
+        """Move a job the owner holds on to `status`, returning False if it was taken from them meanwhile."""
+        if status not in INGEST_STATUSES:
+            raise ValueError(f"Unknown ingest status {status}")
+        values = {"status": status, "updated_at": int(time.time())}
+        if status in ("done", "failed"):
+            values.update(owner=None, draft=draft, error=error)
+        with self.transaction() as session:
+            command = (
+                self._ingest_jobs.update()
+                .where(self._ingest_jobs.c.job_id == job_id)
+                .where(self._ingest_jobs.c.owner == owner)
+                .values(**values)
+            )
+            return session.execute(command).rowcount == 1
+
+    def _insert_ignoring_conflicts(self, table, index_elements):
+        # an insert that does nothing when the key is taken, which sqlite and postgresql spell alike
+        dialect = sqlite if self.is_sqlite else postgresql
+        return dialect.insert(table).on_conflict_do_nothing(index_elements=index_elements)
+
+    def claim_payment_order(
+        self, key: str, registration_id: int, user_id: int, event_id: int, amount: int, currency: str
+    ) -> dict:
+        """
+        Claim creating the gateway order for an idempotency key.
+
+        Returns the order id when it exists already. Otherwise `claimed` says whether the caller should
+        create it: nobody tried yet, the last attempt failed, or its worker went quiet. `attempts`
+        counts the claims, including this one.
+        """
+        now = int(time.time())
+        orders = self._payment_orders.c
+        with self.transaction() as session:
+            command = self._insert_ignoring_conflicts(self._payment_orders, [orders.idempotency_key]).values(
+                idempotency_key=key,
+                registration_id=registration_id,
+                user_id=user_id,
+                event_id=event_id,
+                amount=amount,
+                currency=currency,
+                status="creating",
+                attempts=1,
+                created_at=now,
+                updated_at=now,
+            )
+            if session.execute(command.returning(orders.idempotency_key)).first() is not None:
+                return {"order_id": None, "claimed": True, "attempts": 1}
+
+            command = (
+                self._payment_orders.update()
+                .where(orders.idempotency_key == key)
+                .where(orders.order_id.is_(None))
+                .where(db.or_(orders.status == "released", orders.updated_at < now - 2 * config.PAYMENT_TIMEOUT))
+                .values(status="creating", attempts=orders.attempts + 1, updated_at=now)
+            )
+            claimed = session.execute(command).rowcount == 1
+            command = db.select(orders.order_id, orders.attempts).where(orders.idempotency_key == key)
+            order_id, attempts = session.execute(command).one()
+        return {"order_id": order_id, "claimed": claimed, "attempts": attempts}
+
+    def complete_payment_order(self, key: str, order_id: str):
+        with self.transaction() as session:
+            command = (
+                self._payment_orders.update()
+                .where(self._payment_orders.c.idempotency_key == key)
+                .values(order_id=order_id, status="created", updated_at=int(time.time()))
+            )
+            session.execute(command)
+
+    def release_payment_order(self, key: str):
+        with self.transaction() as session:
+            command = (
+                self._payment_orders.update()
+                .where(self._payment_orders.c.idempotency_key == key)
+                .where(self._payment_orders.c.order_id.is_(None))
+                .values(status="released", updated_at=int(time.time()))
+            )
+            session.execute(command)
+
+    def unpaid_without_order(self, batch_size: int = config.PAYMENT_RECONCILE_BATCH, now: Optional[int] = None) -> List[dict]:
+        """
+        Up to `batch_size` of the oldest unpaid holds that have no gateway order, nor one being created.
+
+        These are the seats of paid events offered to waiters, and holds whose order could not be made
+        while their hold lasts; holds younger than PAYMENT_TIMEOUT are left to the request that made
+        them. Each comes with the event's price.
+        """
+        now = int(time.time()) if now is None else now
+        registrations = self._registrations.c
+        orders = self._payment_orders.c
+        ordered = (
+            db.select(orders.idempotency_key)
+            .where(orders.registration_id == registrations.registration_id)
+            .where(
+                db.or_(
+                    orders.order_id.is_not(None),
+                    # a worker still asking the gateway, as claim_payment_order sees it
+                    db.and_(orders.status == "creating", orders.updated_at >= now - 2 * config.PAYMENT_TIMEOUT),
+                )
+            )
+        )
+        with self.transaction() as session:
+            command = (
+                db.select(
+                    registrations.registration_id,
+                    registrations.user_id,
+                    registrations.event_id,
+                    self._events.c.price,
+                )
+                .join(self._events, self._events.c.event_id == registrations.event_id)
+                .where(registrations.status == "unpaid")
+                # a new registration's own request is about to create its order
+                .where(registrations.registration_timestamp <= now - config.PAYMENT_TIMEOUT)
+                .where(~ordered.exists())
+                .order_by(registrations.registration_timestamp)
+                .limit(batch_size)
+            )
+            return [dict(row._mapping) for row in session.execute(command).fetchall()]
+
+    def add_payment_captures(self, captures: List[dict]):
+        """Store a batch of captures in one statement; ones stored already are left as they are."""
+        with self.transaction() as session:
+            command = self._insert_ignoring_conflicts(
+                self._payment_captures, [self._payment_captures.c.payment_id]
+            )
+            session.execute(command, captures)
+
+    def reconcile_payments(
+        self, batch_size: int = config.PAYMENT_RECONCILE_BATCH, since: int = 0, now: Optional[int] = None
+    ) -> dict:
+        """
+        Match up to `batch_size` of the oldest unreconciled captures to the registrations they pay for.
+
+        Unpaid registrations paid in full are confirmed, and every capture in the batch gets its outcome.
+        Only captures received at `since` or later are looked at. Returns the count of each outcome,
+        and the `watermark`, the time the newest capture in the batch was received.
+        """
+        now = int(time.time()) if now is None else now
+        captures = self._payment_captures.c
+        reconciled = self._payment_reconciliations.c
+        orders = self._payment_orders.c
+        registrations = self._registrations.c
+        counts = dict.fromkeys(RECONCILE_OUTCOMES, 0)
+        with self.transaction() as session:
+            command = (
+                db.select(
+                    captures.payment_id,
+                    captures.amount,
+                    captures.received_at,
+                    orders.registration_id,
+                    orders.amount.label("due"),
+                )
+                .select_from(
+                    self._payment_captures.outerjoin(
+                        self._payment_reconciliations, reconciled.payment_id == captures.payment_id
+                    ).outerjoin(self._payment_orders, orders.order_id == captures.order_id)
+                )
+                .where(reconciled.payment_id.is_(None))
+                .where(captures.received_at >= since)
+                .order_by(captures.received_at)
+                .limit(batch_size)
+            )
+            batch = session.execute(command).fetchall()
+            if not batch:
+                return {"reconciled": 0, **counts, "watermark": since, "max_lag": 0}
+
+            # the holds paid in full move to confirmed, and only those still unpaid when the UPDATE
+            # runs come back: one that expired or was cancelled in the meantime stays as it is
+            paid = list({capture.registration_id for capture in batch if self._pays_in_full(capture)})
+            confirmed = set()
+            for chunk in chunks(paid):
+                command = (
+                    self._registrations.update()
+                    .where(registrations.registration_id.in_(chunk))
+                    .where(registrations.status == "unpaid")
+                    .values(status="confirmed", registration_timestamp=now)
+                    .returning(registrations.registration_id)
+                )
+                confirmed.update(session.execute(command).scalars())
+            for registration_id in confirmed:
+                self._invalidate(session, "registrations", registration_id)
+
+            # what the other registrations are now
+            statuses = {}
+            for chunk in chunks([registration_id for registration_id in paid if registration_id not in confirmed]):
+                command = db.select(registrations.registration_id, registrations.status).where(
+                    registrations.registration_id.in_(chunk)
+                )
+                statuses.update(session.execute(command).all())
+
+            verdicts = []
+            for capture in batch:
+                if capture.registration_id is None:
+                    outcome = "unmatched"
+                elif not self._pays_in_full(capture):
+                    outcome = "underpaid"
+                elif capture.registration_id in confirmed:
+                    outcome = "confirmed"
+                    # a second capture of the same order in the batch is a duplicate
+                    confirmed.discard(capture.registration_id)
+                    statuses[capture.registration_id] = "confirmed"
+                elif statuses.get(capture.registration_id) == "confirmed":
+                    outcome = "duplicate"
+                else:
+                    # the hold expired or was cancelled before the payment came
+                    outcome = "refund"
+                counts[outcome] += 1
+                verdicts.append(
+                    {
+                        "payment_id": capture.payment_id,
+                        "registration_id": capture.registration_id,
+                        "outcome": outcome,
+                        "reconciled_at": now,
+                    }
+                )
+            session.execute(self._payment_reconciliations.insert(), verdicts)
+
+        return {
+            "reconciled": len(batch),
+            **counts,
+            "watermark": batch[-1].received_at,
+            # how long the oldest capture in the batch waited to be reconciled
+            "max_lag": now - batch[0].received_at,
+        }
+
+    @staticmethod
+    def _pays_in_full(capture) -> bool:
+        return capture.registration_id is not None and capture.amount >= capture.due
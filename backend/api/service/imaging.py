@@ -0,0 +1,67 @@
+import io
+from typing import NamedTuple
+
+from api.service import config
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # optional, images are then sent to the vision model as they are
+    Image = None
+
+
+class PreparedImage(NamedTuple):
+    data: bytes  # JPEG
+    width: int
+    height: int
+    # perceptual hash: the same poster resized, re-encoded or recompressed gets the same one
+    phash: str
+
+
+def available() -> bool:
+    return Image is not None
+
+
+def prepare_image(
+    data: bytes, target_size: int = config.VISION_TARGET_SIZE, quality: int = config.VISION_JPEG_QUALITY
+) -> PreparedImage:
+    """
+    Shrink an image to what the vision model looks at, as a JPEG without metadata.
+
+    The longer side is scaled down to `target_size` pixels (never up), the EXIF orientation is
+    applied to the pixels, and the image is re-encoded without EXIF, ICC or other metadata.
+    Raises ValueError for data that is not an image, and RuntimeError when Pillow is not installed.
+    """
+    if Image is None:
+        raise RuntimeError("Pillow is not installed")
+    try:
+        image = Image.open(io.BytesIO(data))
+        # jpeg can decode straight at a fraction of the size, much faster than decoding it all
+        image.draft("RGB", (target_size, target_size))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGB")
+    except (OSError, SyntaxError) as e:
+        raise ValueError(f"Not an image: {e}") from e
+
+    phash = perceptual_hash(image)
+    image.thumbnail((target_size, target_size), Image.LANCZOS)
+    buffer = io.BytesIO()
+    # nothing but the pixels is written unless asked for, so the metadata stays behind
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return PreparedImage(buffer.getvalue(), image.width, image.height, phash)
+
+
+def perceptual_hash(image, size: int = 16) -> str:
+    """
+    Difference hash of the image, as hex.
+
+    Each bit says whether a pixel of the image shrunk to (size + 1) x size greyscale is brighter than
+    its right neighbour. 16 gives 256 bits, fine enough that posters made from one template with
+    different text usually differ.
+    """
+    pixels = image.convert("L").resize((size + 1, size), Image.LANCZOS).tobytes()
+    bits = 0
+    for row in range(size):
+        for column in range(size):
+            left = pixels[row * (size + 1) + column]
+            bits = (bits << 1) | (left > pixels[row * (size + 1) + column + 1])
+    return f"{bits:0{size * size // 4}x}"
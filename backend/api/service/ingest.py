@@ -0,0 +1,132 @@
+import asyncio
+import base64
+import datetime
+from typing import Optional
+from zoneinfo import ZoneInfo
+
+from api.service import config
+from api.service.coordination import Coordination, LocalCoordination
+
+# the fields of manage.Event a draft fills in, for the club to review before adding the event
+EVENT_FIELDS = ("club_id", "event_name", "event_location", "categories", "start_time", "end_time", "limit", "price")
+
+
+def draft_event(fields: dict, caption: str = "", club_id: Optional[int] = None) -> dict:
+    """
+    Map the fields extracted from a poster onto an event, listing the ones that still need filling in.
+
+    The poster's date and time are read in INGEST_TIMEZONE. A poster rarely says when the event ends,
+    so it is assumed to last INGEST_EVENT_DURATION seconds.
+    """
+    event = dict.fromkeys(EVENT_FIELDS)
+    event["club_id"] = club_id
+    event["event_name"] = fields.get("title")
+    event["event_location"] = fields.get("venue")
+    event["categories"] = []
+    event["limit"] = fields.get("capacity")
+    price = fields.get("price") or {}
+    event["price"] = price.get("value", 0.0) if fields.get("isPaid") else 0.0
+
+    if fields.get("date") and fields.get("time"):
+        start = datetime.datetime.strptime(f"{fields['date']} {fields['time']}", "%Y-%m-%d %H:%M")
+        start = start.replace(tzinfo=ZoneInfo(config.INGEST_TIMEZONE))
+        event["start_time"] = int(start.timestamp())
+        event["end_time"] = event["start_time"] + config.INGEST_EVENT_DURATION
+
+    return {
+        "event": event,
+        "missing": [field for field in EVENT_FIELDS if event[field] is None],
+        "description": fields.get("description"),
+        "currency": price.get("currency"),
+        "caption": caption,
+        "extracted": fields,
+    }
+
+
+class IngestWorkers:
+    """
+    Background tasks turning club posts into draft events.
+
+    Jobs are queued in the database by the /ai/ingest route and claimed by the workers of any
+    process, so a slow model never holds up a request. Each job fetches the club's latest post,
+    extracts the event details from the poster, and stores the draft on the job.
+    """
+
+    def __init__(
+        self,
+        database,
+        fetcher,
+        ollama,
+        workers: int = config.INGEST_WORKERS,
+        interval: float = config.INGEST_POLL_INTERVAL,
+        coordination: Optional[Coordination] = None,
+    ):
+        self.database = database
+        self.fetcher = fetcher
+        self.ollama = ollama
+        self.workers = workers
+        self.interval = interval
+        self.origin = (coordination or LocalCoordination()).origin
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+        self.metrics = {"done": 0, "failed": 0, "errors": 0, "last_duration": 0.0}
+
+    def notify(self):
+        """Wake the idle workers of this process, for a job just queued."""
+        self._wakeup.set()
+
+    async def run_once(self) -> bool:
+        """Process one queued job, returning False when there was none."""
+        job = await self.database.claim_ingest_job(self.origin)
+        if job is None:
+            return False
+
+        started = asyncio.get_running_loop().time()
+        job_id = job["job_id"]
+        try:
+            caption, image = await self.fetcher.get_latest_post(job["username"])
+            if not await self.database.update_ingest_job(job_id, self.origin, "extracting"):
+                return True  # given up on as stalled, and queued for another worker
+            fields = await self.ollama.get_image_extract(base64.b64encode(image).decode(), caption)
+            if not fields:
+                raise ValueError("No event details could be read from the post")
+            draft = draft_event(fields, caption, job["club_id"])
+            await self.database.update_ingest_job(job_id, self.origin, "done", draft=draft)
+            self.metrics["done"] += 1
+        except Exception as e:
+            await self.database.update_ingest_job(job_id, self.origin, "failed", error=f"{type(e).__name__}: {e}")
+            self.metrics["failed"] += 1
+        self.metrics["last_duration"] = asyncio.get_running_loop().time() - started
+        return True
+
+    async def _loop(self):
+        while True:
+            # cleared before looking, so a job queued while we look still wakes us
+            self._wakeup.clear()
+            try:
+                if await self.run_once():
+                    continue
+            except Exception as e:
+                self.metrics["errors"] += 1
+                print(f"Ingest worker failed: {e}")
+            # jobs queued by other processes are picked up on the next poll
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._loop()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        await self.ollama.close()
@@ -1,41 +1,201 @@
+import asyncio
+import hashlib
 import json
 import os
+import threading
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
 
-import instaloader
-from instaloader import Post, Profile
+from api.service import config
+from api.service.cache import LRUCache
 
-L = instaloader.Instaloader()
-L.load_session_from_file("CHANGE_THIS_TO_YOUR_USERNAME - It was `mahasvan.exe` previously")
 
+class InstaPost(NamedTuple):
+    shortcode: str
+    caption: str
+    image_url: str
 
-def clear_folder(username):
-    if not os.path.exists(username):
-        os.makedirs(username)
-    for file in os.listdir(username):
-        os.remove(os.path.join("snuc_cc", file))
 
+class InstagramClient:
+    """The network side of fetching posts, so the fetcher can be driven by a fake."""
 
-def get_latest_post(username):
-    clear_folder(username=username)
-    for post in Profile.from_username(L.context, username).get_posts():
-        print(post.caption)
-        L.download_post(post, target=username)
-        break
-    files = os.listdir(username)
-    image_file = next(file for file in files if file.endswith("jpg"))
-    caption_file = next(file for file in files if file.endswith("txt"))
-    caption = open(os.path.join(username, caption_file)).read()
-    image = open(os.path.join(username, image_file), "rb").read()
-    # image is returned as bytes, kjust save onmto a file and when pittong it to ollama, jist pass in the file patrh where you save in
+    def latest_post(self, username: str) -> Optional[InstaPost]:
+        raise NotImplementedError
 
-    return caption, image
+    def download_image(self, post: InstaPost) -> bytes:
+        raise NotImplementedError
 
 
-# todo: add vision model interfacing
-# the get_latest_post endpoint gives binary data for the image, need to encode it into base64 and pass it into ollama via cURL
-# https://ollama.com/library/llava - API Usage Section
+class InstaloaderClient(InstagramClient):
+    """
+    Instagram through instaloader, signed in with a saved session.
 
-# SIGN IN TO INSTA
-# https://instaloader.github.io/troubleshooting.html#login-error
-# you need Firefox in Windows or macOS
-# The cookies from firefox are used here
+    The session is loaded on the first request rather than at import, so the app starts
+    without instaloader or a session file, and only /ai routes fail when they are missing.
+    """
+
+    def __init__(self, session_user: Optional[str] = config.INSTA_SESSION_USER):
+        self.session_user = session_user
+        self._loader = None
+        self._lock = threading.Lock()
+
+    @property
+    def loader(self):
+        with self._lock:
+            if self._loader is None:
+                import instaloader
+
+                loader = instaloader.Instaloader()
+                if self.session_user:
+                    # sign in with the cookies saved by `instaloader --login` or the firefox import script,
+                    # see https://instaloader.github.io/troubleshooting.html#login-error
+                    loader.load_session_from_file(self.session_user)
+                self._loader = loader
+            return self._loader
+
+    def latest_post(self, username: str) -> Optional[InstaPost]:
+        from instaloader import Profile
+
+        for post in Profile.from_username(self.loader.context, username).get_posts():
+            return InstaPost(post.shortcode, post.caption or "", post.url)
+        return None
+
+    def download_image(self, post: InstaPost) -> bytes:
+        return self.loader.context.get_raw(post.image_url).content
+
+
+class FakeInstagramClient(InstagramClient):
+    """Serves fixed posts, keyed by username, and counts the calls made to it."""
+
+    def __init__(self, posts: Optional[Dict[str, Tuple[str, str, bytes]]] = None, delay: float = 0):
+        # username -> (shortcode, caption, image)
+        self.posts = dict(posts or {})
+        self.delay = delay
+        self.lookups = 0
+        self.downloads = 0
+
+    def latest_post(self, username: str) -> Optional[InstaPost]:
+        self.lookups += 1
+        time.sleep(self.delay)
+        if username not in self.posts:
+            return None
+        shortcode, caption, _ = self.posts[username]
+        return InstaPost(shortcode, caption, f"fake://{username}/{shortcode}")
+
+    def download_image(self, post: InstaPost) -> bytes:
+        self.downloads += 1
+        time.sleep(self.delay)
+        for shortcode, _, image in self.posts.values():
+            if shortcode == post.shortcode:
+                return image
+        raise ValueError(f"Unknown post {post.shortcode}")
+
+
+class InstaFetcher:
+    """
+    Latest posts of Instagram accounts, with their caption and image.
+
+    Posts never change once published, so they are stored on disk by shortcode and kept for
+    `retention` seconds, pruned on startup and after every `prune_every` posts stored; which post is
+    an account's latest is remembered for `ttl` seconds.
+    Concurrent requests for one account share a single fetch, which runs off the event loop.
+    """
+
+    def __init__(
+        self,
+        client: Optional[InstagramClient] = None,
+        cache_dir: str = config.INSTA_CACHE_DIR,
+        ttl: float = config.INSTA_CACHE_TTL,
+        retention: float = config.INSTA_CACHE_RETENTION,
+        prune_every: int = config.INSTA_CACHE_PRUNE_EVERY,
+    ):
+        self.client = client or InstaloaderClient()
+        self.cache_dir = cache_dir
+        self.retention = retention
+        self.prune_every = prune_every
+        # posts stored since the last prune; fetches run on several threads
+        self._stored = 0
+        self._stored_lock = threading.Lock()
+        self.latest = LRUCache(maxsize=config.CACHE_SIZE, ttl=ttl)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        self.prune()
+
+    async def get_latest_post(self, username: str) -> Tuple[str, bytes]:
+        username = username.strip().lower()
+        future = self._inflight.get(username)
+        if future is None:
+            future = asyncio.ensure_future(asyncio.to_thread(self.fetch, username))
+            self._inflight[username] = future
+            future.add_done_callback(lambda _: self._inflight.pop(username, None))
+        # one caller going away must not cancel the fetch for the others
+        return await asyncio.shield(future)
+
+    def fetch(self, username: str) -> Tuple[str, bytes]:
+        """The caption and image of the account's latest post, blocking."""
+        shortcode = self.latest.get(username)
+        if shortcode is not None:
+            cached = self._read(shortcode)
+            if cached is not None:
+                return cached
+
+        post = self.client.latest_post(username)
+        if post is None:
+            raise ValueError(f"{username} has no posts")
+        cached = self._read(post.shortcode)
+        if cached is None:
+            cached = post.caption, self.client.download_image(post)
+            self._write(post.shortcode, *cached)
+        self.latest.set(username, post.shortcode)
+        return cached
+
+    def _path(self, shortcode: str, suffix: str) -> str:
+        # shortcodes are [A-Za-z0-9_-], safe as file names
+        return os.path.join(self.cache_dir, f"{shortcode}{suffix}")
+
+    def _read(self, shortcode: str) -> Optional[Tuple[str, bytes]]:
+        try:
+            with open(self._path(shortcode, ".json")) as file:
+                meta = json.load(file)
+            if meta["fetched_at"] + self.retention < time.time():
+                return None
+            with open(self._path(shortcode, ".jpg"), "rb") as file:
+                image = file.read()
+        except (OSError, ValueError, KeyError):
+            return None
+        # an image that does not match its digest was cut short, fetch it again
+        if hashlib.sha256(image).hexdigest() != meta["sha256"]:
+            return None
+        return meta["caption"], image
+
+    def _write(self, shortcode: str, caption: str, image: bytes):
+        meta = {"caption": caption, "sha256": hashlib.sha256(image).hexdigest(), "fetched_at": time.time()}
+        # written to temporary files and renamed, so readers in other workers never see half a post
+        for suffix, content in ((".jpg", image), (".json", json.dumps(meta).encode())):
+            path = self._path(shortcode, suffix)
+            temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary, "wb") as file:
+                file.write(content)
+            os.replace(temporary, path)
+
+        with self._stored_lock:
+            self._stored += 1
+            due = self._stored >= self.prune_every
+            if due:
+                self._stored = 0
+        if due:
+            self.prune()
+
+    def prune(self) -> int:
+        """Delete the posts stored longer than `retention` seconds, returning how many."""
+        removed = 0
+        cutoff = time.time() - self.retention
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += name.endswith(".json")
+            except OSError:
+                continue
+        return removed
@@ -0,0 +1,320 @@
+import time
+from typing import Callable, List, NamedTuple
+
+import sqlalchemy as db
+from sqlalchemy import Column, Table, func
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable  # (connection, database)
+
+
+MIGRATIONS: List[Migration] = []
+
+# the migrations applied to a database, by version
+_schema_version = Table(
+    "schema_version",
+    db.MetaData(),
+    Column("version", db.Integer, primary_key=True, autoincrement=False),
+    Column("description", db.String, nullable=False),
+    Column("applied_at", db.Integer, nullable=False),
+)
+
+
+def migration(version: int, description: str):
+    def register(fn):
+        MIGRATIONS.append(Migration(version, description, fn))
+        return fn
+
+    return register
+
+
+def upgrade(database) -> List[int]:
+    """
+    Bring the database's schema up to date, returning the versions of the migrations applied.
+
+    A new database gets the latest schema from the table definitions and is marked as migrated.
+    An existing one gets its missing tables, then every migration it has not seen, each in its
+    own transaction.
+    """
+    with database.engine.begin() as connection:
+        fresh = not db.inspect(connection).has_table("events")
+        database.meta.create_all(connection)
+        _schema_version.create(connection, checkfirst=True)
+        if fresh:
+            _record(connection, MIGRATIONS)
+            return []
+        applied = set(connection.execute(db.select(_schema_version.c.version)).scalars())
+
+    done = []
+    for step in sorted(MIGRATIONS):
+        if step.version in applied:
+            continue
+        try:
+            with database.engine.begin() as connection:
+                step.apply(connection, database)
+                _record(connection, [step])
+        except db.exc.IntegrityError:
+            # another worker starting up applied it first
+            continue
+        print(f"Applied migration {step.version}: {step.description}")
+        done.append(step.version)
+    return done
+
+
+def _record(connection, steps: List[Migration]):
+    if steps:
+        now = int(time.time())
+        connection.execute(
+            _schema_version.insert(),
+            [{"version": step.version, "description": step.description, "applied_at": now} for step in steps],
+        )
+
+
+def _add_column(connection, table: Table, name: str) -> bool:
+    """Add the column as the table defines it, if it is missing. Returns whether it was added."""
+    existing = {column["name"] for column in db.inspect(connection).get_columns(table.name)}
+    if name in existing:
+        return False
+    ddl = db.schema.CreateColumn(table.c[name]).compile(dialect=connection.dialect)
+    connection.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {ddl}")
+    return True
+
+
+def _create_index(connection, name: str, table: str, columns: List[str], unique: bool = False, where: str = None):
+    """
+    Create an index if it is missing.
+
+    Written out rather than taken from the table definitions, which only hold the latest indexes.
+    """
+    sql = f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"
+    if where:
+        sql += f" WHERE {where}"
+    connection.exec_driver_sql(sql)
+
+
+def _drop_index(connection, name: str):
+    connection.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+
+
+# the queue tables registrations were moved out of once offered or confirmed, until migration 7
+_legacy_queues = {
+    name: db.table(
+        name,
+        db.column("user_id"),
+        db.column("event_id"),
+        db.column("registration_timestamp"),
+        db.column("registration_id"),
+    )
+    for name in ("waitlist", "pendinglist")
+}
+
+
+def _count_seats(events):
+    # the seats held by confirmed and pending registrations, before migration 7
+    registrations = db.table("registrations", db.column("event_id"))
+    pendinglist = _legacy_queues["pendinglist"]
+    confirmed = db.select(func.count()).where(registrations.c.event_id == events.c.event_id).scalar_subquery()
+    pending = db.select(func.count()).where(pendinglist.c.event_id == events.c.event_id).scalar_subquery()
+    return confirmed + pending
+
+
+@migration(1, "columns missing from the first database files")
+def _first_columns(connection, database):
+    tables = database.meta.tables
+    for name in ("price", "on_duty", "rating", "club_id"):
+        _add_column(connection, tables["events"], name)
+    _add_column(connection, tables["users"], "user_type")
+
+
+@migration(2, "seat counters on events")
+def _seats_taken(connection, database):
+    events = database.meta.tables["events"]
+    if _add_column(connection, events, "seats_taken"):
+        connection.execute(events.update().values(seats_taken=_count_seats(events)))
+
+
+@migration(3, "rating totals on events and clubs")
+def _rating_totals(connection, database):
+    events = database.meta.tables["events"]
+    added = _add_column(connection, events, "rating_sum")
+    added = _add_column(connection, events, "rating_count") or added
+    if not added:
+        return
+
+    # existing ratings only kept their running average, count each as one rating
+    connection.execute(
+        events.update().where(events.c.rating.is_not(None)).values(rating_sum=events.c.rating, rating_count=1)
+    )
+    totals = (
+        db.select(
+            events.c.club_id,
+            func.sum(events.c.rating_sum),
+            func.sum(events.c.rating_count),
+            func.sum(events.c.rating_sum) / func.sum(events.c.rating_count),
+        )
+        .where(events.c.club_id.is_not(None))
+        .where(events.c.rating_count > 0)
+        .group_by(events.c.club_id)
+    )
+    connection.execute(
+        database.meta.tables["club_ratings"]
+        .insert()
+        .from_select(["club_id", "rating_sum", "rating_count", "average_rating"], totals)
+    )
+
+
+@migration(4, "event categories join table")
+def _event_categories(connection, database):
+    # backfill the join table from the comma-joined column
+    events = database.meta.tables["events"]
+    event_categories = database.meta.tables["event_categories"]
+    if connection.execute(db.select(event_categories).limit(1)).first():
+        return
+    rows = connection.execute(db.select(events.c.event_id, events.c.categories)).fetchall()
+    values = [
+        {"event_id": event_id, "category": category}
+        for event_id, categories in rows
+        for category in database._normalize_categories((categories or "").split(","))
+    ]
+    if values:
+        connection.execute(event_categories.insert(), values)
+
+
+@migration(5, "indexes for event search, the waitlist queues and the expiry sweep")
+def _search_and_queue_indexes(connection, database):
+    _create_index(connection, "ix_events_start_time", "events", ["start_time"])
+    _create_index(connection, "ix_events_end_time", "events", ["end_time"])
+    _create_index(connection, "ix_events_event_location", "events", ["event_location"])
+    _create_index(connection, "ix_events_club_id", "events", ["club_id"])
+    _create_index(connection, "ix_event_categories_category", "event_categories", ["category", "event_id"])
+    _create_index(connection, "ix_club_ratings_average_rating", "club_ratings", ["average_rating"])
+    _create_index(connection, "ix_waitlist_event_id_timestamp", "waitlist", ["event_id", "registration_timestamp"])
+    _create_index(connection, "ix_pendinglist_registration_timestamp", "pendinglist", ["registration_timestamp"])
+
+
+@migration(6, "indexes for registration lookups, and one registration per user and event")
+def _registration_indexes(connection, database):
+    registrations = db.table(
+        "registrations", db.column("registration_id"), db.column("user_id"), db.column("event_id")
+    )
+
+    # keep the oldest of duplicate registrations (ids are time ordered), and give back the seats of the others
+    keep = db.select(func.min(registrations.c.registration_id)).group_by(
+        registrations.c.user_id, registrations.c.event_id
+    )
+    duplicates = connection.execute(
+        db.select(registrations.c.registration_id, registrations.c.event_id)
+        .where(registrations.c.user_id.is_not(None))
+        .where(registrations.c.registration_id.not_in(keep))
+    ).fetchall()
+    if duplicates:
+        connection.execute(
+            registrations.delete().where(registrations.c.registration_id.in_([row[0] for row in duplicates]))
+        )
+        events = database.meta.tables["events"]
+        connection.execute(
+            events.update()
+            .where(events.c.event_id.in_({row[1] for row in duplicates}))
+            .values(seats_taken=_count_seats(events))
+        )
+        print(f"Removed {len(duplicates)} duplicate registrations")
+
+    _create_index(connection, "ux_registrations_user_id_event_id", "registrations", ["user_id", "event_id"], unique=True)
+    _create_index(connection, "ix_registrations_event_id", "registrations", ["event_id"])
+    _create_index(connection, "ix_waitlist_user_id", "waitlist", ["user_id"])
+    _create_index(connection, "ix_pendinglist_user_id", "pendinglist", ["user_id"])
+
+
+@migration(7, "registration states in the registrations table, replacing the waitlist and pendinglist tables")
+def _registration_states(connection, database):
+    registrations = database.meta.tables["registrations"]
+    _add_column(connection, registrations, "status")
+    _add_column(connection, registrations, "registration_timestamp")
+
+    # the one-registration rule now only covers live registrations
+    _drop_index(connection, "ux_registrations_user_id_event_id")
+    _drop_index(connection, "ix_registrations_event_id")
+
+    inspector = db.inspect(connection)
+    # the first database files have no key on registration_id, and every status read is a lookup by it
+    if "registration_id" not in inspector.get_pk_constraint("registrations")["constrained_columns"]:
+        _create_index(connection, "ux_registrations_registration_id", "registrations", ["registration_id"], unique=True)
+
+    existing = inspector.get_table_names()
+    # offers first, so a user both offered and waiting for an event keeps the offer
+    for name, status in (("pendinglist", "pending"), ("waitlist", "waiting")):
+        if name not in existing:
+            continue
+        queue = _legacy_queues[name]
+        taken = (
+            db.select(registrations.c.registration_id)
+            .where(
+                db.or_(
+                    registrations.c.registration_id == queue.c.registration_id,
+                    db.and_(
+                        registrations.c.user_id == queue.c.user_id,
+                        registrations.c.event_id == queue.c.event_id,
+                    ),
+                )
+            )
+            .exists()
+        )
+        rows = db.select(
+            queue.c.registration_id,
+            queue.c.user_id,
+            queue.c.event_id,
+            db.literal(status),
+            queue.c.registration_timestamp,
+        ).where(~taken)
+        connection.execute(
+            registrations.insert().from_select(
+                ["registration_id", "user_id", "event_id", "status", "registration_timestamp"], rows
+            )
+        )
+        connection.exec_driver_sql(f"DROP TABLE {name}")
+
+    for index in registrations.indexes:
+        index.create(connection, checkfirst=True)
+
+
+@migration(8, "version stamps on events")
+def _event_versions(connection, database):
+    _add_column(connection, database.meta.tables["events"], "version")
+
+
+@migration(9, "unpaid registrations count towards one registration per user and event")
+def _unpaid_registrations(connection, database):
+    _drop_index(connection, "ux_registrations_live_user_id_event_id")
+    _create_index(
+        connection,
+        "ux_registrations_live_user_id_event_id",
+        "registrations",
+        ["user_id", "event_id"],
+        unique=True,
+        where="status IN ('waiting', 'pending', 'unpaid', 'confirmed')",
+    )
+
+
+@migration(10, "payment orders belong to a registration")
+def _payment_order_registrations(connection, database):
+    _add_column(connection, database.meta.tables["payment_orders"], "registration_id")
+
+
+@migration(11, "payment orders are looked up by registration")
+def _payment_order_registration_index(connection, database):
+    _create_index(connection, "ix_payment_orders_registration_id", "payment_orders", ["registration_id"])
+
+
+@migration(12, "catalogue and leaderboard versions are counters")
+def _version_counters(connection, database):
+    tables = database.meta.tables
+    # carry on from the sums the versions were before, so no tag a client holds comes round again
+    catalogue = connection.execute(db.select(func.coalesce(func.sum(tables["events"].c.version), 0))).scalar()
+    leaderboard = connection.execute(db.select(func.coalesce(func.sum(tables["club_ratings"].c.rating_count), 0))).scalar()
+    connection.execute(
+        tables["versions"].insert(),
+        [{"name": "catalogue", "version": catalogue}, {"name": "leaderboard", "version": leaderboard}],
+    )
@@ -1,9 +1,20 @@
+import asyncio
+import collections
+import copy
+import hashlib
+import random
 import requests
 import json
 import base64
-from typing import List, Dict, Optional, Any, Union
+import threading
+from typing import List, Dict, Optional, Any, Tuple
 from datetime import datetime
 
+import httpx
+
+from api.service import config, imaging
+from api.service.cache import LRUCache
+
 # Define the fields we want to extract from images with their data types
 EXTRACTABLE_FIELDS = {
     "title": str,
@@ -19,21 +30,68 @@ EXTRACTABLE_FIELDS = {
     }
 }
 
-class OllamaService:
-    def __init__(self, host: str = "http://localhost:11434"):
-        """Initialize Ollama service with host URL"""
+# bump whenever the prompt or the parsing of its answer changes, so cached extractions are redone
+PROMPT_VERSION = 1
+
+# answers worth asking again for: the server is loading the model, overloaded or restarting
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class _OllamaBase:
+    """The prompt, the parsing of the model's answer, and the cache of extractions shared by both clients"""
+
+    def __init__(
+        self,
+        host: str = config.OLLAMA_HOST,
+        model: str = config.OLLAMA_MODEL,
+        cache_size: int = config.OLLAMA_CACHE_SIZE,
+        target_size: int = config.VISION_TARGET_SIZE,
+        dedupe_distance: int = config.VISION_DEDUPE_DISTANCE,
+    ):
         self.base_url = host
-        self.model = "llava"  # Default model for image processing
-    
-    def _make_request(self, endpoint: str, payload: dict) -> dict:
-        """Make a POST request to Ollama API"""
-        url = f"{self.base_url}/{endpoint}"
-        try:
-            response = requests.post(url, json=payload)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            raise Exception(f"Failed to communicate with Ollama: {str(e)}")
+        self.model = model  # vision model used for image processing
+        self.target_size = target_size
+        self.dedupe_distance = dedupe_distance
+        # extractions by image, caption, model and prompt version
+        self.cache = LRUCache(maxsize=cache_size)
+        # perceptual hashes of the images extracted, by the rest of their cache key
+        self._phashes = LRUCache(maxsize=cache_size)
+        self._phash_lock = threading.Lock()
+
+    def _prepare(self, image_base64: str) -> Tuple[str, str]:
+        """The image to send, shrunk to the model's input size, and the digest its extraction is cached under"""
+        if self.target_size and imaging.available():
+            try:
+                prepared = imaging.prepare_image(base64.b64decode(image_base64), self.target_size)
+                # by perceptual hash, so a poster posted again or recompressed is not extracted again
+                return base64.b64encode(prepared.data).decode(), f"p{prepared.phash}"
+            except ValueError:
+                pass  # not something Pillow reads, let the model try it as it is
+        return image_base64, hashlib.sha256(image_base64.encode()).hexdigest()
+
+    def _cache_key(self, digest: str, caption: str) -> str:
+        caption_digest = hashlib.sha256(caption.encode()).hexdigest()[:16]
+        rest = f"{caption_digest}:{self.model}:{self.target_size}:{PROMPT_VERSION}"
+        # without a caption nothing tells two posters from one template apart, so only an exact hash is a repeat
+        if digest.startswith("p") and self.dedupe_distance and caption.strip():
+            digest = self._nearest_phash(digest, rest)
+        return f"{digest}:{rest}"
+
+    def _nearest_phash(self, digest: str, rest: str) -> str:
+        # recompressing flips a few bits of the hash, so a poster seen before is one within
+        # `dedupe_distance` bits. only posters with the same caption are compared: one club's
+        # posters made from a template differ as little, and only their text tells them apart
+        phash = int(digest[1:], 16)
+        with self._phash_lock:
+            known = self._phashes.get(rest)
+            if known is None:
+                known = collections.deque(maxlen=32)
+                self._phashes.set(rest, known)
+            for other in known:
+                if bin(phash ^ int(other[1:], 16)).count("1") <= self.dedupe_distance:
+                    return other
+            known.append(digest)
+        return digest
 
     def _validate_and_convert_type(self, field: str, value: Any) -> Any:
         """Validate and convert the value to the expected type"""
@@ -111,17 +169,8 @@ class OllamaService:
                         extracted_data[field] = value
             return extracted_data
 
-    def get_image_extract(self, image_base64: str, caption: str = "") -> Dict[str, Any]:
-        """
-        Extract information from an image using Ollama's vision model
-        
-        Args:
-            image_base64: Base64 encoded image string
-            caption: Optional caption or context about the image
-        
-        Returns:
-            Dictionary containing extracted fields and their values with proper types
-        """
+    def _build_payload(self, image_base64: str, caption: str = "") -> dict:
+        """The generate request asking the model for the event fields in the image"""
         prompt = f"""
         Analyze this image{f' of {caption}' if caption else ''} and extract the following event information if visible:
         
@@ -138,37 +187,174 @@ class OllamaService:
         Please respond in a JSON format with these fields. Use null for fields that cannot be determined from the image.
         """
 
-        payload = {
+        return {
             "model": self.model,
             "prompt": prompt,
             "images": [image_base64],
             "stream": False
         }
 
+    def _parse_response(self, response: dict) -> Dict[str, Any]:
+        """The typed fields of a generate response"""
+        # Extract JSON data from response text
+        extracted_data = self._extract_json_from_text(response['response'])
+
+        # Validate and convert types for each field, only keeping non-None values
+        validated_data = {}
+        for field in EXTRACTABLE_FIELDS.keys():
+            if field in extracted_data:
+                value = self._validate_and_convert_type(field, extracted_data[field])
+                if value is not None:  # Only include non-None values
+                    validated_data[field] = value
+
+        return validated_data
+
+
+class OllamaService(_OllamaBase):
+    def __init__(self, host: str = config.OLLAMA_HOST, timeout: float = config.OLLAMA_TIMEOUT, **kwargs):
+        """Initialize Ollama service with host URL"""
+        super().__init__(host, **kwargs)
+        self.timeout = timeout
+        # one session, so connections to the server are reused between calls
+        self.session = requests.Session()
+
+    def _make_request(self, endpoint: str, payload: dict) -> dict:
+        """Make a POST request to Ollama API"""
+        url = f"{self.base_url}/{endpoint}"
         try:
-            response = self._make_request("generate", payload)
-            
-            # Extract JSON data from response text
-            extracted_data = self._extract_json_from_text(response['response'])
-            
-            # Validate and convert types for each field, only keeping non-None values
-            validated_data = {}
-            for field in EXTRACTABLE_FIELDS.keys():
-                if field in extracted_data:
-                    value = self._validate_and_convert_type(field, extracted_data[field])
-                    if value is not None:  # Only include non-None values
-                        validated_data[field] = value
-            
-            return validated_data
+            response = self.session.post(url, json=payload, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"Failed to communicate with Ollama: {str(e)}")
+
+    def get_image_extract(self, image_base64: str, caption: str = "") -> Dict[str, Any]:
+        """
+        Extract information from an image using Ollama's vision model
 
+        Args:
+            image_base64: Base64 encoded image string
+            caption: Optional caption or context about the image
+
+        Returns:
+            Dictionary containing extracted fields and their values with proper types
+        """
+        image_base64, digest = self._prepare(image_base64)
+        key = self._cache_key(digest, caption)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return copy.deepcopy(cached)
+
+        try:
+            response = self._make_request("api/generate", self._build_payload(image_base64, caption))
+            validated_data = self._parse_response(response)
         except Exception as e:
             print(f"Error processing image: {str(e)}")
             return {}  # Return empty dict instead of null fields
 
+        self.cache.set(key, validated_data)
+        return copy.deepcopy(validated_data)
+
     def is_available(self) -> bool:
         """Check if Ollama service is available"""
         try:
-            response = requests.get(f"{self.base_url}/api/tags")
+            response = self.session.get(f"{self.base_url}/api/tags", timeout=self.timeout)
             return response.status_code == 200
-        except:
+        except requests.exceptions.RequestException:
             return False
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncOllamaService(_OllamaBase):
+    """
+    Ollama client for the async routes and batch jobs.
+
+    Connections are pooled, at most `concurrency` requests are in flight at once (the server runs one
+    model, more only queue there), and failed requests are retried with exponential backoff.
+    Identical extractions in flight at the same time share one request.
+    """
+
+    def __init__(
+        self,
+        host: str = config.OLLAMA_HOST,
+        timeout: float = config.OLLAMA_TIMEOUT,
+        concurrency: int = config.OLLAMA_CONCURRENCY,
+        retries: int = config.OLLAMA_RETRIES,
+        backoff: float = config.OLLAMA_BACKOFF,
+        **kwargs,
+    ):
+        super().__init__(host, **kwargs)
+        self.retries = retries
+        self.backoff = backoff
+        self.client = httpx.AsyncClient(
+            base_url=host,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+        )
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    async def _make_request(self, endpoint: str, payload: dict) -> dict:
+        """POST to the Ollama API, retrying transport errors and retryable statuses"""
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._semaphore:
+                    response = await self.client.post(f"/{endpoint}", json=payload)
+                if response.status_code not in RETRY_STATUSES:
+                    response.raise_for_status()
+                    return response.json()
+                error = httpx.HTTPStatusError(
+                    f"Ollama answered {response.status_code}", request=response.request, response=response
+                )
+            except httpx.TransportError as e:
+                error = e
+            if attempt < self.retries:
+                # full jitter, so retries from concurrent requests spread out
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+        raise Exception(f"Failed to communicate with Ollama: {str(error)}")
+
+    async def get_image_extract(self, image_base64: str, caption: str = "") -> Dict[str, Any]:
+        """Extract the event fields from an image, as OllamaService.get_image_extract does"""
+        # decoding and shrinking the image is cpu work, keep it off the event loop
+        image_base64, digest = await asyncio.to_thread(self._prepare, image_base64)
+        key = self._cache_key(digest, caption)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return copy.deepcopy(cached)
+
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._extract(key, image_base64, caption))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return copy.deepcopy(await asyncio.shield(future))
+
+    async def _extract(self, key: str, image_base64: str, caption: str) -> Dict[str, Any]:
+        try:
+            response = await self._make_request("api/generate", self._build_payload(image_base64, caption))
+            validated_data = self._parse_response(response)
+        except Exception as e:
+            print(f"Error processing image: {str(e)}")
+            return {}  # failures are not cached, the next call asks again
+
+        self.cache.set(key, validated_data)
+        return validated_data
+
+    async def get_image_extracts(self, images: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+        """Extract several images at once, each given as {"image": base64, "caption": text}, in order"""
+        return await asyncio.gather(
+            *(self.get_image_extract(image["image"], image.get("caption", "")) for image in images)
+        )
+
+    async def is_available(self) -> bool:
+        """Check if Ollama service is available"""
+        try:
+            response = await self.client.get("/api/tags")
+            return response.status_code == 200
+        except httpx.HTTPError:
+            return False
+
+    async def close(self):
+        await self.client.aclose()
@@ -0,0 +1,117 @@
+import base64
+import csv
+import io
+import json
+from collections.abc import Mapping
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+from api.service import config
+from api.service.response import dumps, format_response
+
+FORMATS = ("json", "ndjson", "csv")
+
+
+def encode_cursor(key: Any) -> str:
+    """An opaque token for the position after `key`."""
+    return base64.urlsafe_b64encode(json.dumps({"after": key}).encode()).decode().rstrip("=")
+
+
+def decode_cursor(token: str) -> Any:
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded))["after"]
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Invalid cursor")
+
+
+def _chunked(pieces: Iterable[bytes], size: int = 64 * 1024) -> Iterator[bytes]:
+    # starlette moves to a worker thread for every chunk, so send rows in blocks rather than one by one
+    buffer = []
+    buffered = 0
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= size:
+            yield b"".join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def json_stream(rows: Iterable) -> Iterator[bytes]:
+    # the same envelope as format_response, written a block of rows at a time
+    def pieces():
+        yield b'{"status_code":200,"response":['
+        for number, row in enumerate(rows):
+            yield (b"," if number else b"") + dumps(row)
+        yield b"]}"
+
+    return _chunked(pieces())
+
+
+def ndjson_stream(rows: Iterable) -> Iterator[bytes]:
+    return _chunked(dumps(row) + b"\n" for row in rows)
+
+
+def csv_stream(rows: Iterable, fields: List[str]) -> Iterator[bytes]:
+    def pieces():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(fields)
+        for row in rows:
+            writer.writerow([row.get(field) for field in fields] if isinstance(row, Mapping) else [row])
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue().encode()
+
+    return _chunked(pieces())
+
+
+async def list_response(
+    request: Request,
+    database,
+    method: str,
+    fields: List[str],
+    key: Callable = lambda row: row,
+    format: str = "json",
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+):
+    """
+    Serve a list endpoint from the database generator `method(after=..., limit=...)`.
+
+    With a cursor or a limit, JSON is returned a page at a time with the cursor of the next page.
+    Otherwise every row from the cursor on is streamed as JSON, NDJSON or CSV, and memory use does
+    not grow with the table.
+    """
+    if format not in FORMATS:
+        raise ValueError(f"Unknown format {format}, use one of {', '.join(FORMATS)}")
+    after = decode_cursor(cursor) if cursor else None
+    if limit is not None:
+        limit = max(1, min(limit, config.LIST_MAX_PAGE_SIZE))
+
+    if format == "json" and (cursor or limit):
+        limit = limit or config.LIST_PAGE_SIZE
+
+        def page(db):
+            # one row more than the page tells us whether there is a next page
+            return list(getattr(db, method)(after=after, limit=limit + 1))
+
+        rows = await database.unit_of_work(page)
+        next_cursor = encode_cursor(key(rows[limit - 1])) if len(rows) > limit else None
+        return format_response(
+            status_code=200, data={"items": rows[:limit], "next_cursor": next_cursor}, request=request
+        )
+
+    # the generator runs on starlette's thread pool as the client reads
+    rows = getattr(database, method)(after=after, limit=limit)
+    if format == "ndjson":
+        return StreamingResponse(ndjson_stream(rows), media_type="application/x-ndjson")
+    if format == "csv":
+        return StreamingResponse(csv_stream(rows, fields), media_type="text/csv")
+    return StreamingResponse(json_stream(rows), media_type="application/json")
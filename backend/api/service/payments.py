@@ -0,0 +1,274 @@
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from api.service import config
+
+
+class PaymentError(Exception):
+    """The gateway could not be reached, answered in time, or did what was asked."""
+
+
+class CircuitOpenError(PaymentError):
+    pass
+
+
+class PaymentGateway:
+    """The calls made to the payment provider, so the service can be driven by a fake."""
+
+    def create_order(self, amount: int, currency: str, receipt: str, notes: dict, timeout: float) -> dict:
+        """Create an order for `amount` in the currency's smallest unit, returning it with its "id"."""
+        raise NotImplementedError
+
+    def find_order(self, receipt: str, timeout: float) -> Optional[dict]:
+        """The order created with `receipt`, if there is one."""
+        raise NotImplementedError
+
+    def validate_vpa(self, vpa: str, timeout: float) -> bool:
+        raise NotImplementedError
+
+
+class RazorpayGateway(PaymentGateway):
+    def __init__(self, client):
+        # a razorpay.Client; extra keyword arguments of its calls go to requests, timeouts included
+        self.client = client
+
+    def create_order(self, amount: int, currency: str, receipt: str, notes: dict, timeout: float) -> dict:
+        data = {"amount": amount, "currency": currency, "receipt": receipt, "notes": notes, "payment": {"capture": "automatic"}}
+        return self.client.order.create(data, timeout=timeout)
+
+    def find_order(self, receipt: str, timeout: float) -> Optional[dict]:
+        orders = self.client.order.all({"receipt": receipt}, timeout=timeout).get("items", [])
+        return orders[0] if orders else None
+
+    def validate_vpa(self, vpa: str, timeout: float) -> bool:
+        account = self.client.payment.validateVpa({"vpa": vpa}, timeout=timeout)
+        return bool(account and account.get("success", True))
+
+
+class FakeGateway(PaymentGateway):
+    """
+    An in-memory gateway, for running without Razorpay keys and for trying out failures.
+
+    Every call takes `latency` seconds; while `failing` is set, calls raise PaymentError.
+    """
+
+    def __init__(self, latency: float = 0, failing: bool = False):
+        self.latency = latency
+        self.failing = failing
+        self.orders = {}
+        self.calls = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _call(self, timeout: float):
+        with self._lock:
+            self.calls += 1
+        # like requests, give up once the timeout passes
+        time.sleep(min(self.latency, timeout))
+        if self.latency > timeout:
+            raise PaymentError("Timed out")
+        if self.failing:
+            raise PaymentError("Gateway unavailable")
+
+    def create_order(self, amount: int, currency: str, receipt: str, notes: dict, timeout: float) -> dict:
+        self._call(timeout)
+        with self._lock:
+            order = {"id": f"order_fake{next(self._ids):010d}", "amount": amount, "currency": currency,
+                     "receipt": receipt, "notes": notes, "status": "created"}
+            self.orders[order["id"]] = order
+        return order
+
+    def find_order(self, receipt: str, timeout: float) -> Optional[dict]:
+        self._call(timeout)
+        return next((order for order in self.orders.values() if order["receipt"] == receipt), None)
+
+    def validate_vpa(self, vpa: str, timeout: float) -> bool:
+        self._call(timeout)
+        return "@" in vpa
+
+    def capture(self, order_id: str, secret: str = config.RAZORPAY_WEBHOOK_SECRET) -> Tuple[bytes, str]:
+        """Pay an order in full, returning the webhook Razorpay would send for it and its signature."""
+        order = self.orders[order_id]
+        with self._lock:
+            payment_id = f"pay_fake{next(self._ids):010d}"
+        payment = {"id": payment_id, "order_id": order_id, "amount": order["amount"], "currency": order["currency"],
+                   "status": "captured"}
+        body = json.dumps({"event": "payment.captured", "payload": {"payment": {"entity": payment}}}).encode()
+        return body, hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def verify_webhook_signature(body: bytes, signature: Optional[str], secret: str = config.RAZORPAY_WEBHOOK_SECRET) -> bool:
+    """Whether the X-Razorpay-Signature of a webhook, an HMAC-SHA256 of its raw body, is right."""
+    expected = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature or "")
+
+
+def parse_capture(body: bytes) -> Optional[dict]:
+    """The payment_captures row for a webhook, or None for events other than an order's payment being captured."""
+    event = json.loads(body)
+    if event.get("event") != "payment.captured":
+        return None
+    payment = event["payload"]["payment"]["entity"]
+    if not payment.get("order_id"):
+        return None
+    return {
+        "payment_id": payment["id"],
+        "order_id": payment["order_id"],
+        "amount": payment["amount"],
+        "currency": payment["currency"],
+        "payload": body.decode(),
+    }
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing gateway for a while.
+
+    After `threshold` failures in a row the circuit opens and calls fail at once. Once `reset_after`
+    seconds have passed, one call is let through to try the gateway again: if it succeeds the circuit
+    closes, otherwise it opens for another `reset_after` seconds.
+    """
+
+    def __init__(self, threshold: int = config.PAYMENT_BREAKER_THRESHOLD, reset_after: float = config.PAYMENT_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.reset_after else "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return
+            if state == "half-open" and not self._trial:
+                self._trial = True
+                return
+        raise CircuitOpenError("Payments are unavailable right now, try again shortly")
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+
+class PaymentService:
+    """
+    Payment gateway calls for the async routes.
+
+    Calls run on their own thread pool, so a slow gateway neither blocks the event loop nor takes
+    the threads of database calls, and each is given up on after `timeout` seconds. Failures and
+    timeouts trip a circuit breaker. Orders are created at most once per registration: retries get
+    the order made the first time.
+    """
+
+    def __init__(
+        self,
+        gateway: PaymentGateway,
+        database,
+        timeout: float = config.PAYMENT_TIMEOUT,
+        workers: int = config.PAYMENT_WORKERS,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.gateway = gateway
+        self.database = database
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="payments")
+
+        self.metrics = {"calls": 0, "failures": 0, "timeouts": 0, "rejected": 0, "reused": 0}
+
+    async def _call(self, fn, *args):
+        try:
+            self.breaker.allow()
+        except CircuitOpenError:
+            self.metrics["rejected"] += 1
+            raise
+
+        self.metrics["calls"] += 1
+        future = asyncio.get_running_loop().run_in_executor(self._executor, fn, *args, self.timeout)
+        try:
+            # the gateway is given the timeout too; this bounds the wait if it overruns it
+            result = await asyncio.wait_for(future, self.timeout + 1)
+        except asyncio.TimeoutError:
+            self.metrics["timeouts"] += 1
+            self.breaker.record_failure()
+            raise PaymentError("The payment gateway did not answer in time")
+        except Exception as e:
+            self.metrics["failures"] += 1
+            self.breaker.record_failure()
+            raise PaymentError(f"Payment gateway error: {e}") from e
+        self.breaker.record_success()
+        return result
+
+    @staticmethod
+    def idempotency_key(registration_id: int) -> str:
+        # doubles as the order's receipt, which razorpay caps at 40 characters
+        return f"registration_{registration_id:x}"
+
+    async def create_order(
+        self, registration_id: int, user_id: int, event_id: int, amount: float, currency: str = "INR"
+    ) -> str:
+        """The id of the order paying for the registration, created on the first call."""
+        key = self.idempotency_key(registration_id)
+        amount = int(round(amount * 100))  # in paise
+        order = await self.database.claim_payment_order(key, registration_id, user_id, event_id, amount, currency)
+        if order["order_id"]:
+            self.metrics["reused"] += 1
+            return order["order_id"]
+        if not order["claimed"]:
+            raise ValueError("The payment for this registration is being created, try again shortly")
+
+        try:
+            created = None
+            if order["attempts"] > 1:
+                # an earlier attempt may have created the order before timing out
+                created = await self._call(self.gateway.find_order, key)
+            if created is None:
+                notes = {"registration_id": str(registration_id), "user_id": str(user_id), "event_id": str(event_id)}
+                created = await self._call(self.gateway.create_order, amount, currency, key, notes)
+        except BaseException:
+            await self.database.release_payment_order(key)
+            raise
+        await self.database.complete_payment_order(key, created["id"])
+        return created["id"]
+
+    async def validate_vpa(self, vpa: str) -> bool:
+        return await self._call(self.gateway.validate_vpa, vpa)
+
+    def start(self):
+        pass
+
+    async def stop(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def from_config(database) -> PaymentService:
+    if config.PAYMENT_GATEWAY == "fake":
+        return PaymentService(FakeGateway(), database)
+    import razorpay
+
+    client = razorpay.Client(auth=(config.RAZORPAY_KEY_ID, config.RAZORPAY_KEY_SECRET))
+    return PaymentService(RazorpayGateway(client), database)
@@ -0,0 +1,218 @@
+import asyncio
+import time
+from typing import Callable, List, Optional
+
+from api.service import config
+from api.service.coordination import Coordination, LocalCoordination
+from api.service.db import RECONCILE_OUTCOMES
+
+# captures of other workers may commit a little after newer ones, so each sweep looks this many
+# seconds behind the newest capture reconciled so far
+WATERMARK_SLACK = 60
+
+
+class CaptureWriter:
+    """
+    Stores the captures webhooks report, many to a commit.
+
+    A webhook waits until its capture is committed, so Razorpay is only told it arrived once it is
+    safe. Captures that come in while a batch is being written, or within `linger` seconds of the
+    first, go in the next commit together, so a rush of callbacks costs a few commits, not one each.
+    """
+
+    def __init__(
+        self,
+        database,
+        batch_size: int = config.PAYMENT_CAPTURE_BATCH,
+        linger: float = config.PAYMENT_CAPTURE_LINGER,
+        on_flush: Optional[Callable[[], None]] = None,
+    ):
+        self.database = database
+        self.batch_size = batch_size
+        self.linger = linger
+        self.on_flush = on_flush
+        self._pending = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+        self.metrics = {"captures": 0, "commits": 0, "errors": 0, "largest_batch": 0}
+
+    async def add(self, capture: dict):
+        """Store the capture, returning once it is committed."""
+        if self._task is None:
+            raise RuntimeError("The capture writer is not running")
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((capture, future))
+        self._wakeup.set()
+        await future
+
+    async def _flush(self, batch: List[tuple]):
+        now = int(time.time())
+        try:
+            await self.database.add_payment_captures([{**capture, "received_at": now} for capture, _ in batch])
+        except Exception as e:
+            self.metrics["errors"] += 1
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.metrics["captures"] += len(batch)
+        self.metrics["commits"] += 1
+        self.metrics["largest_batch"] = max(self.metrics["largest_batch"], len(batch))
+        for _, future in batch:
+            # the webhook may have given up waiting
+            if not future.done():
+                future.set_result(None)
+        if self.on_flush is not None:
+            self.on_flush()
+
+    async def _loop(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            if len(self._pending) < self.batch_size:
+                # let the callbacks arriving alongside this one share its commit
+                await asyncio.sleep(self.linger)
+            batch, self._pending = self._pending[: self.batch_size], self._pending[self.batch_size :]
+            await self._flush(batch)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # the captures still waiting are written before we go
+        while self._pending:
+            batch, self._pending = self._pending[: self.batch_size], self._pending[self.batch_size :]
+            await self._flush(batch)
+
+
+class PaymentReconciler:
+    """
+    Background task that matches stored captures to registrations in batches, off the request path.
+
+    Each run confirms the unpaid registrations whose payment was captured, then expires the holds
+    whose payment never came, giving their seats to the waitlist. Captures are reconciled first, so a
+    payment captured just before its hold runs out still confirms it. Last, the holds without a gateway
+    order get one, as the seats of paid events offered to waiters do. Pending waitlist offers of free
+    events are expired by their own sweep, scheduler.PendingExpiryScheduler.
+
+    With several workers, only the one holding the "payment-reconciliation" lease reconciles.
+    """
+
+    def __init__(
+        self,
+        database,
+        interval: float = config.PAYMENT_RECONCILE_INTERVAL,
+        batch_size: int = config.PAYMENT_RECONCILE_BATCH,
+        coordination: Optional[Coordination] = None,
+        payments=None,
+    ):
+        self.database = database
+        # a PaymentService; without one, holds that lack an order are left to expire
+        self.payments = payments
+        self.coordination = coordination or LocalCoordination()
+        self.interval = interval
+        self.batch_size = batch_size
+        self._watermark = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+        self.metrics = {
+            "runs": 0,
+            "reconciled": 0,
+            **dict.fromkeys(RECONCILE_OUTCOMES, 0),
+            "expired": 0,
+            "orders": 0,
+            "order_errors": 0,
+            "errors": 0,
+            "last_run": None,
+            "last_duration": 0.0,
+            "max_lag": 0,
+            "leader": False,
+        }
+
+    def notify(self):
+        """Reconcile now rather than on the next interval, for captures just stored."""
+        self._wakeup.set()
+
+    async def run_once(self) -> int:
+        started = time.monotonic()
+        reconciled = 0
+        while True:
+            result = await self.database.reconcile_payments(
+                batch_size=self.batch_size, since=max(0, self._watermark - WATERMARK_SLACK)
+            )
+            self._watermark = max(self._watermark, result["watermark"])
+            reconciled += result["reconciled"]
+            for outcome in ("reconciled", *RECONCILE_OUTCOMES):
+                self.metrics[outcome] += result[outcome]
+            self.metrics["max_lag"] = max(self.metrics["max_lag"], result["max_lag"])
+            # a short batch means the backlog has been drained
+            if result["reconciled"] < self.batch_size:
+                break
+
+        while True:
+            result = await self.database.expire_unpaid(batch_size=self.batch_size)
+            self.metrics["expired"] += result["expired"]
+            if result["expired"] < self.batch_size:
+                break
+
+        if self.payments is not None:
+            await self._create_orders()
+
+        self.metrics["runs"] += 1
+        self.metrics["last_run"] = int(time.time())
+        self.metrics["last_duration"] = time.monotonic() - started
+        return reconciled
+
+    async def _create_orders(self):
+        # one batch a run: the gateway is slow, and the holds left over get their orders next run
+        holds = await self.database.unpaid_without_order(batch_size=self.batch_size)
+        for hold in holds:
+            try:
+                await self.payments.create_order(hold["registration_id"], hold["user_id"], hold["event_id"], hold["price"])
+                self.metrics["orders"] += 1
+            except Exception:
+                # retried next run, until the hold expires
+                self.metrics["order_errors"] += 1
+
+    async def _loop(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                # the lease outlives a few missed runs, so it only moves when its holder is gone
+                leader = await asyncio.to_thread(
+                    self.coordination.acquire_lease, "payment-reconciliation", self.interval * 3
+                )
+                self.metrics["leader"] = leader
+                if leader:
+                    await self.run_once()
+            except Exception as e:
+                self.metrics["errors"] += 1
+                print(f"Payment reconciliation failed: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
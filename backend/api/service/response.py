@@ -1,10 +1,85 @@
-from typing import Any
+import datetime
+import hashlib
+import json
+from collections.abc import Mapping
+from typing import Any, Optional
 
+from fastapi import Request, Response
 from fastapi.responses import JSONResponse
+from sqlalchemy.engine import Row
 
+try:
+    import orjson
+except ImportError:  # optional, responses fall back to the standard library
+    orjson = None
 
-def format_response(status_code=200, data: Any = None):
-    return JSONResponse({
-        "status_code": status_code,
-        "response": data
-    })
+
+def _default(value):
+    # database rows are serialized as they come, without building a dict per row first
+    if isinstance(value, Row):
+        return value._asdict()
+    if isinstance(value, Mapping):
+        return dict(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(data: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson when it is installed, and able to render database rows."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def resource_etag(*parts) -> str:
+    """A strong ETag for the representation identified by `parts`, such as a resource and its version."""
+    return f'"{hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()}"'
+
+
+def if_none_match(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    # If-None-Match compares weakly, so W/ prefixes don't matter
+    return header.strip() == "*" or etag in {tag.strip().removeprefix("W/") for tag in header.split(",")}
+
+
+def _cache_headers(etag: str, max_age: Optional[int]) -> dict:
+    headers = {"ETag": etag}
+    if max_age is not None:
+        headers["Cache-Control"] = f"public, max-age={max_age}"
+    return headers
+
+
+def not_modified(etag: str, max_age: Optional[int] = None) -> Response:
+    return Response(status_code=304, headers=_cache_headers(etag, max_age))
+
+
+def format_response(
+    status_code=200,
+    data: Any = None,
+    request: Optional[Request] = None,
+    etag: Optional[str] = None,
+    max_age: Optional[int] = None,
+):
+    body = {"status_code": status_code, "response": data}
+    if request is None:
+        return FastJSONResponse(body)
+
+    # read-only endpoints pass the request, and get an ETag so clients can revalidate their copy.
+    # it is the resource's version when the caller knows it, else a hash of the body
+    content = dumps(body)
+    if etag is None:
+        etag = f'"{hashlib.blake2b(content, digest_size=16).hexdigest()}"'
+    if if_none_match(request, etag):
+        return not_modified(etag, max_age)
+    return Response(content, media_type="application/json", headers=_cache_headers(etag, max_age))
@@ -0,0 +1,29 @@
+from bisect import bisect_left
+from itertools import accumulate
+from typing import Iterable, List, Tuple
+
+
+class Schedule:
+    """
+    A user's booked time intervals, sorted so that overlap checks are a binary search.
+
+    Intervals are half-open: an event ending at 10:00 does not collide with one starting at 10:00.
+    """
+
+    def __init__(self, intervals: Iterable[Tuple[int, int]] = ()):
+        intervals = sorted((start, end) for start, end in intervals if start is not None and end is not None)
+        self._starts = [start for start, _ in intervals]
+        # the latest end time among the first i + 1 intervals
+        self._max_ends = list(accumulate((end for _, end in intervals), max))
+
+    def __len__(self):
+        return len(self._starts)
+
+    def collides(self, start: int, end: int) -> bool:
+        # only intervals starting before `end` can overlap,
+        # and one of them does if the latest of their ends is after `start`
+        count = bisect_left(self._starts, end)
+        return count > 0 and self._max_ends[count - 1] > start
+
+    def collisions(self, events: Iterable[dict]) -> List[dict]:
+        return [event for event in events if self.collides(event["start_time"], event["end_time"])]
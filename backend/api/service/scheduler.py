@@ -0,0 +1,87 @@
+import asyncio
+import time
+from typing import Optional
+
+from api.service import config
+from api.service.coordination import Coordination, LocalCoordination
+
+
+class PendingExpiryScheduler:
+    """
+    Background task that expires pending offers in batches, off the request path.
+
+    Metrics record how many offers were expired and how far past their deadline they were
+    when the sweep reached them (the expiry lag).
+
+    With several workers, only the one holding the "pending-expiry" lease sweeps.
+    """
+
+    def __init__(
+        self,
+        database,
+        interval: float = config.EXPIRY_INTERVAL,
+        batch_size: int = config.EXPIRY_BATCH_SIZE,
+        coordination: Optional[Coordination] = None,
+    ):
+        self.database = database
+        self.coordination = coordination or LocalCoordination()
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task = None
+
+        self.metrics = {
+            "runs": 0,
+            "expired": 0,
+            "errors": 0,
+            "last_run": None,
+            "last_duration": 0.0,
+            "last_lag": 0,
+            "max_lag": 0,
+            "leader": False,
+        }
+
+    async def run_once(self) -> int:
+        started = time.monotonic()
+        expired = 0
+        lag = 0
+        while True:
+            result = await self.database.expire_pending(batch_size=self.batch_size)
+            expired += result["expired"]
+            lag = max(lag, result["max_lag"])
+            # a short batch means the backlog has been drained
+            if result["expired"] < self.batch_size:
+                break
+
+        self.metrics["runs"] += 1
+        self.metrics["expired"] += expired
+        self.metrics["last_run"] = int(time.time())
+        self.metrics["last_duration"] = time.monotonic() - started
+        self.metrics["last_lag"] = lag
+        self.metrics["max_lag"] = max(self.metrics["max_lag"], lag)
+        return expired
+
+    async def _loop(self):
+        while True:
+            try:
+                # the lease outlives a few missed sweeps, so it only moves when its holder is gone
+                leader = await asyncio.to_thread(self.coordination.acquire_lease, "pending-expiry", self.interval * 3)
+                self.metrics["leader"] = leader
+                if leader:
+                    await self.run_once()
+            except Exception as e:
+                self.metrics["errors"] += 1
+                print(f"Pending expiry sweep failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
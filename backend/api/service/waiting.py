@@ -1,15 +1,61 @@
-from collections import defaultdict, deque
+import heapq
+import threading
+from collections import defaultdict
+from typing import Iterable, Optional
 
 
 class EventWaitingList:
-    # singleton class
-    _instance = None
+    """
+    In-memory mirror of the waitlist table, with one queue per event.
 
-    def __new__(cls, *args, **kwargs):
-        if EventWaitingList._instance is None:
-            EventWaitingList._instance = object.__new__(cls)
-            EventWaitingList._instance.__init__(*args, **kwargs)
-        return EventWaitingList._instance
+    Each event's queue is a heap ordered by registration timestamp, so enqueueing and promoting
+    are O(log n). Cancelled entries are dropped lazily when they reach the head of their queue.
+    The table stays the source of truth; the mirror is rebuilt from it on startup, and every
+    worker process keeps its own, updated with the changes the other workers publish.
+    """
+
+    def __init__(self):
+        # event id -> heap of (registration timestamp, registration id)
+        self.waiting = defaultdict(list)
+        # registration id -> (event id, registration timestamp) of the live entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self, entries: Iterable[dict]):
+        with self._lock:
+            self.waiting.clear()
+            self._entries.clear()
+            for entry in entries:
+                self._push(entry["event_id"], entry["registration_id"], entry["registration_timestamp"])
+            for heap in self.waiting.values():
+                heapq.heapify(heap)
+
+    def _push(self, event_id: int, registration_id: int, timestamp: int):
+        self._entries[registration_id] = (event_id, timestamp)
+        self.waiting[event_id].append((timestamp, registration_id))
+
+    def enqueue(self, event_id: int, registration_id: int, timestamp: int):
+        with self._lock:
+            self._entries[registration_id] = (event_id, timestamp)
+            heapq.heappush(self.waiting[event_id], (timestamp, registration_id))
+
+    def cancel(self, registration_id: int):
+        with self._lock:
+            self._entries.pop(registration_id, None)
+
+    def peek(self, event_id: int) -> Optional[int]:
+        """The registration id at the head of the event's queue, if any."""
+        with self._lock:
+            heap = self.waiting.get(event_id)
+            while heap:
+                timestamp, registration_id = heap[0]
+                if self._entries.get(registration_id) == (event_id, timestamp):
+                    return registration_id
+                # cancelled, promoted or re-queued since it was pushed
+                heapq.heappop(heap)
+            self.waiting.pop(event_id, None)
+            return None
 
-    def __init__(self, *args, **kwargs):
-        self.waiting = defaultdict(lambda: deque())
@@ -1,16 +1,37 @@
 import importlib
 import importlib.util
 import json
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 
-from api.service import db
-import razorpay
+from api.service import aiodb, config, coordination, db, payments, scheduler
 
-app = FastAPI()
 
-app.database = db.Database("database.db")
-app.razorpay_client = razorpay.Client(auth=("key_id", "key_secret"))
+@asynccontextmanager
+async def lifespan(app):
+    for service in app.background:
+        service.start()
+    yield
+    for service in reversed(app.background):
+        await service.stop()
+    app.database.shutdown()
+    app.coordination.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# every worker process runs this module, and so gets its own database instance and caches
+app.coordination = coordination.from_url(config.COORDINATION_URL)
+app.database = aiodb.AsyncDatabase(
+    db.Database(config.DATABASE_URL, coordination=app.coordination), mode=config.DB_MODE, workers=config.DB_EXECUTOR_WORKERS
+)
+app.coordination_listener = coordination.CoordinationListener(app.coordination)
+app.coordination_listener.subscribe("changes", app.database.database.apply_changes)
+app.expiry_scheduler = scheduler.PendingExpiryScheduler(app.database, coordination=app.coordination)
+app.payments = payments.from_config(app.database)
+# background tasks started with the app and stopped in reverse; routers add their own in setup
+app.background = [app.coordination_listener, app.expiry_scheduler, app.payments]
 
 
 @app.get("/")
@@ -30,4 +51,5 @@ for route in routes:
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # workers need the import string, as each process imports the app itself
+    uvicorn.run("app:app", host="0.0.0.0", port=8000, workers=config.WORKERS)
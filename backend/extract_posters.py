@@ -0,0 +1,170 @@
+"""
+Extract event details from a folder of posters with the Ollama vision model.
+
+    python extract_posters.py posters/ -o posters.jsonl
+    python extract_posters.py insta_cache/ -o insta.jsonl --workers 4
+
+Every image under the folder is sent to Ollama by a pool of worker processes, and one JSON line per
+image is appended to the output as soon as it is done. Images are identified by their content, so
+running the command again with the same output skips the images already extracted and retries the
+failed ones. Captions are read from a sidecar file next to the image: the .json files of the insta
+cache, or the .txt files instaloader downloads.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterator, Optional, Set, Tuple
+
+from api.service import config
+from api.service.ollama import OllamaService
+
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png", ".webp")
+
+# the service of each worker process, so its connections are reused between images
+_service: Optional[OllamaService] = None
+
+
+def _start_worker(host: str, model: str, timeout: float, target_size: int):
+    global _service
+    _service = OllamaService(host, timeout=timeout, model=model, target_size=target_size)
+
+
+def _caption(path: str) -> str:
+    stem = os.path.splitext(path)[0]
+    try:
+        with open(f"{stem}.json") as file:
+            return json.load(file).get("caption", "")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        with open(f"{stem}.txt") as file:
+            return file.read()
+    except OSError:
+        return ""
+
+
+def _extract(path: str) -> dict:
+    # runs in a worker process
+    started = time.perf_counter()
+    with open(path, "rb") as file:
+        image_base64 = base64.b64encode(file.read()).decode()
+    caption = _caption(path)
+    image_base64, _ = _service._prepare(image_base64)
+    # asked directly rather than through get_image_extract, which hides failures behind an empty result
+    response = _service._make_request("api/generate", _service._build_payload(image_base64, caption))
+    return {"caption": caption, "fields": _service._parse_response(response), "seconds": time.perf_counter() - started}
+
+
+def find_images(folder: str) -> Iterator[str]:
+    for root, _, files in os.walk(folder):
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_SUFFIXES):
+                yield os.path.join(root, name)
+
+
+def _digest(path: str) -> str:
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def load_checkpoint(output: str) -> Set[str]:
+    """The digests of the images the output already has extractions for."""
+    done = set()
+    try:
+        with open(output) as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line of an interrupted run may be cut short
+                    continue
+                if "error" not in entry:
+                    done.add(entry["sha256"])
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def run(folder: str, output: str, workers: int = config.OLLAMA_CONCURRENCY, host: str = config.OLLAMA_HOST,
+        model: str = config.OLLAMA_MODEL, timeout: float = config.OLLAMA_TIMEOUT,
+        target_size: int = config.VISION_TARGET_SIZE) -> Tuple[int, int, int]:
+    """Extract every image in `folder` not yet in `output`, returning the (extracted, failed, skipped) counts."""
+    done = load_checkpoint(output)
+    pending = {}
+    skipped = 0
+    for path in find_images(folder):
+        digest = _digest(path)
+        # the same poster saved twice is extracted once
+        if digest in done:
+            skipped += 1
+            continue
+        done.add(digest)
+        pending[path] = digest
+
+    print(f"{len(pending)} images to extract, {skipped} already done or duplicates")
+    extracted = failed = 0
+    started = time.perf_counter()
+    with open(output, "a+b") as out, ProcessPoolExecutor(
+        max_workers=workers, initializer=_start_worker, initargs=(host, model, timeout, target_size)
+    ) as pool:
+        # a line left unfinished by an interrupted run must not swallow the first new one
+        if out.tell():
+            out.seek(-1, os.SEEK_END)
+            if out.read(1) != b"\n":
+                out.write(b"\n")
+        futures = {pool.submit(_extract, path): path for path in pending}
+        try:
+            for future in as_completed(futures):
+                path = futures[future]
+                entry = {"path": os.path.relpath(path, folder), "sha256": pending[path]}
+                try:
+                    entry.update(future.result())
+                    extracted += 1
+                except Exception as e:
+                    entry["error"] = f"{type(e).__name__}: {e}"
+                    failed += 1
+                out.write(json.dumps(entry).encode() + b"\n")
+                # each line is on disk before the next, so an interrupted run resumes from here
+                out.flush()
+                os.fsync(out.fileno())
+
+                finished = extracted + failed
+                if finished % 10 == 0 or finished == len(pending):
+                    rate = finished / (time.perf_counter() - started)
+                    print(f"{finished}/{len(pending)} images, {rate:.2f} images/s, {failed} failed")
+        except KeyboardInterrupt:
+            pool.shutdown(cancel_futures=True)
+            print("Interrupted, run again to resume")
+            raise
+
+    elapsed = time.perf_counter() - started
+    if pending:
+        print(f"Extracted {extracted} images in {elapsed:.1f}s ({extracted / elapsed:.2f} images/s), {failed} failed")
+    return extracted, failed, skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract event details from a folder of posters with Ollama.")
+    parser.add_argument("folder", help="folder of posters, searched recursively, such as the insta cache")
+    parser.add_argument("-o", "--output", default="extractions.jsonl", help="JSON lines file, appended to and resumed from")
+    parser.add_argument("-w", "--workers", type=int, default=config.OLLAMA_CONCURRENCY, help="parallel extractions")
+    parser.add_argument("--host", default=config.OLLAMA_HOST)
+    parser.add_argument("--model", default=config.OLLAMA_MODEL)
+    parser.add_argument("--timeout", type=float, default=config.OLLAMA_TIMEOUT, help="seconds to wait for each image")
+    parser.add_argument("--size", type=int, default=config.VISION_TARGET_SIZE, help="longest side sent to the model, 0 for as is")
+    args = parser.parse_args(argv)
+
+    try:
+        _, failed, _ = run(args.folder, args.output, args.workers, args.host, args.model, args.timeout, args.size)
+    except KeyboardInterrupt:
+        return 130
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
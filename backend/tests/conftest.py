@@ -0,0 +1,104 @@
+import os
+import secrets
+import time
+
+import pytest
+import sqlalchemy
+
+from api.service import db
+
+from .ollama_stub import StubOllama
+
+# a PostgreSQL server to run the database tests against as well, such as
+# postgresql+psycopg://postgres@localhost/postgres; each test gets a database of its own on it
+POSTGRES_URL = os.getenv("TEST_POSTGRES_URL")
+
+
+def pytest_addoption(parser):
+    parser.addoption("--bench", action="store_true", help="run the benchmarks as well")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--bench"):
+        return
+    skip = pytest.mark.skip(reason="benchmark, run with --bench")
+    for item in items:
+        if "bench" in item.keywords:
+            item.add_marker(skip)
+
+
+def report(name: str, **numbers):
+    """Print a benchmark's results on one line."""
+    print(f"\n{name}: " + ", ".join(f"{key}={value:.4g}" if isinstance(value, float) else f"{key}={value}" for key, value in numbers.items()))
+
+
+@pytest.fixture(scope="session")
+def postgres_server():
+    if not POSTGRES_URL:
+        pytest.skip("set TEST_POSTGRES_URL to run against PostgreSQL")
+    engine = sqlalchemy.create_engine(POSTGRES_URL, isolation_level="AUTOCOMMIT")
+    try:
+        engine.connect().close()
+    except Exception as e:
+        pytest.skip(f"no PostgreSQL server at TEST_POSTGRES_URL: {e}")
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def database_url(request, tmp_path):
+    """An empty database on each backend, the PostgreSQL one only when a server is configured."""
+    if request.param == "sqlite":
+        yield str(tmp_path / "database.db")
+        return
+
+    server = request.getfixturevalue("postgres_server")
+    name = f"test_{secrets.token_hex(6)}"
+    with server.connect() as connection:
+        connection.exec_driver_sql(f'CREATE DATABASE "{name}"')
+    yield server.url.set(database=name).render_as_string(hide_password=False)
+    with server.connect() as connection:
+        connection.exec_driver_sql(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+
+
+@pytest.fixture
+def database(database_url):
+    database = db.Database(database_url)
+    yield database
+    database.close()
+
+
+@pytest.fixture
+def make_event(database):
+    """Create an event, with a club to host it, starting an hour from now."""
+    clubs = []
+
+    def make_event(name: str = "Open Mic", limit: int = 10, price: float = 0.0, start_time: int = None):
+        if not clubs:
+            club_id = database.add_user("club", 1, [])
+            database.add_club(club_id, "Club")
+            clubs.append(club_id)
+        start_time = start_time or int(time.time()) + 3600
+        event_id = database.add_event(name, "Main Auditorium", ["music"], start_time, start_time + 3600, limit, clubs[0], price)
+        return database.get_event(event_id=event_id)
+
+    return make_event
+
+
+@pytest.fixture
+def make_users(database):
+    """Add `count` users in one transaction, returning their ids."""
+
+    def make_users(count: int, prefix: str = "user"):
+        with database.transaction():
+            return [database.add_user(f"{prefix}{number}", 2, []) for number in range(count)]
+
+    return make_users
+
+
+@pytest.fixture
+def ollama():
+    """A stub Ollama server on a local port; set its delay and failures before sending requests."""
+    server = StubOllama().start()
+    yield server
+    server.close()
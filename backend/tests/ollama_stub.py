@@ -0,0 +1,92 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# what the stub model says it sees on every poster
+ANSWER = {
+    "title": "Open Mic",
+    "description": "Songs and poems",
+    "date": "2026-11-20",
+    "time": "18:00",
+    "venue": "Main Auditorium",
+    "capacity": "120 seats",
+    "isPaid": "no",
+}
+
+
+class StubOllama:
+    """
+    A local HTTP server answering like Ollama, for the clients' tests.
+
+    Each generate request takes `delay` seconds, and the first `failures` of them are answered
+    with `status`. The payloads, the connections they came on and the most requests in flight at
+    once are recorded.
+    """
+
+    def __init__(self, delay: float = 0, failures: int = 0, status: int = 503):
+        self.delay = delay
+        self.failures = failures
+        self.status = status
+        self.requests = []
+        self.connections = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, so pooled clients reuse their connections
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                if self.path == "/api/tags":
+                    self._send(200, {"models": [{"name": "llava"}]})
+                else:
+                    self._send(404, {"error": "not found"})
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                status, body = stub._generate(payload, self.client_address)
+                self._send(status, body)
+
+            def _send(self, status: int, body: dict):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self._thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+
+    def _generate(self, payload: dict, client_address) -> tuple:
+        with self._lock:
+            self.requests.append(payload)
+            self.connections.add(client_address)
+            failing = len(self.requests) <= self.failures
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.delay)
+            if failing:
+                return self.status, {"error": "model is loading"}
+            return 200, {"model": payload["model"], "response": f"Here you go: {json.dumps(ANSWER)}", "done": True}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
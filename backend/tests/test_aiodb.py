@@ -0,0 +1,113 @@
+import asyncio
+import os
+import time
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from api.route import conference
+from api.service import aiodb, payments
+
+from .conftest import report
+
+# requests and how many are in flight at once in the load benchmark
+BENCH_REQUESTS = int(os.getenv("BENCH_REQUESTS", 2000))
+BENCH_CONCURRENCY = int(os.getenv("BENCH_CONCURRENCY", 50))
+
+
+async def ticks_during(call, duration: float = 0.3) -> int:
+    """Count the event loop's 10ms ticks while `call` runs for about `duration` seconds."""
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+    await call(lambda database: time.sleep(duration))
+    task.cancel()
+    return ticks
+
+
+def test_thread_mode_keeps_the_loop_running(database):
+    threaded = aiodb.AsyncDatabase(database, mode="thread")
+    inline = aiodb.AsyncDatabase(database, mode="inline")
+    try:
+        assert asyncio.run(ticks_during(threaded.unit_of_work)) >= 10
+        assert asyncio.run(ticks_during(inline.unit_of_work)) == 0
+    finally:
+        threaded._executor.shutdown()
+
+
+def test_unit_of_work_shares_one_session(database):
+    def lookup(database):
+        session = database._session.get()
+        with database.transaction() as inner:
+            return session is not None and inner is session
+
+    assert asyncio.run(aiodb.AsyncDatabase(database, mode="inline").unit_of_work(lookup))
+
+
+def test_methods_are_awaitable(database, make_event):
+    event = make_event()
+    facade = aiodb.AsyncDatabase(database, mode="thread", workers=2)
+    try:
+        assert asyncio.run(facade.get_event(event_id=event["event_id"]))["event_name"] == event["event_name"]
+    finally:
+        facade._executor.shutdown()
+
+
+def test_unknown_mode_is_rejected(database):
+    with pytest.raises(ValueError):
+        aiodb.AsyncDatabase(database, mode="fibers")
+
+
+async def load(app, path: str) -> dict:
+    """Send BENCH_REQUESTS requests to `path`, BENCH_CONCURRENCY at a time, and time them."""
+    limit = asyncio.Semaphore(BENCH_CONCURRENCY)
+    latencies = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+
+        async def request():
+            async with limit:
+                sent = time.perf_counter()
+                response = await client.get(path)
+                latencies.append(time.perf_counter() - sent)
+                assert response.status_code == 200
+
+        started = time.perf_counter()
+        await asyncio.gather(*(request() for _ in range(BENCH_REQUESTS)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests_per_second": BENCH_REQUESTS / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+
+@pytest.mark.bench
+@pytest.mark.parametrize("mode", ["inline", "thread"])
+def test_bench_concurrent_requests(database, make_event, make_users, mode):
+    event = make_event(limit=100)
+    users = make_users(100)
+    for user_id in users:
+        database.register_event(event["event_name"], user_id)
+
+    app = FastAPI()
+    app.database = aiodb.AsyncDatabase(database, mode=mode)
+    app.payments = payments.PaymentService(payments.FakeGateway(), app.database)
+    conference.setup(app)
+    try:
+        # an uncached query per request, with a join over the user's registrations
+        numbers = asyncio.run(load(app, f"/events/registered-events?user_id={users[0]}"))
+    finally:
+        if app.database._executor is not None:
+            app.database._executor.shutdown()
+    report(f"registered-events, {mode} mode", requests=BENCH_REQUESTS, concurrency=BENCH_CONCURRENCY, **numbers)
@@ -0,0 +1,62 @@
+import threading
+
+import pytest
+
+from api.service import db
+
+
+def test_url_selects_the_backend(database, database_url):
+    if "://" not in database_url:
+        assert database.is_sqlite
+    else:
+        assert database.engine.dialect.name == "postgresql"
+        # a pooled engine, checking connections before handing them out
+        assert database.engine.pool.size() == db.config.DB_POOL_SIZE
+        assert database.engine.pool._pre_ping
+
+
+def test_search_by_name(database, make_event):
+    event = make_event(name="Open Mic Night")
+    make_event(name="Chess Finals")
+    # full-text search on SQLite, substring matching elsewhere
+    assert [found["event_id"] for found in database.search_event(event_name="open mic")] == [event["event_id"]]
+
+
+def test_categories_filter(database, make_event):
+    event = make_event()
+    assert [found["event_id"] for found in database.search_event(categories=["Music"])] == [event["event_id"]]
+    assert database.search_event(categories=["chess"]) == []
+
+
+def test_concurrent_promotions_skip_locked_entries(database, make_event, make_users):
+    if database.is_sqlite:
+        pytest.skip("SQLite has a single writer, so promotions never run side by side")
+
+    event = make_event(limit=2)
+    users = make_users(4)
+    registration_ids = [database.register_event(event["event_name"], user_id)["registration_id"] for user_id in users]
+    waiting = set(registration_ids[2:])
+
+    locked = threading.Event()
+    release = threading.Event()
+    taken = {}
+
+    def promote_and_hold():
+        with database.transaction() as session:
+            taken["first"] = database._next_waiting(session, event["event_id"]).registration_id
+            locked.set()
+            # keep the row locked until the other promotion has picked its entry
+            release.wait(timeout=30)
+
+    holder = threading.Thread(target=promote_and_hold)
+    holder.start()
+    try:
+        assert locked.wait(timeout=30)
+        with database.transaction() as session:
+            # does not wait for the locked head of the queue, and takes the next entry instead
+            taken["second"] = database._next_waiting(session, event["event_id"]).registration_id
+    finally:
+        release.set()
+        holder.join()
+
+    assert {taken["first"], taken["second"]} == waiting
@@ -0,0 +1,135 @@
+import json
+import time
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api.route import conference, manage
+from api.service import aiodb, payments
+from api.service.bulk import parse_rows
+
+
+@pytest.fixture
+def client(database):
+    app = FastAPI()
+    app.database = aiodb.AsyncDatabase(database, mode="inline")
+    app.payments = payments.PaymentService(payments.FakeGateway(), app.database)
+    app.expiry_scheduler = None
+    conference.setup(app)
+    manage.setup(app)
+    with TestClient(app) as client:
+        yield client
+
+
+def upload(client, path: str, name: str, text: str) -> dict:
+    return client.post(path, files={"file": (name, text.encode())}).json()
+
+
+def new_event(name: str, club_id: int, categories="music") -> dict:
+    start_time = int(time.time()) + 3600
+    return {
+        "club_id": club_id,
+        "event_name": name,
+        "event_location": "Main Auditorium",
+        "categories": categories,
+        "start_time": start_time,
+        "end_time": start_time + 3600,
+        "limit": 10,
+        "price": 0.0,
+    }
+
+
+def test_rows_are_read_from_csv_and_json():
+    # with the byte order mark spreadsheet programs write
+    assert parse_rows(b"\xef\xbb\xbfname,user_id\nOpen Mic,1\n", filename="rows.csv") == [{"name": "Open Mic", "user_id": "1"}]
+    assert parse_rows(b'[{"name": "Open Mic"}, {"name": "Poetry Night"}]') == [{"name": "Open Mic"}, {"name": "Poetry Night"}]
+    assert parse_rows(b'{"name": "Open Mic"}\n\n{"name": "Poetry Night"}\n') == [{"name": "Open Mic"}, {"name": "Poetry Night"}]
+    # a JSON lines file whose first row happens to be an array
+    assert parse_rows(b'[1]\n{"name": "Open Mic"}\n') == [[1], {"name": "Open Mic"}]
+
+
+def test_rows_that_are_not_objects_are_left_to_the_caller():
+    assert parse_rows(b'[1, "Open Mic", null]') == [1, "Open Mic", None]
+    assert parse_rows(b'"Open Mic"\n[1, 2]\n') == ["Open Mic", [1, 2]]
+
+
+def test_a_malformed_line_is_reported_by_number():
+    with pytest.raises(ValueError, match="^Line 3 is not valid JSON"):
+        parse_rows(b'{"name": "Open Mic"}\n\n{"name": \n')
+
+
+def test_each_registration_row_is_accepted_or_rejected(client, make_event, make_users):
+    event = make_event(limit=1)
+    make_event(name="Paid Gig", price=100.0, start_time=int(time.time()) + 7200)
+    first, second, third = make_users(3)
+    rows = [
+        ("Open Mic", first),
+        ("Open Mic", "abc"),
+        ("Nowhere", second),
+        ("Open Mic", first),
+        ("Open Mic", second),
+        ("Paid Gig", third),
+        ("Open Mic", 999),
+    ]
+    text = "name,user_id\n" + "".join(f"{name},{user_id}\n" for name, user_id in rows)
+
+    results = upload(client, "/events/register-bulk", "rows.csv", text)["response"]
+    assert [result["row"] for result in results] == list(range(len(rows)))
+    assert [result.get("status") for result in results] == ["confirmed", None, None, None, "waiting", None, None]
+    assert "user_id" in results[1]["error"]
+    assert [result.get("error") for result in results[2:4] + results[5:]] == [
+        "Event not found",
+        "Already registered for this event",
+        "Paid events must be registered individually",
+        "User not found",
+    ]
+    assert client.app.database.database.get_event(event_id=event["event_id"])["seats_taken"] == 1
+
+
+def test_an_upload_without_rows_is_rejected(client):
+    assert upload(client, "/events/register-bulk", "rows.csv", "name,user_id\n")["status_code"] == 400
+
+
+def test_an_event_import_with_an_invalid_row_writes_nothing(client, database, make_event):
+    club_id = make_event()["club_id"]
+    rows = [new_event("Poetry Night", club_id), [1, 2], new_event("Poetry Night", club_id)]
+    text = "".join(json.dumps(row) + "\n" for row in rows)
+
+    reply = upload(client, "/manage/add-events-bulk", "events.jsonl", text)
+    assert reply["status_code"] == 400
+    assert [row["row"] for row in reply["response"]["rows"]] == [1, 2]
+    assert reply["response"]["rows"][1]["message"] == "Event name is repeated in the upload"
+
+    # names that are taken are only looked up once every row is valid
+    text = json.dumps(new_event("Poetry Night", club_id)) + "\n" + json.dumps(new_event("Open Mic", club_id)) + "\n"
+    reply = upload(client, "/manage/add-events-bulk", "events.jsonl", text)
+    assert reply["response"]["rows"] == [{"row": 1, "message": "Event name already exists"}]
+    assert database.get_existing_event_names(["Poetry Night"]) == set()
+
+
+def test_an_event_import_adds_every_row(client, database, make_event):
+    club_id = make_event()["club_id"]
+    rows = [new_event("Poetry Night", club_id, "poetry,art"), new_event("Jam Session", club_id)]
+    header = list(rows[0])
+    text = ",".join(header) + "\n" + "".join(",".join(f'"{row[field]}"' for field in header) + "\n" for row in rows)
+
+    reply = upload(client, "/manage/add-events-bulk", "events.csv", text)
+    assert reply["status_code"] == 200
+    events = [database.get_event(event_id=event_id) for event_id in reply["response"]]
+    assert [event["event_name"] for event in events] == ["Poetry Night", "Jam Session"]
+    assert sorted(events[0]["categories"]) == ["art", "poetry"]
+
+
+def test_events_are_added_in_one_transaction(database, make_event):
+    club_id = make_event()["club_id"]
+    events = [new_event("Poetry Night", club_id, ["poetry"]), new_event("Jam Session", club_id, ["music", "jam"])]
+
+    event_ids = database.add_events_bulk(events)
+    assert [database.get_event(event_id=event_id)["event_name"] for event_id in event_ids] == ["Poetry Night", "Jam Session"]
+    assert [event["event_id"] for event in database.search_event(categories=["jam"])] == [event_ids[1]]
+
+    # one taken name and none of them are added
+    with pytest.raises(ValueError, match="Event names already exist: Open Mic"):
+        database.add_events_bulk([new_event("Quiz Night", club_id, ["quiz"]), new_event("Open Mic", club_id, ["music"])])
+    assert database.get_existing_event_names(["Quiz Night"]) == set()
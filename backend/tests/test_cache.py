@@ -0,0 +1,100 @@
+import threading
+
+import pytest
+import sqlalchemy
+
+from api.service import cache as cache_module
+from api.service.cache import LRUCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A monotonic clock the test moves by hand."""
+    now = [1000.0]
+    monkeypatch.setattr(cache_module.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_entries_expire_after_their_ttl(clock):
+    cache = LRUCache(maxsize=4, ttl=10)
+    cache.set("a", 1)
+    clock[0] += 9.9
+    assert cache.get("a") == 1
+
+    clock[0] += 0.1
+    assert cache.get("a") is None
+    assert len(cache) == 0
+    assert cache.stats()["expirations"] == 1
+
+
+def test_the_least_recently_used_entry_is_evicted():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    # reading "a" makes "b" the least recently used
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (1, None, 3)
+    assert cache.stats()["evictions"] == 1
+    assert len(cache) == 2
+
+
+def test_a_value_read_before_an_invalidation_is_not_cached():
+    cache = LRUCache()
+    since = cache.token()
+    # a write to the key commits between the read and the set
+    cache.invalidate("a")
+    cache.set("a", "stale", since=since)
+    assert cache.get("a") is None
+    assert cache.stats()["rejections"] == 1
+
+    # other keys, and values read after the invalidation, are cached as usual
+    cache.set("b", "fresh", since=since)
+    cache.set("a", "fresh", since=cache.token())
+    assert (cache.get("a"), cache.get("b")) == ("fresh", "fresh")
+
+
+def test_a_clear_rejects_every_value_read_before_it():
+    cache = LRUCache()
+    since = cache.token()
+    cache.clear()
+    cache.set("a", "stale", since=since)
+    assert cache.get("a") is None
+
+
+def test_invalidations_it_no_longer_remembers_reject_conservatively():
+    cache = LRUCache(maxsize=2)
+    since = cache.token()
+    for key in ("a", "b", "c"):
+        cache.invalidate(key)
+    # "a" was forgotten to keep the invalidations bounded, so any value read before it is dropped
+    cache.set("d", "stale", since=since)
+    assert cache.get("d") is None
+    cache.set("d", "fresh", since=cache.token())
+    assert cache.get("d") == "fresh"
+
+
+def test_an_event_read_while_a_registration_commits_is_not_cached(database, make_event, make_users):
+    event = make_event()
+    (user_id,) = make_users(1)
+    database.event_map.clear()
+
+    def register_meanwhile(connection, cursor, statement, *args):
+        # the registration commits, and invalidates the event, after it was read
+        if statement.lstrip().startswith("SELECT") and "FROM events" in statement and not registered:
+            registered.append(True)
+            writer = threading.Thread(target=database.register_event, args=(event["event_name"], user_id))
+            writer.start()
+            writer.join()
+
+    registered = []
+    sqlalchemy.event.listen(database.engine, "after_cursor_execute", register_meanwhile)
+    try:
+        assert database.get_event(event_id=event["event_id"])["seats_taken"] == 0
+    finally:
+        sqlalchemy.event.remove(database.engine, "after_cursor_execute", register_meanwhile)
+
+    assert registered
+    assert database.event_map.get(event["event_id"]) is None
+    assert database.get_event(event_id=event["event_id"])["seats_taken"] == 1
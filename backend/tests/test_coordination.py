@@ -0,0 +1,153 @@
+import time
+from collections import defaultdict
+
+import pytest
+
+from api.service import coordination, db
+
+
+class FakeRedisServer:
+    """The state a Redis server would hold: keys with their expiry, and the pub/sub subscribers."""
+
+    def __init__(self):
+        self.values = {}
+        self.subscribers = defaultdict(list)
+
+
+class FakePubSub:
+    def __init__(self, server: FakeRedisServer):
+        self.server = server
+        self.queue = []
+        self.channels = []
+
+    def subscribe(self, channel: str):
+        self.channels.append(channel)
+        self.server.subscribers[channel].append(self.queue)
+
+    def get_message(self, timeout: float = 0):
+        return self.queue.pop(0) if self.queue else None
+
+    def close(self):
+        for channel in self.channels:
+            self.server.subscribers[channel].remove(self.queue)
+
+
+class FakeRedis:
+    """The few redis-py client methods RedisCoordination uses, over an in-memory server."""
+
+    def __init__(self, server: FakeRedisServer):
+        self.server = server
+
+    def publish(self, channel: str, message: str) -> int:
+        subscribers = self.server.subscribers[channel]
+        for queue in subscribers:
+            queue.append({"type": "message", "channel": channel.encode(), "data": message.encode()})
+        return len(subscribers)
+
+    def pubsub(self, ignore_subscribe_messages: bool = False) -> FakePubSub:
+        return FakePubSub(self.server)
+
+    def _live(self, key: str):
+        value = self.server.values.get(key)
+        if value is not None and value[1] < time.monotonic():
+            del self.server.values[key]
+            return None
+        return value
+
+    def set(self, key: str, value: str, nx: bool = False, px: int = None):
+        if nx and self._live(key) is not None:
+            return None
+        self.server.values[key] = (value.encode(), time.monotonic() + px / 1000 if px else float("inf"))
+        return True
+
+    def get(self, key: str):
+        value = self._live(key)
+        return value[0] if value else None
+
+    def pexpire(self, key: str, milliseconds: int) -> bool:
+        value = self._live(key)
+        if value is None:
+            return False
+        self.server.values[key] = (value[0], time.monotonic() + milliseconds / 1000)
+        return True
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def connect(request, tmp_path):
+    """Connect a worker to a coordination backend shared with the others connected by the test."""
+    server = FakeRedisServer()
+    connected = []
+
+    def connect():
+        if request.param == "sqlite":
+            backend = coordination.SQLiteCoordination(f"sqlite:///{tmp_path / 'coordination.db'}")
+        else:
+            backend = coordination.RedisCoordination(FakeRedis(server))
+        connected.append(backend)
+        return backend
+
+    yield connect
+    for backend in connected:
+        backend.close()
+
+
+def test_messages_reach_the_other_workers(connect):
+    first, second, third = connect(), connect(), connect()
+    first.publish("changes", [["invalidate", "events", 1]])
+
+    assert first.poll() == []
+    assert second.poll() == [("changes", [["invalidate", "events", 1]])]
+    assert third.poll() == [("changes", [["invalidate", "events", 1]])]
+    # each message is delivered once
+    assert second.poll() == []
+
+
+def test_one_worker_holds_a_lease(connect):
+    first, second = connect(), connect()
+    assert first.acquire_lease("pending-expiry", 0.2)
+    assert not second.acquire_lease("pending-expiry", 0.2)
+    # renewing our own lease
+    assert first.acquire_lease("pending-expiry", 0.2)
+
+    # its holder stopped renewing, so another worker takes it over
+    time.sleep(0.3)
+    assert second.acquire_lease("pending-expiry", 0.2)
+    assert not first.acquire_lease("pending-expiry", 0.2)
+
+
+def test_from_url():
+    assert isinstance(coordination.from_url("local"), coordination.LocalCoordination)
+    with pytest.raises(ValueError):
+        coordination.from_url("zookeeper://localhost")
+
+
+def test_workers_see_each_others_writes(tmp_path, connect):
+    path = str(tmp_path / "database.db")
+    first = db.Database(path, coordination=connect())
+    second = db.Database(path, coordination=connect())
+    listener = coordination.CoordinationListener(first.coordination)
+    listener.subscribe("changes", first.apply_changes)
+    try:
+        club_id = second.add_user("club", 1, [])
+        second.add_club(club_id, "Club")
+        start_time = int(time.time()) + 3600
+        event_id = second.add_event("Open Mic", "Main Auditorium", ["music"], start_time, start_time + 3600, 1, club_id)
+        users = [second.add_user(f"user{number}", 2, []) for number in range(2)]
+        listener.poll_once()
+
+        assert first.get_event(event_id=event_id)["seats_taken"] == 0
+        registered, waiting = [second.register_event("Open Mic", user_id)["registration_id"] for user_id in users]
+        # the first worker still serves the event from its cache until it hears of the write
+        assert first.get_event(event_id=event_id)["seats_taken"] == 0
+
+        assert listener.poll_once() > 0
+        assert first.get_event(event_id=event_id)["seats_taken"] == 1
+        # and its waitlist mirror has the registration the other worker queued
+        assert first.waiting_list.peek(event_id) == waiting
+
+        # a seat freed through the first worker goes to the head of the waitlist
+        first.cancel_registration(registered)
+        assert second.registration_status(waiting) == "pending"
+    finally:
+        second.close()
+        first.close()
@@ -0,0 +1,114 @@
+import threading
+from contextlib import contextmanager
+
+import pytest
+import sqlalchemy
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api.route import conference
+from api.service import aiodb, payments
+
+
+@pytest.fixture
+def client(database):
+    app = FastAPI()
+    app.database = aiodb.AsyncDatabase(database, mode="inline")
+    app.payments = payments.PaymentService(payments.FakeGateway(), app.database)
+    conference.setup(app)
+    with TestClient(app) as client:
+        yield client
+
+
+def revalidate(client, path: str, etag: str):
+    return client.get(path, headers={"If-None-Match": etag})
+
+
+@contextmanager
+def counted(database):
+    """Collect the statements the database runs."""
+    statements = []
+
+    def count(connection, cursor, statement, *args):
+        statements.append(statement)
+
+    sqlalchemy.event.listen(database.engine, "before_cursor_execute", count)
+    try:
+        yield statements
+    finally:
+        sqlalchemy.event.remove(database.engine, "before_cursor_execute", count)
+
+
+def test_an_unchanged_event_is_not_modified(client, database, make_event, make_users):
+    event = make_event()
+    path = f"/events/get-event/{event['event_id']}"
+    first = client.get(path)
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+
+    # answered from the version this worker has cached, without a query
+    with counted(database) as statements:
+        response = revalidate(client, path, etag)
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert statements == []
+
+    # a registration writes to the event, so the same tag gets the new version
+    database.register_event(event["event_name"], make_users(1)[0])
+    changed = revalidate(client, path, etag)
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert changed.json()["response"]["seats_taken"] == 1
+
+
+def test_search_results_follow_the_catalogue(client, database, make_event):
+    make_event()
+    path = "/events/search-event?categories=music"
+    etag = client.get(path).headers["ETag"]
+    assert revalidate(client, path, etag).status_code == 304
+
+    make_event(name="Poetry Night")
+    changed = revalidate(client, path, etag)
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert len(changed.json()["response"]) == 2
+
+
+def test_the_leaderboard_follows_the_ratings(client, database, make_event):
+    event = make_event()
+    path = "/events/leaderboard"
+    etag = client.get(path).headers["ETag"]
+    assert revalidate(client, path, etag).status_code == 304
+
+    database.update_event_rating(event["event_id"], 4)
+    changed = revalidate(client, path, etag)
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert changed.json()["response"][0]["average_rating"] == 4
+
+
+def test_a_version_read_while_a_write_commits_is_not_cached(database, make_event, make_users):
+    event = make_event()
+    (user_id,) = make_users(1)
+    before = database.catalogue_version(cached=False)
+    database.version_map.clear()
+
+    def register_meanwhile(connection, cursor, statement, *args):
+        # the registration commits, and invalidates the stamp, after the version was read
+        if "FROM versions" in statement and not registered:
+            registered.append(True)
+            writer = threading.Thread(target=database.register_event, args=(event["event_name"], user_id))
+            writer.start()
+            writer.join()
+
+    registered = []
+    sqlalchemy.event.listen(database.engine, "after_cursor_execute", register_meanwhile)
+    try:
+        assert database.catalogue_version(cached=False) in (before, before + 1)
+    finally:
+        sqlalchemy.event.remove(database.engine, "after_cursor_execute", register_meanwhile)
+
+    # the version read before the write was not kept, so the next read sees the write
+    assert registered
+    assert database.version_stamp("catalogue") is None
+    assert database.catalogue_version() == before + 1
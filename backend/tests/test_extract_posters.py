@@ -0,0 +1,77 @@
+import json
+
+import pytest
+
+import extract_posters
+
+from .ollama_stub import ANSWER
+
+
+@pytest.fixture
+def posters(tmp_path):
+    folder = tmp_path / "posters"
+    (folder / "nested").mkdir(parents=True)
+    for number in range(4):
+        (folder / f"poster{number}.jpg").write_bytes(f"poster {number}".encode())
+    # captions next to the image, as the insta cache and instaloader store them
+    (folder / "poster0.json").write_text(json.dumps({"caption": "Open Mic night"}))
+    (folder / "nested" / "poster4.png").write_bytes(b"poster 4")
+    (folder / "nested" / "poster4.txt").write_text("Quiz finals")
+    # the same poster saved twice
+    (folder / "nested" / "copy.jpg").write_bytes(b"poster 1")
+    (folder / "notes.md").write_text("not a poster")
+    return folder
+
+
+def read(output) -> list:
+    return [json.loads(line) for line in output.read_text().splitlines()]
+
+
+def test_extracts_every_poster_once(ollama, posters, tmp_path):
+    output = tmp_path / "out.jsonl"
+    assert extract_posters.run(str(posters), str(output), workers=2, host=ollama.url) == (5, 0, 1)
+
+    entries = {entry["path"]: entry for entry in read(output)}
+    assert len(entries) == 5
+    assert entries["poster0.jpg"]["caption"] == "Open Mic night"
+    assert entries["nested/poster4.png"]["caption"] == "Quiz finals"
+    assert entries["poster2.jpg"]["fields"]["title"] == ANSWER["title"]
+    assert entries["poster2.jpg"]["fields"]["capacity"] == 120
+    assert len(ollama.requests) == 5
+
+
+def test_workers_run_in_parallel(ollama, posters, tmp_path):
+    ollama.delay = 0.2
+    extract_posters.run(str(posters), str(tmp_path / "out.jsonl"), workers=3, host=ollama.url)
+    assert ollama.max_in_flight == 3
+
+
+def test_a_second_run_resumes(ollama, posters, tmp_path):
+    output = tmp_path / "out.jsonl"
+    extract_posters.run(str(posters), str(output), workers=2, host=ollama.url)
+    # the previous run was cut off in the middle of a line
+    with open(output, "a") as file:
+        file.write('{"path": "poster9.jpg", "sha')
+
+    assert extract_posters.run(str(posters), str(output), workers=2, host=ollama.url) == (0, 0, 6)
+    assert len(ollama.requests) == 5
+
+    (posters / "poster5.jpg").write_bytes(b"poster 5")
+    assert extract_posters.run(str(posters), str(output), workers=2, host=ollama.url) == (1, 0, 6)
+    # the new entry starts on a line of its own, after the cut one
+    lines = output.read_text().splitlines()
+    assert lines[-2] == '{"path": "poster9.jpg", "sha'
+    assert json.loads(lines[-1])["path"] == "poster5.jpg"
+
+
+def test_failed_posters_are_retried(ollama, posters, tmp_path, capsys):
+    output = tmp_path / "out.jsonl"
+    ollama.failures = 2
+    ollama.status = 500
+    assert extract_posters.main([str(posters), "-o", str(output), "-w", "1", "--host", ollama.url]) == 1
+    assert sum("error" in entry for entry in read(output)) == 2
+
+    assert extract_posters.main([str(posters), "-o", str(output), "-w", "1", "--host", ollama.url]) == 0
+    assert len(extract_posters.load_checkpoint(str(output))) == 5
+    # throughput is reported as it goes
+    assert "images/s" in capsys.readouterr().out
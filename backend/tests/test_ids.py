@@ -0,0 +1,187 @@
+import multiprocessing
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import pytest
+
+from api.service import assets, db
+
+from .conftest import report
+
+# rows the insert latency benchmark grows the users table to, and inserts timed at each size
+BENCH_ROWS = int(os.getenv("BENCH_ROWS", 1_000_000))
+BENCH_SAMPLES = int(os.getenv("BENCH_SAMPLES", 200))
+
+
+def fields(id_: int) -> tuple:
+    sequence = id_ & ((1 << assets.SEQUENCE_BITS) - 1)
+    node_id = (id_ >> assets.SEQUENCE_BITS) & ((1 << assets.NODE_BITS) - 1)
+    return id_ >> (assets.NODE_BITS + assets.SEQUENCE_BITS), node_id, sequence
+
+
+def test_ids_are_unique_and_increasing():
+    generator = assets.IdGenerator(node_id=5)
+    ids = [generator.next_id() for _ in range(10000)]
+    # more ids than one millisecond's sequence holds, so some waited for the next millisecond
+    assert ids == sorted(set(ids))
+    assert all(fields(id_)[1] == 5 for id_ in ids)
+    assert ids[-1] < 2 ** 53
+
+
+def test_threads_share_a_generator():
+    generator = assets.IdGenerator(node_id=1)
+    ids = []
+
+    def draw():
+        ids.extend(generator.next_id() for _ in range(2000))
+
+    threads = [threading.Thread(target=draw) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(ids)) == len(ids)
+
+
+def test_node_id_must_fit():
+    with pytest.raises(ValueError):
+        assets.IdGenerator(node_id=assets.MAX_NODES)
+
+
+def test_no_ids_are_issued_past_the_lease():
+    generator = assets.IdGenerator()
+    generator.lease(3, time.time() - 1)
+    with pytest.raises(RuntimeError, match="lease has run out"):
+        generator.next_id()
+    generator.valid_until = time.time() + 60
+    assert fields(generator.next_id())[1] == 3
+
+
+def test_a_lease_that_cannot_be_renewed_stops_the_ids(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(db.config, "ID_NODE_LEASE", 2)
+    database = db.Database(str(tmp_path / "database.db"))
+
+    @contextmanager
+    def unreachable():
+        raise ConnectionError("database unreachable")
+        yield
+
+    try:
+        # the renewals fail until the lease runs out
+        database.transaction = unreachable
+        deadline = time.time() + 10
+        while time.time() < deadline and time.time() < assets.generator.valid_until:
+            time.sleep(0.05)
+        with pytest.raises(RuntimeError):
+            assets.unique_id()
+        assert "Failed to renew the id node lease" in caplog.text
+
+        # nobody took the node meanwhile, so the next renewal gets it back
+        del database.transaction
+        while time.time() < deadline and time.time() >= assets.generator.valid_until:
+            time.sleep(0.05)
+        assets.unique_id()
+    finally:
+        database.close()
+
+
+def test_databases_lease_different_nodes(tmp_path):
+    path = str(tmp_path / "database.db")
+    first = db.Database(path)
+    first_node = assets.generator.node_id
+    second = db.Database(path)
+    try:
+        assert assets.generator.node_id != first_node
+        owners = dict(first.engine.connect().execute(db.db.select(first._id_nodes.c.node_id, first._id_nodes.c.owner)).all())
+        assert owners[first_node] == first._node_owner
+        assert owners[assets.generator.node_id] == second._node_owner
+    finally:
+        second.close()
+        first.close()
+
+
+def test_expired_leases_are_taken_over(tmp_path):
+    path = str(tmp_path / "database.db")
+    database = db.Database(path)
+    try:
+        # every node held by a process that stopped renewing a minute ago
+        with database.transaction() as session:
+            session.execute(database._id_nodes.delete())
+            session.execute(
+                database._id_nodes.insert(),
+                [{"node_id": node_id, "owner": "gone", "expires_at": int(time.time()) - 60} for node_id in range(assets.MAX_NODES)],
+            )
+        node_id = database.claim_node_id()
+        with database.transaction() as session:
+            command = db.db.select(database._id_nodes.c.owner).where(database._id_nodes.c.node_id == node_id)
+            assert session.execute(command).scalar() == database._node_owner
+    finally:
+        database.close()
+
+
+def test_closing_gives_the_lease_back(tmp_path):
+    database = db.Database(str(tmp_path / "database.db"))
+    database.close()
+    assert not database._lease_renewal.is_alive()
+    with database.engine.connect() as connection:
+        command = db.db.select(database._id_nodes.c.node_id).where(database._id_nodes.c.owner == database._node_owner)
+        assert connection.execute(command).first() is None
+
+
+def claim_in_process(path, results, barrier):
+    # every process tries the same node first, all at once, so all but one lose the race for it
+    random.shuffle = lambda nodes: None
+    barrier.wait()
+    database = db.Database(path)
+    results.put(assets.generator.node_id)
+    # hold the lease until every process has one
+    barrier.wait()
+    database.close()
+
+
+def test_racing_processes_get_distinct_nodes(tmp_path):
+    path = str(tmp_path / "database.db")
+    # create the schema first, so the processes only race for nodes
+    db.Database(path).close()
+
+    processes = 8
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    barrier = context.Barrier(processes)
+    workers = [context.Process(target=claim_in_process, args=(path, results, barrier)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    nodes = [results.get(timeout=60) for _ in workers]
+    for worker in workers:
+        worker.join()
+    assert len(set(nodes)) == processes
+
+
+@pytest.mark.bench
+def test_bench_insert_latency_stays_flat(database):
+    users = database._users
+    checkpoints = [size for size in (10_000, 100_000, 1_000_000, 10_000_000) if size <= BENCH_ROWS] or [BENCH_ROWS]
+    rows = 0
+    means = []
+    for size in checkpoints:
+        # grow the table with bulk inserts, then time single add_user calls at this size
+        with database.transaction() as session:
+            while rows < size:
+                batch = min(10_000, size - rows)
+                session.execute(
+                    users.insert(),
+                    [{"user_id": assets.unique_id(), "username": f"bulk{rows + number}", "user_type": 2, "interests": ""} for number in range(batch)],
+                )
+                rows += batch
+        started = time.perf_counter()
+        for number in range(BENCH_SAMPLES):
+            database.add_user(f"timed{size}_{number}", 2, [])
+        means.append((time.perf_counter() - started) / BENCH_SAMPLES)
+        rows += BENCH_SAMPLES
+        report("add_user", rows=size, mean_ms=means[-1] * 1000)
+
+    # an O(N) check would grow with the table; an indexed insert stays within noise
+    assert means[-1] < 5 * means[0]
@@ -0,0 +1,157 @@
+import base64
+import io
+import os
+import random
+import time
+
+import pytest
+
+from api.service import config
+from api.service.ollama import OllamaService
+
+from .conftest import report
+
+Image = pytest.importorskip("PIL.Image")
+ImageDraw = pytest.importorskip("PIL.ImageDraw")
+ImageFont = pytest.importorskip("PIL.ImageFont")
+
+from api.service import imaging  # noqa: E402
+
+# sample posters the size benchmark prepares and sends
+BENCH_POSTERS = int(os.getenv("BENCH_POSTERS", 8))
+
+
+def make_poster(seed: int = 0, size=(3024, 4032), orientation: int = None, quality: int = 95) -> bytes:
+    """A phone-camera sized poster: blocks of colour and lines of large text, with camera EXIF."""
+    rng = random.Random(seed)
+    width, height = size
+    image = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randrange(width * 3 // 4), rng.randrange(height * 3 // 4)
+        colour = tuple(rng.randrange(256) for _ in range(3))
+        draw.rectangle((x, y, x + rng.randrange(width // 10, width // 4), y + rng.randrange(height // 10, height // 4)), fill=colour)
+    font = ImageFont.load_default(size=max(10, width // 15))
+    for line in range(6):
+        draw.text((width // 12, height // 8 + line * height // 7), f"Club event {seed} {line}", fill=(255, 255, 255), font=font)
+
+    exif = Image.Exif()
+    exif[0x010F] = "Phone maker"  # Make
+    if orientation:
+        exif[0x0112] = orientation
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, exif=exif)
+    return buffer.getvalue()
+
+
+def recompress(data: bytes, scale: float = 0.5, quality: int = 60) -> bytes:
+    image = Image.open(io.BytesIO(data))
+    image = image.resize((int(image.width * scale), int(image.height * scale)))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def distance(first: str, second: str) -> int:
+    return bin(int(first, 16) ^ int(second, 16)).count("1")
+
+
+def test_posters_are_shrunk_to_the_target_size():
+    prepared = imaging.prepare_image(make_poster(), target_size=672)
+    assert (prepared.width, prepared.height) == (504, 672)
+    assert Image.open(io.BytesIO(prepared.data)).format == "JPEG"
+
+
+def test_small_images_are_not_enlarged():
+    prepared = imaging.prepare_image(make_poster(size=(300, 200)), target_size=672)
+    assert (prepared.width, prepared.height) == (300, 200)
+
+
+def test_metadata_is_stripped_after_rotating():
+    # orientation 6: the camera was turned, and the pixels must be rotated by a quarter
+    prepared = imaging.prepare_image(make_poster(size=(800, 600), orientation=6), target_size=672)
+    assert (prepared.width, prepared.height) == (504, 672)
+    assert dict(Image.open(io.BytesIO(prepared.data)).getexif()) == {}
+
+
+def test_data_that_is_not_an_image():
+    with pytest.raises(ValueError):
+        imaging.prepare_image(b"not an image")
+
+
+def test_perceptual_hash_survives_recompression():
+    poster = make_poster(seed=1)
+    original = imaging.prepare_image(poster).phash
+    assert distance(original, imaging.prepare_image(recompress(poster)).phash) <= config.VISION_DEDUPE_DISTANCE
+    assert distance(original, imaging.prepare_image(make_poster(seed=2)).phash) > config.VISION_DEDUPE_DISTANCE
+
+
+def test_requests_carry_the_prepared_image(ollama):
+    service = OllamaService(ollama.url, target_size=320)
+    try:
+        service.get_image_extract(base64.b64encode(make_poster()).decode())
+    finally:
+        service.close()
+    sent = Image.open(io.BytesIO(base64.b64decode(ollama.requests[0]["images"][0])))
+    assert max(sent.size) == 320
+
+
+def test_no_target_size_sends_images_as_they_are(ollama):
+    poster = base64.b64encode(make_poster(size=(800, 600))).decode()
+    service = OllamaService(ollama.url, target_size=0)
+    try:
+        service.get_image_extract(poster)
+    finally:
+        service.close()
+    assert ollama.requests[0]["images"] == [poster]
+
+
+def test_recompressed_reposts_reuse_the_extraction(ollama):
+    poster = make_poster(seed=0)
+    again = recompress(poster)
+    # a few bits of the hash flipped
+    assert 0 < distance(imaging.prepare_image(poster).phash, imaging.prepare_image(again).phash) <= config.VISION_DEDUPE_DISTANCE
+    again = base64.b64encode(again).decode()
+    service = OllamaService(ollama.url)
+    try:
+        service.get_image_extract(base64.b64encode(poster).decode(), "Open Mic, Friday")
+        service.get_image_extract(again, "Open Mic, Friday")
+        assert len(ollama.requests) == 1
+        # without a caption only an identical hash is the same poster
+        service.get_image_extract(base64.b64encode(poster).decode())
+        service.get_image_extract(again)
+        assert len(ollama.requests) == 3
+    finally:
+        service.close()
+
+
+@pytest.mark.bench
+def test_bench_poster_size_and_latency(ollama):
+    posters = [make_poster(seed=seed) for seed in range(BENCH_POSTERS)]
+    original = sum(len(poster) for poster in posters)
+
+    started = time.perf_counter()
+    prepared = [imaging.prepare_image(poster) for poster in posters]
+    prepare_seconds = (time.perf_counter() - started) / len(posters)
+    shrunk = sum(len(image.data) for image in prepared)
+    report(
+        "prepare_image",
+        posters=len(posters),
+        original_kb=original / len(posters) / 1024,
+        prepared_kb=shrunk / len(posters) / 1024,
+        ms_per_poster=prepare_seconds * 1000,
+    )
+
+    # the request round trip, with the image as it is and prepared, to a server that answers at once
+    for target_size in (0, config.VISION_TARGET_SIZE):
+        service = OllamaService(ollama.url, target_size=target_size, cache_size=0)
+        try:
+            started = time.perf_counter()
+            for number, poster in enumerate(posters):
+                service.get_image_extract(base64.b64encode(poster).decode(), f"poster {number}")
+            seconds = (time.perf_counter() - started) / len(posters)
+        finally:
+            service.close()
+        report("get_image_extract", target_size=target_size, ms_per_poster=seconds * 1000)
+
+    assert shrunk < original / 4
@@ -0,0 +1,129 @@
+import asyncio
+import datetime
+import time
+from zoneinfo import ZoneInfo
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api.route import ai
+from api.service import aiodb, config
+from api.service.ingest import IngestWorkers
+from api.service.insta import FakeInstagramClient, InstaFetcher
+from api.service.ollama import AsyncOllamaService
+
+# not a decodable image, so it goes to the model as it is
+POSTER = b"\xff\xd8poster\xff\xd9"
+
+
+@pytest.fixture
+def workers(database, ollama, tmp_path):
+    """Ingest workers fetching from a fake Instagram account and extracting with the stub model."""
+    client = FakeInstagramClient({"club": ("Cabc123", "Open Mic, Friday 6pm", POSTER)})
+    fetcher = InstaFetcher(client, cache_dir=str(tmp_path), ttl=60)
+    extractor = AsyncOllamaService(ollama.url, backoff=0.01, retries=0)
+    return IngestWorkers(aiodb.AsyncDatabase(database, mode="inline"), fetcher, extractor, workers=1)
+
+
+def run_once(workers) -> bool:
+    async def main():
+        try:
+            return await workers.run_once()
+        finally:
+            await workers.ollama.close()
+
+    return asyncio.run(main())
+
+
+def test_a_job_becomes_a_draft_event(database, workers, ollama):
+    job_id = database.add_ingest_job("club", club_id=7)
+    assert run_once(workers)
+
+    job = database.get_ingest_job(job_id)
+    assert (job["status"], job["attempts"], job["error"]) == ("done", 1, None)
+    draft = job["draft"]
+    start = datetime.datetime(2026, 11, 20, 18, 0, tzinfo=ZoneInfo(config.INGEST_TIMEZONE))
+    assert draft["event"] == {
+        "club_id": 7,
+        "event_name": "Open Mic",
+        "event_location": "Main Auditorium",
+        "categories": [],
+        "start_time": int(start.timestamp()),
+        "end_time": int(start.timestamp()) + config.INGEST_EVENT_DURATION,
+        "limit": 120,
+        "price": 0.0,
+    }
+    assert draft["missing"] == []
+    assert draft["caption"] == "Open Mic, Friday 6pm"
+    assert "of Open Mic, Friday 6pm" in ollama.requests[0]["prompt"]
+    assert workers.metrics["done"] == 1
+
+    # and the queue is empty
+    assert not run_once(workers)
+
+
+def test_a_job_the_model_cannot_read_fails(database, workers, ollama):
+    ollama.failures = 1
+    job_id = database.add_ingest_job("club")
+    assert run_once(workers)
+
+    job = database.get_ingest_job(job_id)
+    assert job["status"] == "failed"
+    assert job["error"] == "ValueError: No event details could be read from the post"
+    assert workers.metrics["failed"] == 1
+
+
+def test_a_stalled_job_is_claimed_again(database):
+    job_id = database.add_ingest_job("club")
+    now = int(time.time())
+    assert database.claim_ingest_job("gone", now=now)["job_id"] == job_id
+
+    # nobody else takes it while its worker may still be busy
+    assert database.claim_ingest_job("worker", now=now + config.INGEST_JOB_TIMEOUT) is None
+
+    job = database.claim_ingest_job("worker", now=now + config.INGEST_JOB_TIMEOUT + 1)
+    assert (job["job_id"], job["status"], job["attempts"]) == (job_id, "fetching", 2)
+    # the worker that went quiet can no longer finish it
+    assert not database.update_ingest_job(job_id, "gone", "done", draft={})
+    assert database.update_ingest_job(job_id, "worker", "done", draft={})
+
+
+def test_a_job_fails_once_its_attempts_are_used_up(database):
+    job_id = database.add_ingest_job("club")
+    now = int(time.time())
+    for attempt in range(config.INGEST_MAX_ATTEMPTS):
+        now += config.INGEST_JOB_TIMEOUT + 1
+        job = database.claim_ingest_job(f"worker{attempt}", now=now)
+        assert (job["job_id"], job["attempts"]) == (job_id, attempt + 1)
+
+    # the last worker went quiet too
+    assert database.claim_ingest_job("worker", now=now + config.INGEST_JOB_TIMEOUT + 1) is None
+    job = database.get_ingest_job(job_id)
+    assert job["status"] == "failed"
+    assert job["error"] == "The worker processing it stopped responding"
+
+
+def test_the_status_route_reports_the_job(database, workers):
+    app = FastAPI()
+    app.include_router(ai.router, prefix=ai.prefix)
+    ai.router.database = workers.database
+    ai.router.ingest_workers = workers
+
+    with TestClient(app) as client:
+        queued = client.post("/ai/ingest", json={"username": " Club ", "club_id": 7}).json()
+        assert queued["status_code"] == 202
+        job_id = queued["response"]["job_id"]
+
+        status = client.get(f"/ai/ingest/{job_id}").json()["response"]
+        assert (status["username"], status["status"], status["draft"]) == ("club", "queued", None)
+
+        assert client.portal.call(workers.run_once)
+        status = client.get(f"/ai/ingest/{job_id}").json()["response"]
+        assert status["status"] == "done"
+        assert status["draft"]["event"]["event_name"] == "Open Mic"
+
+        missing = client.get(f"/ai/ingest/{job_id + 1}").json()
+        assert missing == {"status_code": 404, "response": {"error": "Job not found"}}
+
+        client.portal.call(workers.ollama.close)
@@ -0,0 +1,111 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from api.service.insta import FakeInstagramClient, InstaFetcher
+
+POSTER = b"\xff\xd8poster\xff\xd9"
+
+
+@pytest.fixture
+def client():
+    return FakeInstagramClient({"club": ("Cabc123", "Open Mic, Friday 6pm", POSTER)}, delay=0.05)
+
+
+@pytest.fixture
+def fetcher(client, tmp_path):
+    return InstaFetcher(client, cache_dir=str(tmp_path), ttl=60)
+
+
+def test_concurrent_requests_share_one_fetch(fetcher, client):
+    async def fetch_many():
+        return await asyncio.gather(*(fetcher.get_latest_post(" Club ") for _ in range(20)))
+
+    results = asyncio.run(fetch_many())
+    assert results == [("Open Mic, Friday 6pm", POSTER)] * 20
+    assert (client.lookups, client.downloads) == (1, 1)
+    assert fetcher._inflight == {}
+
+
+def test_fetching_runs_off_the_loop(fetcher):
+    async def ticks_while_fetching():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.005)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        await fetcher.get_latest_post("club")
+        task.cancel()
+        return ticks
+
+    # a lookup and a download of 50ms each
+    assert asyncio.run(ticks_while_fetching()) >= 5
+
+
+def test_latest_post_is_trusted_for_the_ttl(client, tmp_path):
+    fetcher = InstaFetcher(client, cache_dir=str(tmp_path), ttl=0.1)
+    fetcher.fetch("club")
+    fetcher.fetch("club")
+    assert (client.lookups, client.downloads) == (1, 1)
+
+    time.sleep(0.15)
+    # the account is asked again, but the post it names is on disk already
+    fetcher.fetch("club")
+    assert (client.lookups, client.downloads) == (2, 1)
+
+    time.sleep(0.15)
+    client.posts["club"] = ("Cdef456", "Quiz night", b"another poster")
+    assert fetcher.fetch("club") == ("Quiz night", b"another poster")
+    assert (client.lookups, client.downloads) == (3, 2)
+
+
+def test_posts_on_disk_are_shared_between_workers(fetcher, client, tmp_path):
+    fetcher.fetch("club")
+    other = InstaFetcher(client, cache_dir=str(tmp_path), ttl=60)
+    assert other.fetch("club") == ("Open Mic, Friday 6pm", POSTER)
+    assert client.downloads == 1
+    assert sorted(os.listdir(tmp_path)) == ["Cabc123.jpg", "Cabc123.json"]
+
+
+def test_a_cut_short_image_is_fetched_again(fetcher, client, tmp_path):
+    fetcher.fetch("club")
+    with open(tmp_path / "Cabc123.jpg", "wb") as file:
+        file.write(POSTER[:4])
+    fetcher.latest.clear()
+    assert fetcher.fetch("club") == ("Open Mic, Friday 6pm", POSTER)
+    assert client.downloads == 2
+
+
+def test_accounts_without_posts(fetcher):
+    with pytest.raises(ValueError):
+        fetcher.fetch("nobody")
+
+
+def test_old_posts_are_pruned(fetcher, tmp_path):
+    fetcher.fetch("club")
+    week_ago = time.time() - 8 * 24 * 3600
+    for name in os.listdir(tmp_path):
+        os.utime(tmp_path / name, (week_ago, week_ago))
+    assert fetcher.prune() == 1
+    assert os.listdir(tmp_path) == []
+
+
+def test_storing_posts_prunes_old_ones(tmp_path):
+    client = FakeInstagramClient({name: (f"C{name}", "", POSTER) for name in ("first", "second", "third")})
+    fetcher = InstaFetcher(client, cache_dir=str(tmp_path), ttl=60, prune_every=2)
+    fetcher.fetch("first")
+    week_ago = time.time() - 8 * 24 * 3600
+    for name in os.listdir(tmp_path):
+        os.utime(tmp_path / name, (week_ago, week_ago))
+
+    # the second post stored is the second since the last prune
+    fetcher.fetch("second")
+    assert sorted(os.listdir(tmp_path)) == ["Csecond.jpg", "Csecond.json"]
+    fetcher.fetch("third")
+    assert len(os.listdir(tmp_path)) == 4
@@ -0,0 +1,203 @@
+import re
+import shutil
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import pytest
+import sqlalchemy
+
+from api.service import db, migrations
+
+# the database file the repository shipped with, from before the migrations
+SHIPPED_DATABASE = Path(__file__).resolve().parent.parent / "database.db"
+
+
+@pytest.fixture
+def sqlite_database(tmp_path):
+    database = db.Database(str(tmp_path / "database.db"))
+    yield database
+    database.close()
+
+
+@contextmanager
+def captured(database):
+    """Collect the reads and writes the database runs, with their parameters."""
+    statements = []
+
+    def capture(connection, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+            statements.append((statement, parameters))
+
+    sqlalchemy.event.listen(database.engine, "before_cursor_execute", capture)
+    try:
+        yield statements
+    finally:
+        sqlalchemy.event.remove(database.engine, "before_cursor_execute", capture)
+
+
+def table_scans(database, statements) -> list:
+    """The tables that the query plan of any of the statements reads in full, without an index."""
+    scans = []
+    with database.engine.connect() as connection:
+        for statement, parameters in statements:
+            for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters):
+                match = re.fullmatch(r"SCAN (\w+)", row[3])
+                if match:
+                    scans.append(match.group(1))
+    return scans
+
+
+@pytest.fixture
+def populated(sqlite_database, make_event, make_users):
+    database = sqlite_database
+    event = make_event(limit=2)
+    users = make_users(4)
+    registration_ids = [database.register_event(event["event_name"], user_id)["registration_id"] for user_id in users]
+    return database, event, users, registration_ids
+
+
+# make_event and make_users build on the parametrized `database` fixture; these tests are about sqlite plans
+@pytest.fixture
+def database(sqlite_database):
+    return sqlite_database
+
+
+def test_registrations_of_a_user_use_an_index(populated):
+    database, event, users, _ = populated
+    with captured(database) as statements:
+        database.get_registered_events(users[0])
+        database.get_live_registration(users[0], event["event_id"])
+    assert statements and table_scans(database, statements) == []
+
+
+def test_waitlist_head_uses_an_index(populated):
+    database, event, _, registration_ids = populated
+    # an empty mirror, so the head comes from the (event_id, status, registration_timestamp) index
+    database.waiting_list.load([])
+    with captured(database) as statements:
+        database.cancel_registration(registration_ids[0])
+    assert database.registration_status(registration_ids[2]) == "pending"
+    assert table_scans(database, statements) == []
+
+
+def test_expiry_sweeps_use_an_index(populated):
+    database, *_ = populated
+    with captured(database) as statements:
+        database.expire_pending(now=int(time.time()))
+        database.expire_unpaid(now=int(time.time()))
+    assert statements and table_scans(database, statements) == []
+
+
+def test_event_search_uses_indexes(populated):
+    database, event, _, _ = populated
+    with captured(database) as statements:
+        database.search_event(categories=["music"])
+        database.search_event(start_time=event["start_time"] - 1)
+        database.search_event(event_location=event["event_location"])
+        database.get_event(event_name=event["event_name"])
+    assert statements and table_scans(database, statements) == []
+
+
+def test_leaderboard_uses_an_index(populated):
+    database, event, _, _ = populated
+    database.update_event_rating(event["event_id"], 4)
+    with captured(database) as statements:
+        # the version stamp is read from its counter row along with the board
+        database.get_leaderboard(limit=10)
+        database.catalogue_version(cached=False)
+    assert statements and table_scans(database, statements) == []
+
+
+def test_versions_are_counted_with_the_writes(populated, make_users):
+    database, event, _, registration_ids = populated
+    catalogue, leaderboard = database.catalogue_version(cached=False), database.leaderboard_version(cached=False)
+
+    # a unit of work adds one however many events it writes to
+    database.cancel_registration(registration_ids[0])
+    assert database.catalogue_version(cached=False) == catalogue + 1
+    database.update_event_rating(event["event_id"], 4)
+    assert database.catalogue_version(cached=False) == catalogue + 2
+    assert database.leaderboard_version(cached=False) == leaderboard + 1
+
+    # and a unit of work that rolls back adds nothing
+    with pytest.raises(ValueError):
+        with database.transaction():
+            database.register_event(event["event_name"], make_users(1)[0])
+            raise ValueError("rolled back")
+    assert database.catalogue_version(cached=False) == catalogue + 2
+
+
+def test_queues_of_jobs_and_captures_use_indexes(sqlite_database):
+    database = sqlite_database
+    database.add_ingest_job("club")
+    with captured(database) as statements:
+        database.claim_ingest_job("worker")
+        database.reconcile_payments()
+    assert statements and table_scans(database, statements) == []
+
+
+def test_shipped_database_is_migrated_in_place(tmp_path):
+    path = tmp_path / "database.db"
+    shutil.copy(SHIPPED_DATABASE, path)
+
+    database = db.Database(str(path))
+    try:
+        versions = database.engine.connect().execute(sqlalchemy.text("SELECT version FROM schema_version")).scalars().all()
+        assert sorted(versions) == [step.version for step in sorted(migrations.MIGRATIONS)]
+        inspector = sqlalchemy.inspect(database.engine)
+        assert "waitlist" not in inspector.get_table_names()
+        assert {index.name for index in database._registrations.indexes} <= {
+            index["name"] for index in inspector.get_indexes("registrations")
+        }
+
+        # the waitlist entry it held is now a waiting registration, and the event kept its data
+        (entry,) = database.get_waiting_list()
+        assert entry["registration_id"] == 1661228934
+        event = database.get_event(event_id=704549229)
+        assert event["event_name"] == "hee hee" and event["seats_taken"] == 0
+        # the catalogue's counter carries on from the versions of its events
+        with database.engine.connect() as connection:
+            versions = connection.execute(sqlalchemy.text("SELECT sum(version) FROM events")).scalar()
+        assert database.catalogue_version() == versions
+    finally:
+        database.close()
+
+    # opening it again has nothing left to apply
+    reopened = db.Database(str(path))
+    try:
+        assert migrations.upgrade(reopened) == []
+    finally:
+        reopened.close()
+
+
+def test_duplicate_registrations_are_merged(tmp_path):
+    path = tmp_path / "database.db"
+    # the tables as the first database files had them
+    connection = sqlite3.connect(path)
+    connection.executescript(
+        """
+        CREATE TABLE events (event_id INTEGER NOT NULL, event_name VARCHAR NOT NULL, event_location VARCHAR,
+            categories VARCHAR, start_time INTEGER, end_time INTEGER, "limit" INTEGER,
+            UNIQUE (event_id), UNIQUE (event_name));
+        CREATE TABLE users (user_id INTEGER, username VARCHAR, interests VARCHAR, creation_time DATETIME);
+        CREATE TABLE registrations (registration_id INTEGER, user_id VARCHAR, event_name VARCHAR, event_id VARCHAR);
+        CREATE TABLE waitlist (user_id INTEGER, event_id INTEGER, registration_timestamp INTEGER, registration_id INTEGER);
+        CREATE TABLE pendinglist (user_id INTEGER, event_id INTEGER, registration_timestamp INTEGER, registration_id INTEGER);
+        INSERT INTO events VALUES (1, 'Open Mic', 'Hall', 'music', 100, 200, 3);
+        INSERT INTO users VALUES (10, 'first', '', NULL), (11, 'second', '', NULL), (12, 'third', '', NULL);
+        INSERT INTO registrations VALUES (20, 10, 'Open Mic', 1), (21, 10, 'Open Mic', 1), (22, 11, 'Open Mic', 1);
+        INSERT INTO pendinglist VALUES (12, 1, 150, 23);
+        """
+    )
+    connection.commit()
+    connection.close()
+
+    database = db.Database(str(path))
+    try:
+        statuses = {registration_id: database.registration_status(registration_id) for registration_id in (20, 21, 22, 23)}
+        assert statuses == {20: "confirmed", 21: "not found", 22: "confirmed", 23: "pending"}
+        assert database.get_event(event_id=1)["seats_taken"] == 3
+    finally:
+        database.close()
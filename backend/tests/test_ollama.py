@@ -0,0 +1,122 @@
+import asyncio
+import base64
+
+import pytest
+
+from api.service import ollama as ollama_module
+from api.service.ollama import AsyncOllamaService, OllamaService
+
+EXPECTED = {
+    "title": "Open Mic",
+    "description": "Songs and poems",
+    "date": "2026-11-20",
+    "time": "18:00",
+    "venue": "Main Auditorium",
+    "capacity": 120,
+    "isPaid": False,
+}
+
+
+def poster(number: int = 0) -> str:
+    # not a decodable image, so it is sent as it is and cached by its sha256
+    return base64.b64encode(f"poster {number}".encode()).decode()
+
+
+def run(ollama, test, **kwargs):
+    """Run `test(service)` against a client of the stub server."""
+
+    async def main():
+        service = AsyncOllamaService(ollama.url, backoff=0.01, **kwargs)
+        try:
+            return await test(service)
+        finally:
+            await service.close()
+
+    return asyncio.run(main())
+
+
+def test_extracts_typed_fields(ollama):
+    assert run(ollama, lambda service: service.get_image_extract(poster(), "Open Mic night")) == EXPECTED
+    assert ollama.requests[0]["images"] == [poster()]
+    assert "of Open Mic night" in ollama.requests[0]["prompt"]
+
+
+def test_failed_requests_are_retried(ollama):
+    ollama.failures = 2
+    assert run(ollama, lambda service: service.get_image_extract(poster()), retries=3) == EXPECTED
+    assert len(ollama.requests) == 3
+
+
+def test_failures_are_not_cached(ollama):
+    ollama.failures = 2
+
+    async def test(service):
+        first = await service.get_image_extract(poster())
+        second = await service.get_image_extract(poster())
+        return first, second
+
+    assert run(ollama, test, retries=1) == ({}, EXPECTED)
+    assert len(ollama.requests) == 3
+
+
+def test_concurrency_is_bounded(ollama):
+    ollama.delay = 0.1
+
+    async def test(service):
+        return await service.get_image_extracts([{"image": poster(number)} for number in range(6)])
+
+    assert run(ollama, test, concurrency=2) == [EXPECTED] * 6
+    assert ollama.max_in_flight == 2
+    # and the pool kept its two connections open between requests
+    assert len(ollama.connections) == 2
+
+
+def test_extractions_are_cached_by_image_caption_and_prompt_version(ollama, monkeypatch):
+    async def test(service):
+        await service.get_image_extract(poster(), "caption")
+        await service.get_image_extract(poster(), "caption")
+        await service.get_image_extract(poster(), "another caption")
+        monkeypatch.setattr(ollama_module, "PROMPT_VERSION", ollama_module.PROMPT_VERSION + 1)
+        await service.get_image_extract(poster(), "caption")
+
+    run(ollama, test)
+    assert len(ollama.requests) == 3
+
+
+def test_identical_extractions_in_flight_share_a_request(ollama):
+    ollama.delay = 0.1
+
+    async def test(service):
+        return await asyncio.gather(*(service.get_image_extract(poster()) for _ in range(5)))
+
+    results = run(ollama, test)
+    assert results == [EXPECTED] * 5
+    assert len(ollama.requests) == 1
+    # every caller gets a copy of its own
+    results[0]["title"] = "changed"
+    assert results[1]["title"] == "Open Mic"
+
+
+def test_is_available(ollama):
+    assert run(ollama, lambda service: service.is_available())
+
+
+def test_blocking_client_reuses_its_connection(ollama):
+    service = OllamaService(ollama.url)
+    try:
+        assert [service.get_image_extract(poster(number)) for number in range(3)] == [EXPECTED] * 3
+        assert service.is_available()
+    finally:
+        service.close()
+    assert len(ollama.connections) == 1
+
+
+@pytest.mark.parametrize("status", [500, 503])
+def test_blocking_client_reports_failures_as_empty(ollama, status):
+    ollama.failures = 1
+    ollama.status = status
+    service = OllamaService(ollama.url)
+    try:
+        assert service.get_image_extract(poster()) == {}
+    finally:
+        service.close()
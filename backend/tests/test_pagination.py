@@ -0,0 +1,95 @@
+import csv
+import io
+import json
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api.route import conference
+from api.service import aiodb, payments
+from api.service.pagination import decode_cursor, encode_cursor, json_stream
+
+FIELDS = ["registration_id", "user_id", "event_name", "event_id", "registration_timestamp", "status"]
+
+
+@pytest.fixture
+def client(database):
+    app = FastAPI()
+    app.database = aiodb.AsyncDatabase(database, mode="inline")
+    app.payments = payments.PaymentService(payments.FakeGateway(), app.database)
+    conference.setup(app)
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture
+def registrations(database, make_event, make_users) -> list:
+    """Ten registrations made in one transaction, so they all share a timestamp; their ids in order."""
+    event = make_event(limit=5)
+    results = database.register_events_bulk([{"name": event["event_name"], "user_id": user_id} for user_id in make_users(10)])
+    return sorted(result["registration_id"] for result in results)
+
+
+def test_cursors_round_trip():
+    assert decode_cursor(encode_cursor(1234)) == 1234
+    for token in ("not a cursor", encode_cursor(1)[:-2], "e30"):  # garbage, truncated, and {}
+        with pytest.raises(ValueError, match="^Invalid cursor$"):
+            decode_cursor(token)
+
+
+def test_pages_walk_every_row_once(client, registrations):
+    seen = []
+    cursor = None
+    pages = 0
+    while True:
+        params = {"limit": 3} if cursor is None else {"limit": 3, "cursor": cursor}
+        page = client.get("/events/get-all-registrations", params=params).json()["response"]
+        seen.extend(page["items"])
+        pages += 1
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+    # rows sharing a timestamp are told apart by their id, so none is repeated or skipped
+    assert len({registration["registration_timestamp"] for registration in seen}) == 1
+    assert [registration["registration_id"] for registration in seen] == registrations
+    assert pages == 4
+
+
+def test_a_page_ending_on_the_last_row_has_no_next_cursor(client, registrations):
+    page = client.get("/events/get-all-registrations", params={"limit": 10}).json()["response"]
+    assert len(page["items"]) == 10
+    assert page["next_cursor"] is None
+
+
+def test_an_invalid_cursor_is_rejected(client, registrations):
+    for params in ({"cursor": "not a cursor"}, {"format": "xml"}):
+        reply = client.get("/events/get-all-registrations", params=params).json()
+        assert reply["status_code"] == 400
+        assert reply["response"]["error"] == "ValueError"
+
+
+def test_rows_are_streamed_as_ndjson(client, registrations):
+    response = client.get("/events/get-all-registrations", params={"format": "ndjson"})
+    assert response.headers["content-type"] == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["registration_id"] for row in rows] == registrations
+    assert set(rows[0]) == set(FIELDS)
+
+
+def test_rows_are_streamed_as_csv_from_a_cursor(client, registrations):
+    cursor = encode_cursor(registrations[3])
+    response = client.get("/events/get-all-registrations", params={"format": "csv", "cursor": cursor})
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.reader(io.StringIO(response.text)))
+    assert rows[0] == FIELDS
+    assert [int(row[0]) for row in rows[1:]] == registrations[4:]
+
+
+def test_a_json_stream_is_one_envelope():
+    rows = [{"registration_id": number} for number in range(5000)]
+    chunks = list(json_stream(iter(rows)))
+    # written in blocks, not a chunk per row
+    assert 1 < len(chunks) < 100
+    assert json.loads(b"".join(chunks)) == {"status_code": 200, "response": rows}
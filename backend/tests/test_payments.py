@@ -0,0 +1,199 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from api.service import aiodb, payments
+
+from .conftest import report
+
+# orders created at once in the latency benchmark, and how long each gateway call takes there
+BENCH_ORDERS = int(os.getenv("BENCH_ORDERS", 200))
+BENCH_GATEWAY_LATENCY = float(os.getenv("BENCH_GATEWAY_LATENCY", 0.05))
+
+
+class LosesAnswers(payments.FakeGateway):
+    """While `losing` is set, creates the order and then fails, like a call timing out after the gateway acted."""
+
+    losing = True
+
+    def create_order(self, *args, **kwargs):
+        order = super().create_order(*args, **kwargs)
+        if self.losing:
+            raise payments.PaymentError("Timed out")
+        return order
+
+
+class IgnoresTimeouts(payments.FakeGateway):
+    def _call(self, timeout: float):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+
+
+@pytest.fixture
+def service_for(database):
+    """A PaymentService over the gateway, run in its own event loop by `service_for(gateway)(test)`."""
+
+    def service_for(gateway, **kwargs):
+        def run(test):
+            async def main():
+                facade = aiodb.AsyncDatabase(database, mode="thread", workers=4)
+                service = payments.PaymentService(gateway, facade, **kwargs)
+                try:
+                    return await test(service)
+                finally:
+                    await service.stop()
+                    facade._executor.shutdown()
+
+            return asyncio.run(main())
+
+        return run
+
+    return service_for
+
+
+def test_retries_get_the_first_order(service_for):
+    gateway = payments.FakeGateway(latency=0.05)
+
+    async def test(service):
+        first = await asyncio.gather(*(service.create_order(7, 1, 2, 250.0) for _ in range(5)), return_exceptions=True)
+        again = await service.create_order(7, 1, 2, 250.0)
+        return first, again, service.metrics
+
+    first, again, metrics = service_for(gateway)(test)
+    order_ids = {result for result in first if isinstance(result, str)}
+    # concurrent duplicates are told to retry while the first creates the order
+    assert all(isinstance(result, ValueError) for result in first if not isinstance(result, str))
+    assert order_ids == {again}
+    assert len(gateway.orders) == 1
+    assert gateway.orders[again]["amount"] == 25000
+    assert gateway.orders[again]["receipt"] == payments.PaymentService.idempotency_key(7)
+    assert metrics["reused"] >= 1
+
+
+def test_each_registration_gets_its_own_order(service_for):
+    gateway = payments.FakeGateway()
+
+    async def test(service):
+        return await service.create_order(7, 1, 2, 250.0), await service.create_order(8, 1, 2, 250.0)
+
+    first, second = service_for(gateway)(test)
+    assert first != second
+
+
+def test_an_order_created_before_a_timeout_is_found_again(service_for):
+    gateway = LosesAnswers()
+
+    async def test(service):
+        with pytest.raises(payments.PaymentError):
+            await service.create_order(7, 1, 2, 250.0)
+        # the gateway answers again, and the retry looks for the order before creating one
+        gateway.losing = False
+        return await service.create_order(7, 1, 2, 250.0)
+
+    order_id = service_for(gateway)(test)
+    assert list(gateway.orders) == [order_id]
+
+
+def test_slow_calls_are_given_up_on(service_for):
+    gateway = IgnoresTimeouts(latency=1.5)
+
+    async def test(service):
+        started = time.monotonic()
+        with pytest.raises(payments.PaymentError):
+            await service.validate_vpa("club@upi")
+        return time.monotonic() - started, service.metrics
+
+    elapsed, metrics = service_for(gateway, timeout=0.1)(test)
+    assert elapsed < 1.4
+    assert metrics["timeouts"] == 1
+
+
+def test_failures_open_the_circuit(service_for):
+    gateway = payments.FakeGateway(failing=True)
+    breaker = payments.CircuitBreaker(threshold=2, reset_after=0.2)
+
+    async def test(service):
+        for _ in range(2):
+            with pytest.raises(payments.PaymentError):
+                await service.validate_vpa("club@upi")
+        assert breaker.state == "open"
+        with pytest.raises(payments.CircuitOpenError):
+            await service.validate_vpa("club@upi")
+        assert gateway.calls == 2
+
+        # after reset_after one trial call goes through, and closes the circuit when it succeeds
+        await asyncio.sleep(0.25)
+        gateway.failing = False
+        assert await service.validate_vpa("club@upi")
+        assert breaker.state == "closed"
+        return service.metrics
+
+    metrics = service_for(gateway, breaker=breaker)(test)
+    assert metrics["rejected"] == 1
+
+
+def test_failed_trial_opens_the_circuit_again():
+    breaker = payments.CircuitBreaker(threshold=1, reset_after=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    breaker.allow()
+    # only one trial at a time
+    with pytest.raises(payments.CircuitOpenError):
+        breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+
+def test_gateway_calls_do_not_block_the_loop(service_for):
+    gateway = payments.FakeGateway(latency=0.3)
+
+    async def test(service):
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        await service.create_order(7, 1, 2, 250.0)
+        task.cancel()
+        return ticks
+
+    assert service_for(gateway)(test) >= 10
+
+
+@pytest.mark.bench
+def test_bench_order_latency(service_for):
+    gateway = payments.FakeGateway(latency=BENCH_GATEWAY_LATENCY)
+
+    async def test(service):
+        latencies = []
+
+        async def order(registration_id):
+            started = time.perf_counter()
+            await service.create_order(registration_id, 1, 2, 100.0)
+            latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(order(registration_id) for registration_id in range(BENCH_ORDERS)))
+        elapsed = time.perf_counter() - started
+        # the same registrations again, answered from the stored orders
+        reused = time.perf_counter()
+        await asyncio.gather(*(service.create_order(registration_id, 1, 2, 100.0) for registration_id in range(BENCH_ORDERS)))
+        return elapsed, time.perf_counter() - reused, sorted(latencies)
+
+    elapsed, reused, latencies = service_for(gateway)(test)
+    report(
+        "create_order",
+        orders=BENCH_ORDERS,
+        gateway_ms=BENCH_GATEWAY_LATENCY * 1000,
+        orders_per_second=BENCH_ORDERS / elapsed,
+        p50_ms=latencies[len(latencies) // 2] * 1000,
+        p99_ms=latencies[int(len(latencies) * 0.99)] * 1000,
+        retries_per_second=BENCH_ORDERS / reused,
+    )
@@ -0,0 +1,52 @@
+import random
+
+import pytest
+import sqlalchemy
+
+
+def stored(database, table, key: str, value: int):
+    with database.engine.connect() as connection:
+        command = sqlalchemy.select(table.c.rating_sum, table.c.rating_count).where(table.c[key] == value)
+        return connection.execute(command).one()
+
+
+def test_running_means_match_a_full_recompute(database, make_event):
+    events = [make_event(), make_event(name="Poetry Night")]
+    club_id = events[0]["club_id"]
+    # ratings are anonymous, so a second rating from the same person is just another rating
+    rng = random.Random(0)
+    given = {event["event_id"]: [rng.randint(1, 5) for _ in range(rng.randint(3, 12))] for event in events}
+    for event_id, ratings in given.items():
+        for rating in ratings:
+            database.update_event_rating(event_id, rating)
+
+    everything = [rating for ratings in given.values() for rating in ratings]
+    for event_id, ratings in given.items():
+        assert database.get_event(event_id=event_id)["rating"] == pytest.approx(sum(ratings) / len(ratings))
+        assert stored(database, database._events, "event_id", event_id) == (sum(ratings), len(ratings))
+
+    assert stored(database, database._club_ratings, "club_id", club_id) == (sum(everything), len(everything))
+    (entry,) = database.get_leaderboard()
+    assert entry["club_id"] == club_id
+    assert entry["average_rating"] == pytest.approx(sum(everything) / len(everything))
+
+
+def test_the_leaderboard_ranks_clubs_by_their_mean(database, make_event):
+    event = make_event()
+    other_club = database.add_user("other", 1, [])
+    database.add_club(other_club, "Other Club")
+    other_event = database.add_event("Jam Session", "Hall", ["music"], event["start_time"], event["end_time"], 10, other_club)
+
+    for rating in (5, 1, 3):
+        database.update_event_rating(event["event_id"], rating)
+    for rating in (4, 4):
+        database.update_event_rating(other_event, rating)
+    assert [(entry["club_id"], entry["average_rating"]) for entry in database.get_leaderboard()] == [
+        (other_club, 4.0),
+        (event["club_id"], 3.0),
+    ]
+
+
+def test_rating_a_missing_event_is_rejected(database):
+    with pytest.raises(ValueError, match="^Event not found$"):
+        database.update_event_rating(1, 5)
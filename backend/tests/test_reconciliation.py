@@ -0,0 +1,224 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import time
+from contextlib import asynccontextmanager
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api.route import conference
+from api.route import payments as payment_routes
+from api.service import aiodb, config, coordination, payments
+from api.service.reconciliation import CaptureWriter
+
+
+@pytest.fixture
+def app(database):
+    @asynccontextmanager
+    async def lifespan(app):
+        for service in app.background:
+            service.start()
+        yield
+        for service in reversed(app.background):
+            await service.stop()
+        app.database._executor.shutdown()
+
+    app = FastAPI(lifespan=lifespan)
+    app.coordination = coordination.LocalCoordination()
+    app.database = aiodb.AsyncDatabase(database)
+    app.gateway = payments.FakeGateway()
+    app.payments = payments.PaymentService(app.gateway, app.database)
+    app.background = [app.payments]
+    conference.setup(app)
+    payment_routes.setup(app)
+    # the tests reconcile when they choose to
+    app.background.remove(payment_routes.router.reconciler)
+    return app
+
+
+@pytest.fixture
+def client(app):
+    with TestClient(app) as client:
+        yield client
+
+
+def register(client, name: str, user_id: int) -> dict:
+    return client.post("/events/register-event", json={"name": name, "user_id": user_id}).json()["response"]
+
+
+def pay(client, app, order_id: str, amount: int = None) -> int:
+    """Deliver the webhook of a capture of the order, returning the HTTP status it got."""
+    body, signature = app.gateway.capture(order_id)
+    if amount is not None:
+        event = json.loads(body)
+        event["payload"]["payment"]["entity"]["amount"] = amount
+        body = json.dumps(event).encode()
+        signature = hmac.new(config.RAZORPAY_WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    return client.post("/payments/webhook", content=body, headers={"X-Razorpay-Signature": signature}).status_code
+
+
+def reconcile(client) -> dict:
+    client.portal.call(payment_routes.router.reconciler.run_once)
+    return client.get("/payments/reconciliation-stats").json()["response"]["reconciliation"]
+
+
+def test_paid_registration_is_held_until_paid(client, app, database, make_event, make_users):
+    event = make_event(price=250.0)
+    (user_id,) = make_users(1)
+
+    registered = register(client, event["event_name"], user_id)
+    assert database.registration_status(registered["registration_id"]) == "unpaid"
+    assert app.gateway.orders[registered["order_id"]]["amount"] == 25000
+
+    assert pay(client, app, registered["order_id"]) == 200
+    assert reconcile(client)["confirmed"] == 1
+    assert database.registration_status(registered["registration_id"]) == "confirmed"
+
+
+def test_a_retried_registration_gets_the_same_order(client, app, make_event, make_users):
+    event = make_event(price=250.0)
+    (user_id,) = make_users(1)
+
+    first = register(client, event["event_name"], user_id)
+    assert register(client, event["event_name"], user_id) == first
+    assert len(app.gateway.orders) == 1
+
+    # once cancelled, registering again is a new hold with an order of its own
+    client.get(f"/events/cancel-registration/{first['registration_id']}")
+    again = register(client, event["event_name"], user_id)
+    assert again["registration_id"] != first["registration_id"]
+    assert again["order_id"] != first["order_id"]
+
+
+def test_events_without_a_price_are_free(client, database, make_event, make_users):
+    event = make_event(price=None)
+    (user_id,) = make_users(1)
+
+    registered = register(client, event["event_name"], user_id)
+    assert registered["order_id"] is None
+    assert database.registration_status(registered["registration_id"]) == "confirmed"
+    assert register(client, event["event_name"], user_id)["message"] == "Already registered for this event"
+
+
+def test_a_failed_payment_gives_the_seat_back(client, app, database, make_event, make_users):
+    event = make_event(price=250.0, limit=1)
+    (user_id,) = make_users(1)
+    app.gateway.failing = True
+
+    assert register(client, event["event_name"], user_id)["message"].startswith("Payment failed")
+    assert database.get_event(event_id=event["event_id"])["seats_taken"] == 0
+    assert database.get_live_registration(user_id, event["event_id"]) is None
+
+
+def test_a_waiter_offered_a_paid_seat_must_pay_for_it(client, app, database, make_event, make_users):
+    event = make_event(price=250.0, limit=1)
+    first, second = make_users(2)
+
+    held = register(client, event["event_name"], first)
+    waiting = register(client, event["event_name"], second)
+    assert (waiting["status"], waiting["order_id"]) == ("waiting", None)
+
+    # the freed seat is held unpaid, and cannot be approved without paying
+    client.get(f"/events/cancel-registration/{held['registration_id']}")
+    assert database.registration_status(waiting["registration_id"]) == "unpaid"
+    approved = client.get(f"/events/approve-registration/{waiting['registration_id']}").json()["response"]
+    assert approved["message"] == "Registrations for paid events are confirmed by their payment"
+
+    # the reconciler makes the offer's order once its request has had its chance to
+    assert reconcile(client)["orders"] == 0
+    with database.transaction() as session:
+        command = (
+            database._registrations.update()
+            .where(database._registrations.c.registration_id == waiting["registration_id"])
+            .values(registration_timestamp=int(time.time()) - int(config.PAYMENT_TIMEOUT) - 1)
+        )
+        session.execute(command)
+    assert reconcile(client)["orders"] == 1
+    assert reconcile(client)["orders"] == 1
+
+    # registering again finds the order made for the offer
+    offered = register(client, event["event_name"], second)
+    assert offered["registration_id"] == waiting["registration_id"]
+    assert offered["status"] == "unpaid"
+    assert len(app.gateway.orders) == 2
+
+    assert pay(client, app, offered["order_id"]) == 200
+    assert reconcile(client)["confirmed"] == 1
+    assert database.registration_status(waiting["registration_id"]) == "confirmed"
+
+
+def test_webhooks_must_be_signed(client, app, make_event, make_users):
+    event = make_event(price=250.0)
+    (user_id,) = make_users(1)
+    order_id = register(client, event["event_name"], user_id)["order_id"]
+    body, _ = app.gateway.capture(order_id)
+    response = client.post("/payments/webhook", content=body, headers={"X-Razorpay-Signature": "0" * 64})
+    assert response.status_code == 400
+
+
+def test_every_capture_gets_an_outcome(client, app, database, make_event, make_users):
+    event = make_event(price=250.0)
+    paid, twice, short, lapsed, cancelled = make_users(5)
+    orders = {user_id: register(client, event["event_name"], user_id) for user_id in (paid, twice, short, lapsed, cancelled)}
+
+    # the hold ran out, and the other was cancelled, before their payments came
+    with database.transaction() as session:
+        command = (
+            database._registrations.update()
+            .where(database._registrations.c.registration_id == orders[lapsed]["registration_id"])
+            .values(registration_timestamp=int(time.time()) - config.PAYMENT_HOLD_TTL - 1)
+        )
+        session.execute(command)
+    assert database.expire_unpaid()["expired"] == 1
+    client.get(f"/events/cancel-registration/{orders[cancelled]['registration_id']}")
+
+    for user_id in (paid, twice, twice, lapsed, cancelled):
+        assert pay(client, app, orders[user_id]["order_id"]) == 200
+    assert pay(client, app, orders[short]["order_id"], amount=100) == 200
+    # a payment for an order that is not ours
+    app.gateway.orders["order_elsewhere"] = {"amount": 100, "currency": "INR"}
+    assert pay(client, app, "order_elsewhere") == 200
+
+    stats = reconcile(client)
+    assert {outcome: stats[outcome] for outcome in ("confirmed", "duplicate", "underpaid", "refund", "unmatched")} == {
+        "confirmed": 2,
+        "duplicate": 1,
+        "underpaid": 1,
+        "refund": 2,
+        "unmatched": 1,
+    }
+    assert database.registration_status(orders[short]["registration_id"]) == "unpaid"
+    assert database.registration_status(orders[lapsed]["registration_id"]) == "expired"
+    # nothing is reconciled twice
+    assert reconcile(client)["reconciled"] == 7
+
+
+def test_redelivered_webhooks_are_stored_once(database):
+    capture = {"payment_id": "pay_1", "order_id": "order_1", "amount": 100, "currency": "INR", "received_at": 1, "payload": "{}"}
+    database.add_payment_captures([capture])
+    database.add_payment_captures([capture])
+    assert database.reconcile_payments(now=2)["reconciled"] == 1
+
+
+def test_captures_arriving_together_share_a_commit(database):
+    async def main():
+        facade = aiodb.AsyncDatabase(database)
+        writer = CaptureWriter(facade, linger=0.05)
+        writer.start()
+        try:
+            captures = [
+                {"payment_id": f"pay_{number}", "order_id": "order_1", "amount": 100, "currency": "INR", "payload": "{}"}
+                for number in range(50)
+            ]
+            await asyncio.gather(*(writer.add(capture) for capture in captures))
+            return writer.metrics
+        finally:
+            await writer.stop()
+            facade._executor.shutdown()
+
+    metrics = asyncio.run(main())
+    assert metrics["captures"] == 50
+    assert metrics["commits"] < 5
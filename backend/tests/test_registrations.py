@@ -0,0 +1,110 @@
+import time
+
+import pytest
+
+from api.service import config
+
+
+def register(database, event, users) -> list:
+    return [database.register_event(event["event_name"], user_id)["registration_id"] for user_id in users]
+
+
+def statuses(database, registration_ids) -> list:
+    return [database.registration_status(registration_id) for registration_id in registration_ids]
+
+
+def seats_taken(database, event) -> int:
+    return database.get_event(event_id=event["event_id"])["seats_taken"]
+
+
+def backdate(database, registration_id: int, seconds: int):
+    """Move the registration's last change `seconds` into the past."""
+    with database.transaction() as session:
+        command = (
+            database._registrations.update()
+            .where(database._registrations.c.registration_id == registration_id)
+            .values(registration_timestamp=int(time.time()) - seconds)
+        )
+        session.execute(command)
+
+
+@pytest.mark.parametrize("status, to", [("confirmed", "pending"), ("expired", "confirmed"), ("cancelled", "confirmed")])
+def test_illegal_transitions_are_rejected(database, make_event, make_users, status, to):
+    event = make_event(limit=2)
+    confirmed, cancelled, expired = register(database, event, make_users(3))
+    database.cancel_registration(cancelled)
+    backdate(database, expired, config.PENDING_TTL + 1)
+    database.expire_pending()
+    registration_id = {"confirmed": confirmed, "cancelled": cancelled, "expired": expired}[status]
+    assert database.registration_status(registration_id) == status
+
+    with pytest.raises(ValueError, match=f"^Cannot move a {status} registration to {to}$"):
+        with database.transaction() as session:
+            database._transition(session, database._find_registration(session, registration_id), to)
+    assert database.registration_status(registration_id) == status
+
+
+def test_only_pending_offers_can_be_approved(database, make_event, make_users):
+    event = make_event(limit=1)
+    confirmed, waiting = register(database, event, make_users(2))
+    for registration_id in (confirmed, waiting):
+        with pytest.raises(ValueError, match="^Registration not found$"):
+            database.approve_registration(registration_id)
+    assert statuses(database, [confirmed, waiting]) == ["confirmed", "waiting"]
+
+
+def test_an_expired_offer_cannot_be_approved(database, make_event, make_users):
+    event = make_event(limit=1)
+    first, second, third = register(database, event, make_users(3))
+    database.cancel_registration(first)
+    # the sweep has not reached it yet
+    backdate(database, second, config.PENDING_TTL + 1)
+
+    with pytest.raises(ValueError, match="^Registration expired$"):
+        database.approve_registration(second)
+    # the expiry committed, and its seat went to the next in line
+    assert statuses(database, [first, second, third]) == ["cancelled", "expired", "pending"]
+    assert seats_taken(database, event) == 1
+
+
+def test_the_expiry_sweep_gives_the_seat_back(database, make_event, make_users):
+    event = make_event(limit=2)
+    first, second, third, fourth = register(database, event, make_users(4))
+    database.cancel_registration(first)
+    database.cancel_registration(second)
+    assert statuses(database, [third, fourth]) == ["pending", "pending"]
+
+    backdate(database, third, config.PENDING_TTL + 1)
+    assert database.expire_pending()["expired"] == 1
+    # nobody is waiting for the seat, so the event has one free again
+    assert statuses(database, [third, fourth]) == ["expired", "pending"]
+    assert seats_taken(database, event) == 1
+    assert database.expire_pending()["expired"] == 0
+
+
+@pytest.mark.parametrize("status", ["waiting", "pending", "unpaid", "confirmed"])
+def test_cancelling_a_live_registration(database, make_event, make_users, status):
+    event = make_event(limit=1, price=100.0 if status == "unpaid" else 0.0)
+    holder, waiter, next_waiter = register(database, event, make_users(3))
+    if status == "pending":
+        database.cancel_registration(holder)
+    registration_id = {"waiting": waiter, "pending": waiter}.get(status, holder)
+    assert database.registration_status(registration_id) == status
+
+    assert database.cancel_registration(registration_id)
+    assert database.registration_status(registration_id) == "cancelled"
+    if status == "waiting":
+        # it leaves the line without touching the seats
+        assert statuses(database, [holder, next_waiter]) == ["confirmed", "waiting"]
+        database.cancel_registration(holder)
+        assert database.registration_status(next_waiter) == "pending"
+    else:
+        # the seat it held is offered to the next in line
+        offered = next_waiter if status == "pending" else waiter
+        assert database.registration_status(offered) == ("unpaid" if status == "unpaid" else "pending")
+    assert seats_taken(database, event) == 1
+
+    # cancelling again changes nothing
+    assert database.cancel_registration(registration_id)
+    assert database.registration_status(registration_id) == "cancelled"
+    assert seats_taken(database, event) == 1
@@ -0,0 +1,53 @@
+import pytest
+
+from api.service.schedule import Schedule
+
+HOUR = 3600
+
+
+@pytest.fixture
+def schedule():
+    # 10:00-11:00, 13:00-16:00, and 14:00-15:00 inside it; times in hours for readability
+    return Schedule([(13 * HOUR, 16 * HOUR), (10 * HOUR, 11 * HOUR), (14 * HOUR, 15 * HOUR)])
+
+
+@pytest.mark.parametrize(
+    "start, end",
+    [
+        (9, 10),  # ends as the first starts
+        (11, 12),  # starts as the first ends
+        (11, 13),  # fills the gap exactly
+        (16, 17),  # after everything
+    ],
+)
+def test_touching_intervals_do_not_collide(schedule, start, end):
+    assert not schedule.collides(start * HOUR, end * HOUR)
+
+
+@pytest.mark.parametrize(
+    "start, end",
+    [
+        (9, 11),  # overlaps the start of one
+        (10, 11),  # the same interval
+        (10.5, 10.75),  # inside one
+        (9, 17),  # around all of them
+        (15.5, 17),  # overlaps the end of the long one, after the short one inside it ended
+        (12, 14),  # overlaps the start of the long one
+    ],
+)
+def test_overlapping_intervals_collide(schedule, start, end):
+    assert schedule.collides(start * HOUR, end * HOUR)
+
+
+def test_intervals_without_times_are_ignored():
+    schedule = Schedule([(None, 2 * HOUR), (HOUR, None), (HOUR, 2 * HOUR)])
+    assert len(schedule) == 1
+    assert not Schedule().collides(0, HOUR)
+
+
+def test_collisions_keeps_the_events_that_collide(schedule):
+    events = [
+        {"event_id": 1, "start_time": 11 * HOUR, "end_time": 13 * HOUR},
+        {"event_id": 2, "start_time": 15 * HOUR, "end_time": 17 * HOUR},
+    ]
+    assert schedule.collisions(events) == [events[1]]
@@ -0,0 +1,73 @@
+import asyncio
+import time
+
+from api.service import aiodb, config
+from api.service.scheduler import PendingExpiryScheduler
+
+
+def backdate(database, registration_id: int, seconds: int):
+    with database.transaction() as session:
+        command = (
+            database._registrations.update()
+            .where(database._registrations.c.registration_id == registration_id)
+            .values(registration_timestamp=int(time.time()) - seconds)
+        )
+        session.execute(command)
+
+
+def register(database, event, users) -> list:
+    return [database.register_event(event["event_name"], user_id)["registration_id"] for user_id in users]
+
+
+def test_an_expired_offer_goes_to_the_next_waiter(database, make_event, make_users):
+    event = make_event(limit=1)
+    holder, offered, waiter = register(database, event, make_users(3))
+    database.cancel_registration(holder)
+    backdate(database, offered, config.PENDING_TTL + 5)
+
+    scheduler = PendingExpiryScheduler(aiodb.AsyncDatabase(database, mode="inline"))
+    assert asyncio.run(scheduler.run_once()) == 1
+    assert [database.registration_status(registration_id) for registration_id in (offered, waiter)] == ["expired", "pending"]
+    assert database.get_event(event_id=event["event_id"])["seats_taken"] == 1
+    assert scheduler.metrics["expired"] == 1
+    assert scheduler.metrics["max_lag"] >= 5
+
+    # the new offer has its full time to be approved
+    assert asyncio.run(scheduler.run_once()) == 0
+    database.approve_registration(waiter)
+
+
+def test_a_run_drains_every_batch(database, make_event, make_users):
+    event = make_event(limit=3)
+    registration_ids = register(database, event, make_users(6))
+    for registration_id in registration_ids[:3]:
+        database.cancel_registration(registration_id)
+    for registration_id in registration_ids[3:]:
+        backdate(database, registration_id, config.PENDING_TTL + 1)
+
+    scheduler = PendingExpiryScheduler(aiodb.AsyncDatabase(database, mode="inline"), batch_size=1)
+    assert asyncio.run(scheduler.run_once()) == 3
+    assert database.get_event(event_id=event["event_id"])["seats_taken"] == 0
+
+
+def test_the_lease_holder_sweeps_in_the_background(database, make_event, make_users):
+    event = make_event(limit=1)
+    holder, offered = register(database, event, make_users(2))
+    database.cancel_registration(holder)
+    backdate(database, offered, config.PENDING_TTL + 1)
+
+    async def main():
+        scheduler = PendingExpiryScheduler(aiodb.AsyncDatabase(database, mode="inline"), interval=0.01)
+        scheduler.start()
+        try:
+            for _ in range(200):
+                if scheduler.metrics["expired"]:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await scheduler.stop()
+        return scheduler.metrics
+
+    metrics = asyncio.run(main())
+    assert (metrics["leader"], metrics["expired"], metrics["errors"]) == (True, 1, 0)
+    assert database.registration_status(offered) == "expired"
@@ -0,0 +1,64 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# registrations fired at one event at once by the stress test
+STRESS_REGISTRATIONS = int(os.getenv("STRESS_REGISTRATIONS", 2000))
+STRESS_THREADS = int(os.getenv("STRESS_THREADS", 32))
+
+
+def statuses(database, registration_ids):
+    return [database.registration_status(registration_id) for registration_id in registration_ids]
+
+
+def test_parallel_registrations_never_oversell(database, make_event, make_users):
+    event = make_event(limit=25)
+    users = make_users(STRESS_REGISTRATIONS)
+
+    with ThreadPoolExecutor(max_workers=STRESS_THREADS) as executor:
+        registered = list(executor.map(lambda user_id: database.register_event(event["event_name"], user_id), users))
+
+    # each registration reports the status it got, and the rows agree
+    found = statuses(database, [registration["registration_id"] for registration in registered])
+    assert found == [registration["status"] for registration in registered]
+    assert found.count("confirmed") == event["limit"]
+    assert found.count("waiting") == STRESS_REGISTRATIONS - event["limit"]
+    assert database.get_event(event_id=event["event_id"])["seats_taken"] == event["limit"]
+
+
+def test_seat_counter_is_read_from_the_event_row(database, make_event, make_users):
+    event = make_event(limit=2)
+    users = make_users(3)
+
+    registration_ids = [database.register_event(event["event_name"], user_id)["registration_id"] for user_id in users]
+    assert statuses(database, registration_ids) == ["confirmed", "confirmed", "waiting"]
+    assert database.get_event(event_id=event["event_id"])["seats_taken"] == 2
+
+
+def test_cancelling_offers_the_seat_to_the_waitlist(database, make_event, make_users):
+    event = make_event(limit=1)
+    users = make_users(3)
+    first, second, third = [database.register_event(event["event_name"], user_id)["registration_id"] for user_id in users]
+
+    database.cancel_registration(first)
+    assert statuses(database, [first, second, third]) == ["cancelled", "pending", "waiting"]
+    # the offer holds the seat the cancellation gave back
+    assert database.get_event(event_id=event["event_id"])["seats_taken"] == 1
+
+    database.approve_registration(second)
+    assert database.registration_status(second) == "confirmed"
+
+
+def test_bulk_registrations_share_the_free_seats(database, make_event, make_users):
+    event = make_event(limit=3)
+    users = make_users(5)
+
+    results = database.register_events_bulk([{"name": event["event_name"], "user_id": user_id} for user_id in users])
+    assert [result["status"] for result in results] == ["confirmed"] * 3 + ["waiting"] * 2
+    assert database.get_event(event_id=event["event_id"])["seats_taken"] == 3
+
+
+def test_a_full_event_rejects_a_conditional_increment(database, make_event):
+    event = make_event(limit=1)
+    with database.transaction() as session:
+        assert database._take_seat(session, event["event_id"])
+        assert not database._take_seat(session, event["event_id"])
@@ -0,0 +1,32 @@
+from api.service.waiting import EventWaitingList
+
+
+def test_each_event_is_served_oldest_first():
+    waiting = EventWaitingList()
+    waiting.load([
+        {"event_id": 1, "registration_id": 12, "registration_timestamp": 200},
+        {"event_id": 1, "registration_id": 11, "registration_timestamp": 100},
+        {"event_id": 2, "registration_id": 21, "registration_timestamp": 50},
+    ])
+    waiting.enqueue(1, 13, 150)
+
+    assert (waiting.peek(1), waiting.peek(2), waiting.peek(3)) == (11, 21, None)
+    waiting.cancel(11)
+    assert waiting.peek(1) == 13
+    waiting.cancel(13)
+    assert waiting.peek(1) == 12
+    assert len(waiting) == 2
+
+
+def test_a_requeued_entry_takes_its_new_place():
+    waiting = EventWaitingList()
+    waiting.enqueue(1, 11, 100)
+    waiting.enqueue(1, 12, 200)
+    # the stale heap entry at the head no longer matches, and is dropped
+    waiting.enqueue(1, 11, 300)
+    assert waiting.peek(1) == 12
+    waiting.cancel(12)
+    assert waiting.peek(1) == 11
+    waiting.cancel(11)
+    assert waiting.peek(1) is None
+    assert 1 not in waiting.waiting